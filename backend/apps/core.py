@@ -80,4 +80,18 @@ class AuthBearer(HttpBearer):
             raise AuthenticationError()
 
 
+class AsyncAuthBearer(HttpBearer):
+    """异步视图使用的认证，用户查询走异步ORM"""
+
+    async def authenticate(self, request, token):
+        try:
+            user_id = token_util.parse(token)
+            request.user = await User.objects.aget(id=user_id)
+            # 返回用户id
+            return user_id
+        except Exception as e:
+            raise AuthenticationError()
+
+
 auth = dict(auth=AuthBearer())
+async_auth = dict(auth=AsyncAuthBearer())
@@ -1,13 +1,13 @@
 from django.contrib import admin
 from .models import (
-    KnowledgeBase, Document, DocumentChunk, 
+    KnowledgeBase, Document, DocumentChunk, IngestionJob,
     QASession, QARecord, ModelConfig, EmbeddingConfig
 )
 
 
 @admin.register(KnowledgeBase)
 class KnowledgeBaseAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_by', 'created_at', 'is_active']
+    list_display = ['name', 'created_by', 'created_at', 'embedding_config', 'is_active']
     list_filter = ['is_active', 'created_at']
     search_fields = ['name', 'description']
     readonly_fields = ['created_at', 'updated_at']
@@ -29,6 +29,14 @@ class DocumentChunkAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at']
 
 
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['document', 'knowledge_base', 'status', 'stage', 'progress', 'worker', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['document__title', 'error']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
+
+
 @admin.register(QASession)
 class QASessionAdmin(admin.ModelAdmin):
     list_display = ['title', 'user', 'knowledge_base', 'created_at']
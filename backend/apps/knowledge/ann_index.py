@@ -0,0 +1,207 @@
+"""
+向量的近似最近邻(IVF)索引，供大规模知识库检索使用
+
+在归一化向量上做球面k-means得到 nlist 个簇中心（粗量化器），每个块归入最近的簇。
+检索时先用簇中心与查询的相似度选出 nprobe 个簇，只对这些簇内的块计算精确的余弦相似度，
+扫描量约为 N*nprobe/nlist。nprobe 越大召回率越高、耗时越长。
+召回率取决于数据的聚类程度，训练后用抽样的行与精确检索对比（calibrate），选出达到目标召回率的最小 nprobe，
+扫描比例过大仍达不到时不使用索引。
+索引与向量文件一起持久化，行号与 VectorStore 的行一一对应。
+"""
+import logging
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex:
+    """倒排文件(IVF)索引：簇中心 + 每行所属的簇"""
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_count: Optional[int] = None,
+                 nprobe: Optional[int] = None):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        # 训练时的行数，规模翻倍后重新训练
+        self.trained_count = trained_count if trained_count is not None else len(self.assignments)
+        # calibrate 选出的检索簇数，未校准时为None
+        self.nprobe = nprobe
+        # 按簇排序的行号和每个簇的起止位置，首次检索时一起计算
+        self._lists = None
+
+    def __len__(self) -> int:
+        return len(self.assignments)
+
+    def copy(self) -> 'IVFIndex':
+        """副本共享簇中心，add/keep 只替换副本的分配数组"""
+        return IVFIndex(self.centroids, self.assignments, self.trained_count, self.nprobe)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def default_nlist(count: int) -> int:
+        """簇数的经验值 4*sqrt(N)"""
+        return max(1, min(count, int(4 * math.sqrt(count))))
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, nlist: Optional[int] = None, iterations: int = 10,
+              sample_size: Optional[int] = None, seed: int = 0) -> 'IVFIndex':
+        """在（抽样的）向量上训练球面k-means，再把全部行分配到最近的簇"""
+        count = len(vectors)
+        nlist = min(nlist or cls.default_nlist(count), count)
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, sample_size or max(nlist * 32, 10000))
+        sample_rows = np.sort(rng.choice(count, sample_size, replace=False)) if sample_size < count else np.arange(count)
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = cls._nearest(sample, centroids)
+            counts = np.bincount(labels, minlength=nlist)
+            # 按簇排序后分段求和
+            sums = np.zeros_like(centroids)
+            nonempty = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums[nonempty] = np.add.reduceat(sample[np.argsort(labels, kind='stable')], starts[nonempty], axis=0)
+            # 空簇重新取随机样本作为中心
+            empty = ~nonempty
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+
+        return cls(centroids, cls._nearest(vectors, centroids))
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 16384) -> np.ndarray:
+        """按批计算每行相似度最高的簇中心"""
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+            labels[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return labels
+
+    def calibrate(self, vectors: np.ndarray, target_recall: float = 0.95, top_k: int = 10,
+                  queries: int = 200, min_nprobe: int = 1, max_fraction: float = 0.25,
+                  seed: int = 0) -> Optional[int]:
+        """与精确检索对比 recall@top_k，选出达到 target_recall 的最小 nprobe
+
+        查询由抽样的行加随机扰动得到，与原行的相似度等于各行与最近邻相似度的中位数：
+        直接用行本身作查询时它总在自己的簇里，召回率偏高。
+        nprobe 从 min_nprobe 开始逐次翻倍，超过 nlist*max_fraction（扫描量不再明显少于精确检索）仍未达到时
+        返回None；结果同时记录在 self.nprobe。
+        """
+        count = len(vectors)
+        top_k = min(top_k, count - 1)
+        self.nprobe = None
+        if top_k <= 0:
+            return None
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(count, min(queries, count), replace=False))
+        sample = np.asarray(vectors[rows], dtype=np.float32)
+
+        # 最近邻（跳过行自身）的相似度中位数 cos(theta)，查询 = 行 + tan(theta) * 随机单位方向
+        _, scores = self._exact_top(vectors, sample, 2)
+        similarity = float(np.clip(np.median(scores[:, 1]), 0.05, 0.999))
+        noise = rng.standard_normal(sample.shape).astype(np.float32)
+        noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+        sample += math.tan(math.acos(similarity)) * noise
+        sample /= np.linalg.norm(sample, axis=1, keepdims=True)
+        expected = [set(found.tolist()) for found in self._exact_top(vectors, sample, top_k)[0]]
+
+        max_nprobe = max(1, int(self.nlist * max_fraction))
+        nprobe = max(1, min(min_nprobe, max_nprobe))
+        while True:
+            hits = sum(
+                len(exact.intersection(self.search(vectors, query, top_k=top_k, nprobe=nprobe)[0].tolist()))
+                for query, exact in zip(sample, expected)
+            )
+            recall = hits / (top_k * len(expected))
+            if recall >= target_recall:
+                self.nprobe = nprobe
+                return nprobe
+            if nprobe >= max_nprobe:
+                logger.warning(f"IVF索引在 nprobe={nprobe} 时 recall@{top_k} 仅 {recall:.3f}，低于 {target_recall}")
+                return None
+            nprobe = min(nprobe * 2, max_nprobe)
+
+    @staticmethod
+    def _exact_top(vectors: np.ndarray, queries: np.ndarray, k: int,
+                   batch_size: int = 16384) -> Tuple[np.ndarray, np.ndarray]:
+        """按批扫描全部向量，返回每个查询相似度最高的 k 行及其相似度（按相似度降序），形状 (查询数, k)"""
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(vectors), batch_size):
+            scores = queries @ np.asarray(vectors[start:start + batch_size], dtype=np.float32).T
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate(
+                [best_rows, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)], axis=1
+            )
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def add(self, new_vectors: np.ndarray):
+        """新增的行分配到最近的簇（不重新训练）"""
+        if len(new_vectors) == 0:
+            return
+        self.assignments = np.concatenate([self.assignments, self._nearest(new_vectors, self.centroids)])
+        self._lists = None
+
+    def keep(self, keep_rows):
+        """只保留给定的行（升序），行号重新编排为连续的0..n-1"""
+        self.assignments = self.assignments[keep_rows]
+        self._lists = None
+
+    def search(self, vectors: np.ndarray, query: np.ndarray, top_k: int = 5,
+               nprobe: int = 16) -> Tuple[np.ndarray, np.ndarray]:
+        """在最接近查询的 nprobe 个簇内检索，返回按相似度降序的 (行号数组, 相似度数组)
+
+        vectors 为与索引行对齐的归一化向量矩阵（可以是memmap），query 为归一化的查询向量。
+        """
+        lists = self._lists
+        if lists is None:
+            # 两个数组作为一个属性赋值，并发检索不会看到只更新了一半的状态
+            lists = self._lists = (
+                np.argsort(self.assignments, kind='stable').astype(np.int64),
+                np.concatenate([[0], np.cumsum(np.bincount(self.assignments, minlength=self.nlist))])
+            )
+        order, offsets = lists
+
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ query
+        if nprobe < self.nlist:
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.nlist)
+        candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # 行号升序读取，memmap上接近顺序访问
+        candidates.sort()
+        similarities = np.asarray(vectors[candidates]) @ query
+        k = min(top_k, len(candidates))
+        top = np.argpartition(-similarities, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return candidates[top], similarities[top]
+
+    def save(self, path: str):
+        """写入npz文件（centroids/assignments/trained_count/nprobe，未校准时 nprobe 为0）"""
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments,
+                     trained_count=np.array(self.trained_count), nprobe=np.array(self.nprobe or 0))
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFIndex':
+        with np.load(path) as data:
+            nprobe = int(data['nprobe']) if 'nprobe' in data.files else 0
+            return cls(data['centroids'], data['assignments'], int(data['trained_count']), nprobe or None)
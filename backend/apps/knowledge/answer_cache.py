@@ -0,0 +1,190 @@
+"""
+问答结果缓存
+
+AnswerCache: 进程内LRU+TTL缓存，重复的问题直接返回上次的回答和来源。
+缓存键为 (知识库ID, 知识库版本号, 归一化后的问题, 模型配置ID, top_k, threshold)。
+文档增删都会递增知识库版本号，旧版本的缓存项不再被命中，随LRU淘汰或过期自然清除。
+
+SemanticAnswerCache: 按问题向量的余弦相似度匹配同一知识库版本下已保存的 QARecord，
+措辞不同的同一问题复用已有回答，不再检索和调用大模型。只匹配以相同模型配置和检索参数
+（QARecord.cache_scope）生成的回答。
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+# 问题末尾的标点和语气词不影响语义
+_TRAILING_PATTERN = re.compile(r'[\s?？!！。.,，;；~～…]+$')
+_SPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_question(question: str) -> str:
+    """问题归一化：全角转半角、英文小写、合并空白、去掉末尾标点"""
+    text = unicodedata.normalize('NFKC', question).lower().strip()
+    text = _SPACE_PATTERN.sub(' ', text)
+    return _TRAILING_PATTERN.sub('', text)
+
+
+class AnswerCache:
+    """线程安全的LRU+TTL缓存，max_size<=0 时不缓存"""
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(kb_id: int, version: int, question: str, config_id: Optional[int],
+                 top_k: int, threshold: float) -> Tuple:
+        return kb_id, version, normalize_question(question), config_id, top_k, round(float(threshold), 4)
+
+    @staticmethod
+    def make_scope(config_id: Optional[int], top_k: int, threshold: float) -> str:
+        """回答依赖的模型配置和检索参数，保存为 QARecord.cache_scope"""
+        return f"{config_id or ''}:{top_k}:{round(float(threshold), 4)}"
+
+    def get(self, key: Hashable) -> Optional[Dict]:
+        """命中时返回缓存的结果并移到最近使用的位置，过期项顺带删除"""
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Dict):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kb_id: Optional[int] = None):
+        """清除某个知识库（不指定时为全部）的缓存项"""
+        with self._lock:
+            if kb_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == kb_id]:
+                del self._entries[key]
+
+    def stats(self) -> Dict:
+        """命中统计（当前进程）"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+
+class SemanticAnswerCache:
+    """语义缓存：每个知识库在内存中保留当前版本下可复用问答记录的问题向量矩阵
+
+    候选为 kb_version 与知识库当前版本一致、嵌入版本与当前模型一致、cache_scope（模型配置和检索参数）
+    相同且保存了问题向量的 QARecord；每次查找只增量读取比上次更新的记录，其他工作进程保存的回答同样可以命中。
+    查询数据库时不持有锁，读到的记录在锁内合并，各知识库的查找互不阻塞。
+    """
+
+    def __init__(self, threshold: float = 0.95):
+        self.threshold = threshold
+        # (kb_id, cache_scope) -> {'key': (知识库版本, 嵌入版本), 'last_id': 已读取的最大记录ID, 'ids': (...), 'vectors': 矩阵}
+        # 条目创建后不再修改，合并新记录时整体替换
+        self._entries: Dict[Tuple[int, str], Dict] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, kb_id: int, scope: str, kb_version: int, embedding_version: str,
+               question_vector: np.ndarray) -> Optional[Tuple[int, float]]:
+        """返回相似度最高且不低于阈值的 (QARecord ID, 相似度)，没有时返回None（同步方法，会查询数据库）"""
+        entry = self._refresh(kb_id, scope, kb_version, embedding_version)
+        if entry['vectors'] is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        similarities = entry['vectors'] @ question_vector
+        best = int(np.argmax(similarities))
+        with self._lock:
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry['ids'][best], float(similarities[best])
+
+    def _refresh(self, kb_id: int, scope: str, kb_version: int, embedding_version: str) -> Dict:
+        """知识库版本或嵌入版本变化时清空，然后追加新保存的问答记录，返回最新的条目"""
+        from apps.knowledge.models import QARecord
+        from apps.knowledge.rag_system_simple import bytes_to_vector, normalize_rows
+
+        slot = (kb_id, scope)
+        key = (kb_version, embedding_version)
+        with self._lock:
+            entry = self._entries.get(slot)
+        if entry is None or entry['key'] != key:
+            entry = {'key': key, 'last_id': 0, 'ids': (), 'vectors': None}
+
+        rows = list(QARecord.objects.filter(
+            session__knowledge_base_id=kb_id,
+            cache_scope=scope,
+            kb_version=kb_version,
+            embedding_version=embedding_version,
+            question_embedding__isnull=False,
+            id__gt=entry['last_id']
+        ).order_by('id').values_list('id', 'question_embedding'))
+
+        with self._lock:
+            current = self._entries.get(slot)
+            if current is not None and current['key'] == key and current['last_id'] >= entry['last_id']:
+                # 查询期间其他线程已合并过，只追加它没有读到的记录
+                entry = current
+                rows = [row for row in rows if row[0] > entry['last_id']]
+            if rows:
+                vectors = normalize_rows(np.vstack([bytes_to_vector(data) for _, data in rows]))
+                entry = {
+                    'key': key,
+                    'last_id': rows[-1][0],
+                    'ids': entry['ids'] + tuple(record_id for record_id, _ in rows),
+                    'vectors': vectors if entry['vectors'] is None else np.concatenate([entry['vectors'], vectors])
+                }
+            self._entries[slot] = entry
+        return entry
+
+    def invalidate(self, kb_id: Optional[int] = None):
+        with self._lock:
+            if kb_id is None:
+                self._entries.clear()
+                return
+            for slot in [slot for slot in self._entries if slot[0] == kb_id]:
+                del self._entries[slot]
+
+    def stats(self) -> Dict:
+        """命中统计（当前进程）"""
+        total = self.hits + self.misses
+        return {
+            'threshold': self.threshold,
+            'candidates': sum(len(entry['ids']) for entry in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
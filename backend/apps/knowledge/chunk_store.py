@@ -0,0 +1,99 @@
+"""
+文档块的列式元数据
+
+内存索引每行只保存 document_id 和 chunk_index 两个整数（NumPy数组），块所属文档的
+来源路径和类型按文档保存一份。块内容和分块时记录的其余元数据留在数据库中，检索结果需要时
+按 (document_id, chunk_index)（DocumentChunk 上唯一）批量读取，
+百万级块的知识库在内存中不再为每个块常驻一个字符串和一个字典。
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# 没有所属文档（未持久化）的行
+MISSING_DOCUMENT = -1
+
+
+class ChunkTable:
+    """与向量矩阵按行对齐的块元数据，创建后不再修改"""
+
+    __slots__ = ('document_ids', 'chunk_indexes', 'documents')
+
+    def __init__(self, document_ids=None, chunk_indexes=None,
+                 documents: Optional[Dict[int, Tuple[str, str]]] = None):
+        self.document_ids = np.asarray(document_ids if document_ids is not None else [], dtype=np.int64)
+        self.chunk_indexes = np.asarray(chunk_indexes if chunk_indexes is not None else [], dtype=np.int32)
+        # document_id -> (来源路径, 文件类型)
+        self.documents = documents if documents is not None else {}
+
+    def __len__(self) -> int:
+        return len(self.document_ids)
+
+    def concat(self, other: 'ChunkTable') -> 'ChunkTable':
+        return ChunkTable(
+            np.concatenate([self.document_ids, other.document_ids]),
+            np.concatenate([self.chunk_indexes, other.chunk_indexes]),
+            {**self.documents, **other.documents}
+        )
+
+    def take(self, rows) -> 'ChunkTable':
+        """只保留给定的行，同时去掉不再有块的文档"""
+        document_ids = self.document_ids[rows]
+        remaining = set(np.unique(document_ids).tolist())
+        return ChunkTable(
+            document_ids, self.chunk_indexes[rows],
+            {document_id: info for document_id, info in self.documents.items() if document_id in remaining}
+        )
+
+    def document_id_set(self) -> set:
+        """包含的文档ID集合"""
+        document_ids = np.unique(self.document_ids)
+        return set(document_ids[document_ids != MISSING_DOCUMENT].tolist())
+
+    def keys(self) -> np.ndarray:
+        """每行的 (document_id, chunk_index)，形状 (n, 2)"""
+        return np.column_stack([self.document_ids, self.chunk_indexes.astype(np.int64)]).reshape(-1, 2)
+
+    def metadata(self, row: int, extra: Optional[Dict] = None) -> Dict:
+        """构造一行的元数据字典，extra 为数据库中该块保存的元数据"""
+        document_id = int(self.document_ids[row])
+        meta = {'chunk_index': int(self.chunk_indexes[row])}
+        if document_id != MISSING_DOCUMENT:
+            source, file_type = self.documents.get(document_id, (None, None))
+            meta = {'document_id': document_id, **meta, 'source': source, 'type': file_type}
+        return {**meta, **(extra or {})}
+
+    def fetch(self, rows: Iterable[int], batch_size: int = 500) -> List[Tuple[int, str, Dict]]:
+        """按给定顺序读取各行的 (行号, 块内容, 元数据)（同步方法，会查询数据库）
+
+        每批按 (document_id, chunk_index) 精确匹配查询；数据库中已不存在的块（如未持久化或刚被删除）
+        不出现在结果中，返回的行数可能少于请求的行数。
+        """
+        from django.db.models import Q
+
+        rows = [int(row) for row in rows]
+        found = {}
+        for start in range(0, len(rows), batch_size):
+            # document_id -> 该文档需要的 chunk_index
+            wanted: Dict[int, set] = {}
+            for row in rows[start:start + batch_size]:
+                document_id = int(self.document_ids[row])
+                if document_id != MISSING_DOCUMENT:
+                    wanted.setdefault(document_id, set()).add(int(self.chunk_indexes[row]))
+            if not wanted:
+                continue
+            from apps.knowledge.models import DocumentChunk
+            condition = Q()
+            for document_id, chunk_indexes in wanted.items():
+                condition |= Q(document_id=document_id, chunk_index__in=chunk_indexes)
+            for document_id, chunk_index, content, meta in DocumentChunk.objects.filter(condition).values_list(
+                'document_id', 'chunk_index', 'content', 'metadata'
+            ):
+                found[(document_id, chunk_index)] = (content, meta)
+
+        results = []
+        for row in rows:
+            stored = found.get((int(self.document_ids[row]), int(self.chunk_indexes[row])))
+            if stored is not None:
+                results.append((row, stored[0], self.metadata(row, stored[1])))
+        return results
@@ -0,0 +1,113 @@
+"""
+问答上下文构建
+
+按token预算把检索到的文档块拼成提示词中的知识库内容：
+- 内容完全相同的块只保留一次；
+- 同一文档中相邻的块（chunk_index 连续）合并为一段，去掉分块时重叠的文本；
+- 段落按其中最高的相似度排序，依次放入直到用完预算，放不下的段落按剩余预算在句子边界截断。
+token数按字符估算：中日韩字符约1个token，其他字符约4个1个token。
+"""
+import math
+import re
+from typing import Dict, List, Tuple
+
+# 中日韩文字、全角标点和全角字符
+_CJK_PATTERN = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+_SENTENCE_END = re.compile(r'[。！？；!?;\n]')
+
+# 相邻块首尾重合少于该字符数时视为偶然相同，不去重
+MIN_OVERLAP = 20
+# 截断后剩余预算不足该token数时不再放入新的段落
+MIN_PASSAGE_TOKENS = 50
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def overlap_length(previous: str, following: str, max_overlap: int = 500) -> int:
+    """previous 的后缀与 following 的前缀重合的最大长度（不足 MIN_OVERLAP 时为0）"""
+    limit = min(len(previous), len(following), max_overlap)
+    if limit < MIN_OVERLAP:
+        return 0
+    head = following[:MIN_OVERLAP]
+    position = previous.find(head, len(previous) - limit)
+    while position != -1:
+        if following.startswith(previous[position:]):
+            return len(previous) - position
+        position = previous.find(head, position + 1)
+    return 0
+
+
+def merge_passages(docs: List[Dict]) -> List[Tuple[str, float]]:
+    """去重并合并相邻块，返回按相似度降序的 [(段落文本, 段落中最高的相似度)]"""
+    seen = set()
+    groups: Dict = {}
+    for rank, doc in enumerate(docs):
+        content = doc.get('content') or ''
+        if not content or content in seen:
+            continue
+        seen.add(content)
+        metadata = doc.get('metadata') or {}
+        document_id = metadata.get('document_id')
+        chunk_index = metadata.get('chunk_index')
+        # 缺少文档信息的块单独成段
+        key = ('document', document_id) if document_id is not None and chunk_index is not None else ('row', rank)
+        groups.setdefault(key, []).append((chunk_index or 0, content, doc.get('score', 0.0)))
+
+    passages = []
+    for items in groups.values():
+        items.sort(key=lambda item: item[0])
+        last_index, text, score = items[0]
+        for chunk_index, content, chunk_score in items[1:]:
+            if chunk_index == last_index + 1:
+                overlap = overlap_length(text, content)
+                text = text + content[overlap:] if overlap else f"{text}\n{content}"
+                score = max(score, chunk_score)
+            else:
+                passages.append((text, score))
+                text, score = content, chunk_score
+            last_index = chunk_index
+        passages.append((text, score))
+
+    passages.sort(key=lambda passage: -passage[1])
+    return passages
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截取不超过 max_tokens 的前缀，尽量在后半部分的句子边界处结束"""
+    used = 0.0
+    end = 0
+    for end, char in enumerate(text):
+        used += 1 if _CJK_PATTERN.match(char) else 0.25
+        if used > max_tokens:
+            break
+    else:
+        return text
+    boundary = max((match.end() for match in _SENTENCE_END.finditer(text, 0, end)), default=0)
+    return text[:boundary] if boundary > end // 2 else text[:end]
+
+
+def build_context(docs: List[Dict], max_tokens: int, separator: str = "\n\n") -> Tuple[str, int]:
+    """在 max_tokens 预算内构建上下文，返回 (上下文, 估算的token数)"""
+    parts = []
+    used = 0
+    separator_tokens = estimate_tokens(separator)
+    for text, _ in merge_passages(docs):
+        cost = estimate_tokens(text) + (separator_tokens if parts else 0)
+        if used + cost <= max_tokens:
+            parts.append(text)
+            used += cost
+            continue
+        remaining = max_tokens - used - (separator_tokens if parts else 0)
+        if remaining >= MIN_PASSAGE_TOKENS or not parts:
+            text = truncate_to_tokens(text, remaining)
+            if text:
+                used += estimate_tokens(text) + (separator_tokens if parts else 0)
+                parts.append(text)
+        break
+    return separator.join(parts), used
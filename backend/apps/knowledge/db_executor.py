@@ -0,0 +1,136 @@
+"""
+RAG层数据库访问的共享线程池
+
+Django ORM 不能在运行事件循环的线程中调用。问答路径上的查询统一提交到一个
+有界线程池（DB_EXECUTOR_WORKERS 个线程），不再为每次查询新建线程：
+池中线程常驻，各自的数据库连接与请求线程一样按 CONN_MAX_AGE 在查询之间复用。
+同时统计任务在队列中的等待时间和实际执行时间，通过 /knowledge/stats 查看。
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+class DBExecutorStats:
+    """排队等待和执行耗时统计（秒）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.errors = 0
+            self.pending = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.run_total = 0.0
+            self.run_max = 0.0
+
+    def submitted(self):
+        with self._lock:
+            self.pending += 1
+
+    def record(self, wait: float, run: float, failed: bool):
+        with self._lock:
+            self.pending -= 1
+            self.calls += 1
+            self.errors += int(failed)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.run_total += run
+            self.run_max = max(self.run_max, run)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            calls = self.calls or 1
+            return {
+                'workers': _executor._max_workers if _executor else 0,
+                'calls': self.calls,
+                'errors': self.errors,
+                'pending': self.pending,
+                'avg_wait_ms': round(self.wait_total / calls * 1000, 2),
+                'max_wait_ms': round(self.wait_max * 1000, 2),
+                'avg_run_ms': round(self.run_total / calls * 1000, 2),
+                'max_run_ms': round(self.run_max * 1000, 2)
+            }
+
+
+stats = DBExecutorStats()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """返回共享线程池，首次使用时按 DB_EXECUTOR_WORKERS 创建"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from apps.knowledge.rag_system_simple import get_kb_setting
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_kb_setting('DB_EXECUTOR_WORKERS', 4),
+                    thread_name_prefix='kb-db'
+                )
+    return _executor
+
+
+def in_db_thread() -> bool:
+    """当前线程是否为线程池中的线程"""
+    return getattr(_local, 'active', False)
+
+
+def _timed_call(submitted_at: float, func: Callable, args, kwargs) -> Any:
+    """在池中线程内执行 func，记录排队和执行耗时
+
+    池中线程不经过Django的请求开始/结束信号，每个任务前后各调用一次 close_old_connections，
+    与请求线程一样按 CONN_MAX_AGE 关闭过期或出错的连接。
+    """
+    from django.db import close_old_connections
+
+    started_at = time.perf_counter()
+    _local.active = True
+    failed = False
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        close_old_connections()
+        _local.active = False
+        stats.record(started_at - submitted_at, time.perf_counter() - started_at, failed)
+
+
+async def run_db(func: Callable, *args, **kwargs) -> Any:
+    """在共享线程池中执行同步的数据库操作并等待结果（异步代码使用）"""
+    stats.submitted()
+    loop = asyncio.get_running_loop()
+    call = functools.partial(_timed_call, time.perf_counter(), func, args, kwargs)
+    return await loop.run_in_executor(get_executor(), call)
+
+
+def run_db_sync(func: Callable, *args, **kwargs) -> Any:
+    """同步代码执行数据库操作
+
+    在运行事件循环的线程中调用时抛出 RuntimeError：阻塞等待会卡住整个事件循环，
+    异步代码应改为 await run_db(...)，把包含数据库操作的同步函数整体放到线程池中执行。
+    """
+    if not in_db_thread():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError(f"不能在事件循环线程中同步执行数据库操作 {getattr(func, '__qualname__', func)}，请使用 await run_db(...)")
+    return func(*args, **kwargs)
@@ -0,0 +1,280 @@
+"""
+可插拔的嵌入模型实现，按 EmbeddingConfig 为每个知识库选择
+
+所有嵌入模型提供相同的接口（与 SimpleEmbedding 一致）：
+    provider / version / is_fitted 属性，fit(texts)、encode(texts)、get_state()、set_state(state) 方法。
+encode 返回按行L2归一化的 float32 矩阵；version 不同的向量互相不可比。
+"""
+import hashlib
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from .keyword_index import tokenize
+from .llm_client import RETRY_STATUSES, retry_delay
+from .rag_system_simple import SimpleEmbedding, normalize_rows, get_kb_setting
+
+logger = logging.getLogger(__name__)
+
+_request_executor: Optional[ThreadPoolExecutor] = None
+_request_executor_lock = threading.Lock()
+
+
+def get_request_executor() -> ThreadPoolExecutor:
+    """所有API嵌入模型共享的请求线程池，首次使用时按 EMBEDDING_API_CONCURRENCY 创建，线程常驻复用"""
+    global _request_executor
+    if _request_executor is None:
+        with _request_executor_lock:
+            if _request_executor is None:
+                _request_executor = ThreadPoolExecutor(
+                    max_workers=get_kb_setting('EMBEDDING_API_CONCURRENCY', 4),
+                    thread_name_prefix='kb-embed'
+                )
+    return _request_executor
+
+
+class HashedTfidfEmbedding:
+    """本地哈希TF-IDF嵌入（BM25风格的词频饱和与文档长度归一化）
+
+    词项经crc32哈希映射到固定维度并带符号，fit() 在语料上统计每个桶的文档频率得到idf。
+    """
+    provider = 'local'
+
+    def __init__(self, dimension: int = 1024, k1: float = 1.2, b: float = 0.75):
+        self.dimension = dimension
+        self.k1 = k1
+        self.b = b
+        self.idf = np.ones(dimension, dtype=np.float32)
+        self.avgdl = 1.0
+        self.doc_count = 0
+        self.is_fitted = False
+        self.version = ''
+
+    def _hash_tokens(self, tokens: List[str]):
+        """词项 -> (桶位置, 符号, 词频)"""
+        if not tokens:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32), np.array([], dtype=np.float32)
+        hashes = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens), dtype=np.int64, count=len(tokens))
+        unique_hashes, tf = np.unique(hashes, return_counts=True)
+        buckets = unique_hashes % self.dimension
+        signs = np.where((unique_hashes // self.dimension) % 2 == 0, 1.0, -1.0).astype(np.float32)
+        return buckets, signs, tf.astype(np.float32)
+
+    def fit(self, texts: List[str]) -> 'HashedTfidfEmbedding':
+        """在语料上统计文档频率和平均文档长度"""
+        df = np.zeros(self.dimension, dtype=np.float64)
+        total_length = 0
+        for text in texts:
+            tokens = tokenize(text)
+            total_length += len(tokens)
+            buckets, _, _ = self._hash_tokens(tokens)
+            df[np.unique(buckets)] += 1
+
+        self.doc_count = len(texts)
+        self.avgdl = total_length / self.doc_count if self.doc_count else 1.0
+        self.idf = np.log((self.doc_count - df + 0.5) / (df + 0.5) + 1.0).astype(np.float32)
+        self.version = self._compute_version()
+        self.is_fitted = True
+        return self
+
+    def _compute_version(self) -> str:
+        digest = hashlib.sha1(f"{self.provider}|{self.dimension}|{self.k1}|{self.b}|{self.avgdl:.6f}".encode('utf-8'))
+        digest.update(np.round(self.idf, 6).tobytes())
+        return digest.hexdigest()[:16]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """编码文本为向量"""
+        if not texts:
+            return np.array([])
+        if not self.is_fitted:
+            self.fit(texts)
+
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            buckets, signs, tf = self._hash_tokens(tokens)
+            if len(buckets) == 0:
+                continue
+            length_norm = 1 - self.b + self.b * len(tokens) / self.avgdl
+            weights = self.idf[buckets] * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+            np.add.at(vectors[row], buckets, signs * weights)
+        return normalize_rows(vectors)
+
+    def get_state(self) -> Dict:
+        return {
+            'provider': self.provider,
+            'dimension': self.dimension,
+            'k1': self.k1,
+            'b': self.b,
+            'idf': np.round(self.idf, 6).tolist(),
+            'avgdl': self.avgdl,
+            'doc_count': self.doc_count,
+            'version': self.version
+        }
+
+    def set_state(self, state: Dict):
+        self.dimension = state.get('dimension', self.dimension)
+        self.k1 = state.get('k1', self.k1)
+        self.b = state.get('b', self.b)
+        self.idf = np.asarray(state.get('idf', np.ones(self.dimension)), dtype=np.float32)
+        self.avgdl = state.get('avgdl', 1.0)
+        self.doc_count = state.get('doc_count', 0)
+        self.version = state.get('version') or self._compute_version()
+        self.is_fitted = len(self.idf) == self.dimension
+
+
+class APIEmbedding:
+    """OpenAI兼容的嵌入API（POST {api_base_url}/embeddings）
+
+    文本按 batch_size 分批，在进程内共享的请求线程池中并发请求，429/5xx和连接错误按指数退避重试；
+    返回的向量维度必须与配置的 dimension 一致（未配置时以第一次返回的维度为准）。
+    结果按内容哈希缓存在进程内（LRU），相同文本不会重复请求。
+    """
+    provider = 'api'
+
+    def __init__(self, model_name: str, api_base_url: str, api_key: str = '', dimension: Optional[int] = None,
+                 batch_size: Optional[int] = None, concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None, cache_size: Optional[int] = None):
+        self.model_name = model_name
+        self.api_base_url = api_base_url.rstrip('/')
+        self.api_key = api_key
+        self.dimension = dimension
+        self.batch_size = batch_size or get_kb_setting('EMBEDDING_API_BATCH_SIZE', 64)
+        self.concurrency = concurrency or get_kb_setting('EMBEDDING_API_CONCURRENCY', 4)
+        self.timeout = timeout or get_kb_setting('EMBEDDING_API_TIMEOUT', 30)
+        self.cache_size = cache_size or get_kb_setting('EMBEDDING_API_CACHE_SIZE', 10000)
+        self.version = hashlib.sha1(f"{self.provider}|{self.api_base_url}|{model_name}".encode('utf-8')).hexdigest()[:16]
+        self.is_fitted = True
+        self._cache = OrderedDict()
+        self._session = None
+
+    def fit(self, texts: List[str]) -> 'APIEmbedding':
+        """远程模型无需拟合"""
+        return self
+
+    def _get_session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def _cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.version}|{text}".encode('utf-8')).hexdigest()
+
+    def _request_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """请求一批文本的向量，按返回的index对齐；429/5xx和连接错误最多重试 EMBEDDING_API_RETRIES 次"""
+        import requests
+
+        retries = get_kb_setting('EMBEDDING_API_RETRIES', 2)
+        for attempt in range(retries + 1):
+            try:
+                response = self._get_session().post(
+                    f"{self.api_base_url}/embeddings",
+                    headers={
+                        'Content-Type': 'application/json',
+                        'Authorization': f'Bearer {self.api_key}'
+                    },
+                    json={'model': self.model_name, 'input': texts},
+                    timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    raise Exception(f"嵌入API连接失败: {e}") from e
+                delay = retry_delay(attempt)
+                logger.warning(f"嵌入API连接异常 {e}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            else:
+                if response.status_code == 200:
+                    return self._parse_vectors(response.json(), len(texts))
+                if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                    raise Exception(f"嵌入API请求失败 ({response.status_code}): {response.text[:200]}")
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f"嵌入API返回 {response.status_code}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            time.sleep(delay)
+        raise Exception("嵌入API请求失败")
+
+    def _parse_vectors(self, payload: Dict, count: int) -> List[np.ndarray]:
+        """按index排序并检查数量和维度"""
+        data = sorted(payload.get('data', []), key=lambda item: item.get('index', 0))
+        if len(data) != count:
+            raise Exception(f"嵌入API返回数量不匹配: 请求 {count} 条，返回 {len(data)} 条")
+        vectors = [np.asarray(item['embedding'], dtype=np.float32) for item in data]
+        if self.dimension is None:
+            self.dimension = len(vectors[0])
+        for vector in vectors:
+            if vector.shape != (self.dimension,):
+                raise Exception(f"嵌入API返回的向量维度 {vector.size} 与配置的维度 {self.dimension} 不一致")
+        return vectors
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """编码文本为向量"""
+        if not texts:
+            return np.array([])
+
+        keys = [self._cache_key(text) for text in texts]
+        pending = OrderedDict()
+        for key, text in zip(keys, texts):
+            if key not in self._cache and key not in pending:
+                pending[key] = text
+
+        if pending:
+            pending_keys = list(pending)
+            batches = [pending_keys[i:i + self.batch_size] for i in range(0, len(pending_keys), self.batch_size)]
+            logger.info(f"嵌入API请求: {len(pending_keys)} 条文本, {len(batches)} 批")
+            if len(batches) == 1:
+                results = [self._request_batch(list(pending.values()))]
+            else:
+                results = get_request_executor().map(
+                    lambda batch: self._request_batch([pending[key] for key in batch]), batches
+                )
+            for batch, vectors in zip(batches, results):
+                for key, vector in zip(batch, vectors):
+                    self._cache[key] = vector
+
+        vectors = np.vstack([self._cache[key] for key in keys])
+        for key in keys:
+            self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return normalize_rows(vectors)
+
+    def get_state(self) -> Dict:
+        return {
+            'provider': self.provider,
+            'model_name': self.model_name,
+            'api_base_url': self.api_base_url,
+            'version': self.version
+        }
+
+    def set_state(self, state: Dict):
+        """远程模型的版本由配置决定，状态文件只用于记录"""
+        pass
+
+
+def get_embedding_model(config=None):
+    """根据 EmbeddingConfig 创建嵌入模型，未配置时使用 SimpleEmbedding"""
+    if config is None:
+        return SimpleEmbedding()
+
+    if config.embedding_type == 'api':
+        return APIEmbedding(
+            model_name=config.model_name,
+            api_base_url=config.api_base_url,
+            api_key=config.api_key,
+            dimension=config.dimension
+        )
+    if config.embedding_type == 'local':
+        return HashedTfidfEmbedding(dimension=config.dimension)
+
+    logger.warning(f"未知的嵌入类型 {config.embedding_type}，使用 SimpleEmbedding")
+    return SimpleEmbedding()
@@ -0,0 +1,283 @@
+"""
+文档入库任务队列 - 基于数据库的任务表，无需外部消息中间件
+
+上传接口只保存文件并创建 IngestionJob，由 `python manage.py process_ingestion_jobs`
+启动的工作进程领取任务并调用 RAGSystem.process_document；同一知识库有多个待处理任务时一次领取最多
+PARSE_WORKERS 个，其中不超过 PARALLEL_PARSE_MAX_BYTES 的小文件由 RAGSystem.process_documents_parallel
+在进程池中并行解析，大文件仍逐个流式入库，峰值内存与文件大小无关。
+任务领取通过带状态条件的 UPDATE 完成，多个工作进程可以安全地并发消费同一张表。
+处理中的任务由后台线程定期刷新 heartbeat_at，各工作进程在轮询时把心跳超时（工作进程异常退出）的任务重新排队。
+知识库的共享向量文件也由工作进程在任务完成后写入，问答请求中的同步只映射已写好的文件；
+知识库比嵌入模型拟合时增长了 EMBEDDING_REFIT_GROWTH 倍后，写入前先在全部语料上重新拟合。
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_document(document):
+    """为文档创建入库任务，文档状态置为待处理"""
+    from apps.knowledge.models import IngestionJob
+
+    document.status = 'pending'
+    document.save(update_fields=['status'])
+    job = IngestionJob.objects.create(document=document, knowledge_base_id=document.knowledge_base_id)
+    logger.info(f"文档 {document.id} 已加入入库队列, 任务 {job.id}")
+    return job
+
+
+def claim_next_job(worker_name: str, knowledge_base_id: Optional[int] = None):
+    """领取最早的待处理任务（可限定知识库），没有任务时返回None"""
+    from django.utils import timezone
+    from apps.knowledge.models import IngestionJob
+
+    candidates = IngestionJob.objects.filter(status='pending')
+    if knowledge_base_id is not None:
+        candidates = candidates.filter(knowledge_base_id=knowledge_base_id)
+    for job_id in candidates.values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        claimed = IngestionJob.objects.filter(id=job_id, status='pending').update(
+            status='processing',
+            stage='queued',
+            worker=worker_name,
+            started_at=now,
+            heartbeat_at=now
+        )
+        if claimed:
+            return IngestionJob.objects.select_related('document').get(id=job_id)
+    return None
+
+
+def claim_jobs(worker_name: str, limit: int = 1) -> List:
+    """领取最早的待处理任务，再领取同一知识库的其他待处理任务，最多 limit 个"""
+    job = claim_next_job(worker_name)
+    if job is None:
+        return []
+    jobs = [job]
+    while len(jobs) < limit:
+        job = claim_next_job(worker_name, jobs[0].knowledge_base_id)
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def _heartbeat(job_ids: List[int], interval: float, stop_event: threading.Event):
+    """任务处理期间每 interval 秒刷新一次 heartbeat_at（在单独的线程中运行，使用自己的数据库连接）"""
+    from django.db import connection
+    from django.utils import timezone
+    from apps.knowledge.models import IngestionJob
+
+    try:
+        while not stop_event.wait(interval):
+            try:
+                IngestionJob.objects.filter(id__in=job_ids, status='processing').update(heartbeat_at=timezone.now())
+            except Exception as e:
+                logger.warning(f"刷新入库任务 {job_ids} 的心跳失败: {e}")
+    finally:
+        connection.close()
+
+
+def run_job(rag_system, job, heartbeat_interval: Optional[float] = None) -> bool:
+    """执行一个已领取的任务，返回是否成功"""
+    return run_jobs(rag_system, [job], heartbeat_interval) == 1
+
+
+def run_jobs(rag_system, jobs: List, heartbeat_interval: Optional[float] = None) -> int:
+    """执行已领取的同一知识库的任务，返回成功的任务数
+
+    不超过 PARALLEL_PARSE_MAX_BYTES 的小文件有两个及以上时，解析和分块在进程池中并行
+    （RAGSystem.process_documents_parallel，子进程把整份文件的块返回主进程）；
+    其余文件逐个由 RAGSystem.process_document 流式读取、分批入库。每个任务都按阶段报告进度。
+    """
+    from django.utils import timezone
+    from apps.knowledge.models import Document, IngestionJob
+    from apps.knowledge.rag_system_simple import get_kb_setting
+
+    kb_id = jobs[0].knowledge_base_id
+    Document.objects.filter(id__in=[job.document_id for job in jobs]).update(status='processing')
+
+    def progress_reporter(job):
+        def report_progress(stage: str, progress: int):
+            IngestionJob.objects.filter(id=job.id).update(stage=stage, progress=progress, heartbeat_at=timezone.now())
+        return report_progress
+
+    max_bytes = get_kb_setting('PARALLEL_PARSE_MAX_BYTES', 8 * 1024 * 1024)
+    parallel = [i for i, job in enumerate(jobs) if _file_size(job.document.file_path) <= max_bytes]
+    if len(parallel) < 2:
+        parallel = []
+    results: List[Optional[Dict]] = [None] * len(jobs)
+
+    if heartbeat_interval is None:
+        heartbeat_interval = get_kb_setting('INGEST_HEARTBEAT_INTERVAL', 30)
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat, args=([job.id for job in jobs], heartbeat_interval, stop_heartbeat),
+        name=f'ingest-heartbeat-{jobs[0].id}', daemon=True
+    )
+    heartbeat.start()
+    try:
+        if parallel:
+            reporters = [progress_reporter(jobs[i]) for i in parallel]
+            IngestionJob.objects.filter(id__in=[jobs[i].id for i in parallel]).update(stage='parse', progress=5)
+            parallel_results = rag_system.process_documents_parallel(
+                kb_id, [(jobs[i].document.file_path, jobs[i].document_id) for i in parallel],
+                progress_callback=lambda index, stage, progress: reporters[index](stage, progress)
+            )
+            for i, result in zip(parallel, parallel_results):
+                results[i] = result
+        for i, job in enumerate(jobs):
+            if results[i] is None:
+                results[i] = rag_system.process_document(
+                    kb_id, job.document.file_path, job.document_id, progress_callback=progress_reporter(job)
+                )
+    except Exception as e:
+        results = [result or {'success': False, 'error': str(e)} for result in results]
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+
+    succeeded = sum(_finish_job(job, result) for job, result in zip(jobs, results))
+    if succeeded:
+        refit_if_grown(rag_system, kb_id)
+        persist_index(rag_system, kb_id)
+    else:
+        rag_system.knowledge_bases.pop(kb_id, None)
+        rag_system.kb_versions.pop(kb_id, None)
+    return succeeded
+
+
+def _file_size(file_path: str) -> float:
+    """文件大小，读取失败时视为大文件（交给单文件流程报告错误）"""
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return float('inf')
+
+
+def refit_if_grown(rag_system, kb_id: int):
+    """知识库比嵌入模型拟合时增长了 EMBEDDING_REFIT_GROWTH 倍后，在整个语料上重新拟合并重新编码"""
+    try:
+        rag_system.refit_embedding_if_grown(kb_id)
+    except Exception as e:
+        logger.error(f"重新拟合知识库 {kb_id} 的嵌入模型失败: {e}")
+
+
+def persist_index(rag_system, kb_id: int):
+    """任务完成后写入知识库新版本的共享向量文件，问答进程同步时直接映射，不在请求中写文件"""
+    try:
+        rag_system.persist_knowledge_base(kb_id)
+    except Exception as e:
+        logger.error(f"写入知识库 {kb_id} 的向量文件失败: {e}")
+    finally:
+        # 工作进程只负责写入，不需要常驻知识库的内存索引
+        rag_system.knowledge_bases.pop(kb_id, None)
+        rag_system.kb_versions.pop(kb_id, None)
+
+
+def _finish_job(job, result: Dict) -> bool:
+    """按处理结果更新任务和文档状态，返回是否成功"""
+    from django.utils import timezone
+    from apps.knowledge.models import Document, IngestionJob
+
+    if result.get('success'):
+        IngestionJob.objects.filter(id=job.id).update(
+            status='completed',
+            stage='done',
+            progress=100,
+            result={'chunk_count': result.get('chunk_count', 0), 'ingest_stats': result.get('ingest_stats', {})},
+            finished_at=timezone.now()
+        )
+        logger.info(f"入库任务 {job.id} 完成: 文档 {job.document_id}, {result.get('chunk_count', 0)} 个块")
+        return True
+
+    error = result.get('error', '未知错误')
+    Document.objects.filter(id=job.document_id).update(status='failed')
+    IngestionJob.objects.filter(id=job.id).update(status='failed', error=error, finished_at=timezone.now())
+    logger.error(f"入库任务 {job.id} 失败: 文档 {job.document_id}, {error}")
+    return False
+
+
+def requeue_stale_jobs(timeout_seconds: int) -> int:
+    """把超过 timeout_seconds 秒没有心跳的处理中任务（工作进程异常退出）重新放回队列"""
+    from django.db.models import Q
+    from django.utils import timezone
+    from apps.knowledge.models import Document, IngestionJob
+
+    deadline = timezone.now() - timedelta(seconds=timeout_seconds)
+    # 升级前领取的任务没有心跳，按开始时间判断
+    stale = Q(heartbeat_at__lt=deadline) | Q(heartbeat_at__isnull=True, started_at__lt=deadline)
+    stale_ids = list(IngestionJob.objects.filter(stale, status='processing').values_list('id', flat=True))
+    if not stale_ids:
+        return 0
+    # UPDATE 带着同样的条件，查询之后刚刷新心跳的任务不会被重新排队
+    count = IngestionJob.objects.filter(stale, id__in=stale_ids, status='processing').update(
+        status='pending', stage='', progress=0, worker='', started_at=None, heartbeat_at=None
+    )
+    if count:
+        Document.objects.filter(
+            ingestion_jobs__id__in=stale_ids, ingestion_jobs__status='pending'
+        ).update(status='pending')
+        logger.warning(f"重新排队 {count} 个心跳超时的入库任务")
+    return count
+
+
+def worker_loop(worker_name: Optional[str] = None, poll_interval: float = 2.0, once: bool = False,
+                stop_event=None) -> int:
+    """工作进程主循环：领取并执行任务，队列为空时按 poll_interval 轮询
+
+    每隔 INGEST_REQUEUE_INTERVAL 秒把心跳超过 INGEST_JOB_TIMEOUT 秒的任务重新排队，
+    并为向量文件落后于版本号的知识库写入新文件。
+    once=True 时处理完当前队列即退出；返回处理的任务数。stop_event 被设置后处理完当前任务即退出。
+    """
+    import django
+    django.setup()
+
+    if stop_event is not None and multiprocessing.parent_process() is not None:
+        # 子进程由父进程统一处理中断信号，避免任务执行到一半被打断
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from django.db import close_old_connections
+    from apps.knowledge.rag_system_simple import RAGSystem, get_kb_setting
+
+    worker_name = worker_name or f"{socket.gethostname()}-{os.getpid()}"
+    rag_system = RAGSystem()
+    processed = 0
+    batch_size = max(1, get_kb_setting('PARSE_WORKERS', min(os.cpu_count() or 1, 4)))
+    job_timeout = get_kb_setting('INGEST_JOB_TIMEOUT', 300)
+    requeue_interval = get_kb_setting('INGEST_REQUEUE_INTERVAL', 60)
+    next_requeue = 0.0
+    logger.info(f"入库工作进程 {worker_name} 已启动")
+
+    while not (stop_event and stop_event.is_set()):
+        close_old_connections()
+        if time.monotonic() >= next_requeue:
+            requeue_stale_jobs(job_timeout)
+            # 文档删除等不经过入库队列的版本变化，也由工作进程补写向量文件
+            try:
+                rag_system.persist_stale_knowledge_bases()
+            except Exception as e:
+                logger.error(f"写入向量文件失败: {e}")
+            next_requeue = time.monotonic() + requeue_interval
+        jobs = claim_jobs(worker_name, batch_size)
+        if not jobs:
+            if once:
+                break
+            if stop_event:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+        run_jobs(rag_system, jobs)
+        processed += len(jobs)
+
+    logger.info(f"入库工作进程 {worker_name} 退出, 共处理 {processed} 个任务")
+    return processed
@@ -0,0 +1,169 @@
+"""
+知识库的倒排关键词索引，按BM25打分，与向量检索结果融合（混合检索）
+
+设备型号、标准编号这类关键词在向量空间里区分度很低，倒排索引只读取查询词的倒排表，
+检索开销与命中的块数成正比，而不是与知识库总块数成正比。
+每个块的词频在入库时计算并保存在 DocumentChunk.terms 中，加载索引时无需重新分词。
+"""
+import math
+import re
+from collections import Counter
+from typing import List, Dict, Iterable, Tuple
+
+import numpy as np
+
+try:
+    import jieba
+    HAS_JIEBA = True
+except ImportError:
+    HAS_JIEBA = False
+
+# jieba不可用时的简单切分：英文/数字串（设备型号、标准编号）和单个汉字
+_FALLBACK_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9\-_./]*|[一-鿿]')
+
+# 完整的型号/编号（如 ZN63A-12、GB/T、14285-2006），jieba会把它们拆开，额外作为一个词项索引
+_CODE_PATTERN = re.compile(r'[A-Za-z0-9]+(?:[\-_./][A-Za-z0-9]+)+')
+
+# 几乎每个块都包含的虚词，不建倒排表
+STOP_WORDS = frozenset('的 了 和 与 及 或 是 在 为 对 等 中 也 就 都 而 被 把 由 其 之 这 那 有 将 以 于 并'.split())
+
+
+def tokenize(text: str) -> List[str]:
+    """分词：优先使用jieba，英文统一小写，去掉空白和标点"""
+    if HAS_JIEBA:
+        tokens = jieba.lcut(text)
+    else:
+        tokens = _FALLBACK_TOKEN_PATTERN.findall(text)
+    return [token.lower() for token in tokens if token.strip() and not re.fullmatch(r'\W+', token)]
+
+
+def term_counts(text: str) -> Dict[str, int]:
+    """块的词频：分词结果去掉虚词，再补充完整的型号/编号词项"""
+    counts = Counter(token for token in tokenize(text) if token not in STOP_WORDS)
+    for code, count in Counter(code.lower() for code in _CODE_PATTERN.findall(text)).items():
+        counts[code] = max(counts[code], count)
+    return dict(counts)
+
+
+class KeywordIndex:
+    """BM25倒排索引，行号与 VectorStore 的行一一对应
+
+    倒排表按词项分组存放在连续数组中（_offsets 为每个词项的起止位置），
+    新增的块先放入待合并列表，检索或删除前再一次性合并。
+    数组只整体替换不原地修改，copy() 得到的副本与原索引互不影响。
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_ids: Dict[str, int] = {}
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._rows = np.zeros(0, dtype=np.int32)
+        self._tfs = np.zeros(0, dtype=np.float32)
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def copy(self) -> 'KeywordIndex':
+        """浅复制：共享倒排数组，只复制会原地修改的词项表和待合并列表"""
+        clone = KeywordIndex(self.k1, self.b)
+        clone.term_ids = dict(self.term_ids)
+        clone.doc_lengths = self.doc_lengths
+        clone._offsets, clone._rows, clone._tfs = self._offsets, self._rows, self._tfs
+        clone._pending = list(self._pending)
+        return clone
+
+    def compact(self):
+        """立即合并待合并的倒排表，之后检索不再修改索引"""
+        self._merge_pending()
+
+    def add(self, terms_list: Iterable[Dict[str, int]]):
+        """按顺序追加块的词频，行号接在已有行之后"""
+        base = len(self)
+        term_col, row_col, tf_col, lengths = [], [], [], []
+        for row, counts in enumerate(terms_list, base):
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_col.append(self.term_ids.setdefault(term, len(self.term_ids)))
+                row_col.append(row)
+                tf_col.append(tf)
+        if not lengths:
+            return
+        self._pending.append((
+            np.array(term_col, dtype=np.int64),
+            np.array(row_col, dtype=np.int32),
+            np.array(tf_col, dtype=np.float32)
+        ))
+        self.doc_lengths = np.concatenate([self.doc_lengths, np.array(lengths, dtype=np.float32)])
+
+    def keep(self, keep_rows: List[int]):
+        """只保留给定的行（升序），行号重新编排为连续的0..n-1"""
+        mapping = np.full(len(self), -1, dtype=np.int64)
+        mapping[keep_rows] = np.arange(len(keep_rows))
+        terms, rows, tfs = self._expand()
+        new_rows = mapping[rows]
+        mask = new_rows >= 0
+        self._set_postings(terms[mask], new_rows[mask].astype(np.int32), tfs[mask])
+        self.doc_lengths = self.doc_lengths[keep_rows]
+
+    def search(self, query: str, top_k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25检索，返回按得分降序的 (行号数组, 得分数组)，只包含至少命中一个查询词的行"""
+        self._merge_pending()
+        n = len(self)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        if n == 0 or top_k <= 0:
+            return empty
+
+        avgdl = float(self.doc_lengths.mean()) or 1.0
+        row_parts, score_parts = [], []
+        for term in term_counts(query):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            lo, hi = self._offsets[term_id], self._offsets[term_id + 1]
+            df = hi - lo
+            if df == 0:
+                continue
+            rows = self._rows[lo:hi]
+            tfs = self._tfs[lo:hi]
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[rows] / avgdl)
+            row_parts.append(rows)
+            score_parts.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+        if not row_parts:
+            return empty
+
+        # 只在命中的行上累加各词项得分
+        hit_rows, inverse = np.unique(np.concatenate(row_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts)).astype(np.float32)
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return hit_rows[top].astype(np.int64), scores[top]
+
+    def _expand(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """合并后的倒排表展开为 (词项ID, 行号, 词频) 三列"""
+        self._merge_pending()
+        terms = np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int64), np.diff(self._offsets))
+        return terms, self._rows, self._tfs
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        terms = np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int64), np.diff(self._offsets))
+        self._set_postings(
+            np.concatenate([terms] + [part[0] for part in pending]),
+            np.concatenate([self._rows] + [part[1] for part in pending]),
+            np.concatenate([self._tfs] + [part[2] for part in pending])
+        )
+
+    def _set_postings(self, terms: np.ndarray, rows: np.ndarray, tfs: np.ndarray):
+        """按词项ID稳定排序（同一词项内保持行号升序）并重建偏移量"""
+        order = np.argsort(terms, kind='stable')
+        self._rows = rows[order]
+        self._tfs = tfs[order]
+        counts = np.bincount(terms, minlength=len(self.term_ids))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
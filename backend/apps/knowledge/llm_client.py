@@ -0,0 +1,163 @@
+"""
+大模型API的共享HTTP客户端
+
+每个事件循环按 协议+主机 复用一个带连接池的 aiohttp.ClientSession（keep-alive），
+同一工作进程内的问答不再为每次调用重新建立TCP+TLS连接。
+请求遇到连接错误、超时、429或5xx时按指数退避重试；流式请求只在收到响应之前重试。
+连接数、超时、重试次数等通过 settings.KNOWLEDGE_BASE 的 LLM_HTTP_* 配置。
+"""
+import asyncio
+import json
+import logging
+import random
+import weakref
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .rag_system_simple import get_kb_setting
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# 事件循环 -> {协议+主机: 会话}；事件循环被回收后对应的会话随之释放
+_sessions: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, aiohttp.ClientSession]]' = weakref.WeakKeyDictionary()
+
+
+class LLMAPIError(Exception):
+    """大模型API请求失败（重试后仍失败或返回非重试类错误）"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    """返回当前事件循环中该URL所在主机的共享会话，不存在或已关闭时创建"""
+    loop = asyncio.get_running_loop()
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    sessions = _sessions.setdefault(loop, {})
+    session = sessions.get(origin)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=get_kb_setting('LLM_HTTP_LIMIT', 100),
+            limit_per_host=get_kb_setting('LLM_HTTP_LIMIT_PER_HOST', 20),
+            keepalive_timeout=get_kb_setting('LLM_HTTP_KEEPALIVE', 60),
+            ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=get_kb_setting('LLM_HTTP_TIMEOUT', 30),
+            connect=get_kb_setting('LLM_HTTP_CONNECT_TIMEOUT', 10)
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        sessions[origin] = session
+        logger.info(f"创建大模型API连接池: {origin}")
+    return session
+
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """第 attempt 次重试前的等待秒数：优先服务端的 Retry-After，否则指数退避加随机抖动"""
+    max_delay = get_kb_setting('LLM_HTTP_MAX_BACKOFF', 10)
+    if retry_after:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    base = get_kb_setting('LLM_HTTP_BACKOFF', 0.5) * (2 ** attempt)
+    return min(base + random.uniform(0, base / 2), max_delay)
+
+
+async def post_json(url: str, payload: Dict, headers: Optional[Dict] = None) -> Dict:
+    """POST JSON 并返回解析后的响应，失败时抛出 LLMAPIError"""
+    retries = get_kb_setting('LLM_HTTP_RETRIES', 2)
+    session = get_session(url)
+    for attempt in range(retries + 1):
+        try:
+            async with session.post(url, json=payload, headers=headers) as response:
+                if response.status == 200:
+                    return await response.json(content_type=None)
+                error_text = await response.text()
+                if response.status not in RETRY_STATUSES or attempt >= retries:
+                    raise LLMAPIError(f"API请求失败 ({response.status}): {error_text[:500]}", response.status)
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f"API返回 {response.status}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise LLMAPIError(f"API连接失败: {str(e) or type(e).__name__}") from e
+            delay = retry_delay(attempt)
+            logger.warning(f"API连接异常 {str(e) or type(e).__name__}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+        await asyncio.sleep(delay)
+    raise LLMAPIError("API请求失败")
+
+
+async def post_stream(url: str, payload: Dict, headers: Optional[Dict] = None) -> AsyncIterator[Dict]:
+    """POST JSON 并逐个产出服务端事件流(SSE)中 data 行解析后的JSON，遇到 [DONE] 结束
+
+    流式响应的总时长不受 LLM_HTTP_TIMEOUT 限制，改为限制相邻两次读取之间的间隔。
+    """
+    retries = get_kb_setting('LLM_HTTP_RETRIES', 2)
+    session = get_session(url)
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        connect=get_kb_setting('LLM_HTTP_CONNECT_TIMEOUT', 10),
+        sock_read=get_kb_setting('LLM_HTTP_TIMEOUT', 30)
+    )
+    for attempt in range(retries + 1):
+        try:
+            response = await session.post(url, json=payload, headers=headers, timeout=timeout)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise LLMAPIError(f"API连接失败: {str(e) or type(e).__name__}") from e
+            delay = retry_delay(attempt)
+            logger.warning(f"API连接异常 {str(e) or type(e).__name__}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            await asyncio.sleep(delay)
+            continue
+
+        async with response:
+            if response.status != 200:
+                error_text = await response.text()
+                if response.status not in RETRY_STATUSES or attempt >= retries:
+                    raise LLMAPIError(f"API请求失败 ({response.status}): {error_text[:500]}", response.status)
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f"API返回 {response.status}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            else:
+                try:
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line.startswith(b'data:'):
+                            continue
+                        data = line[5:].strip()
+                        if data == b'[DONE]':
+                            return
+                        if data:
+                            yield json.loads(data)
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise LLMAPIError(f"API流式响应中断: {str(e) or type(e).__name__}") from e
+        await asyncio.sleep(delay)
+    raise LLMAPIError("API请求失败")
+
+
+async def close_sessions():
+    """关闭当前事件循环中的所有共享会话（ASGI lifespan 关闭时、或关闭自建的事件循环之前调用）"""
+    sessions = _sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
+def close_all_sessions():
+    """关闭所有空闲事件循环中的共享会话（同步方法，工作进程退出时调用）
+
+    正在运行的事件循环由其自身的 lifespan 关闭；已关闭的事件循环无法再关闭连接，只丢弃引用。
+    """
+    for loop, sessions in list(_sessions.items()):
+        if loop.is_running():
+            continue
+        _sessions.pop(loop, None)
+        if loop.is_closed():
+            continue
+        for session in sessions.values():
+            loop.run_until_complete(session.close())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+写入知识库共享向量文件的Django管理命令
+"""
+
+from django.core.management.base import BaseCommand
+from apps.knowledge.models import KnowledgeBase
+from apps.knowledge.rag_system_simple import RAGSystem
+
+
+class Command(BaseCommand):
+    help = '为向量文件落后于知识库版本的知识库写入新的共享向量文件（入库工作进程会自动执行）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kb', type=int, action='append', help='知识库ID，可重复；不指定则处理所有激活的知识库')
+
+    def handle(self, *args, **options):
+        """执行命令"""
+        rag_system = RAGSystem()
+        if not options['kb']:
+            persisted = rag_system.persist_stale_knowledge_bases()
+            self.stdout.write(self.style.SUCCESS(f'✓ 写入 {len(persisted)} 个知识库的向量文件: {persisted}'))
+            return
+
+        for kb_id in options['kb']:
+            if not KnowledgeBase.objects.filter(id=kb_id).exists():
+                self.stdout.write(self.style.ERROR(f'✗ 知识库 {kb_id} 不存在'))
+                continue
+            manifest = rag_system.persist_knowledge_base(kb_id)
+            if manifest:
+                self.stdout.write(self.style.SUCCESS(
+                    f"✓ 知识库 {kb_id}: 版本 {manifest['version']}, {manifest['count']} 个块"
+                ))
+            else:
+                self.stdout.write(f'- 知识库 {kb_id} 的向量文件已是最新或正在由其他进程写入')
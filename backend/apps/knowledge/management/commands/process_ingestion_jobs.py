@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+消费文档入库任务队列的Django管理命令
+"""
+
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from apps.knowledge.ingestion import worker_loop
+from apps.knowledge.rag_system_simple import get_kb_setting
+
+
+class Command(BaseCommand):
+    help = '启动入库工作进程，处理上传文档的解析、分块、编码和入库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=get_kb_setting('INGEST_WORKERS', 2), help='工作进程数量')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='队列为空时的轮询间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='处理完当前队列后退出')
+
+    @staticmethod
+    def install_shutdown_handler(stop_event):
+        """收到 SIGTERM/SIGINT 时设置 stop_event，正在处理的任务完成后再退出"""
+        def shutdown(signum, frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+    def handle(self, *args, **options):
+        """执行命令"""
+        workers = max(1, options['workers'])
+        if workers == 1:
+            stop_event = threading.Event()
+            self.install_shutdown_handler(stop_event)
+            processed = worker_loop(poll_interval=options['poll_interval'], once=options['once'], stop_event=stop_event)
+            self.stdout.write(self.style.SUCCESS(f'✓ 共处理 {processed} 个入库任务'))
+            return
+
+        # 子进程各自建立数据库连接
+        connections.close_all()
+        stop_event = multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(
+                target=worker_loop,
+                kwargs={'poll_interval': options['poll_interval'], 'once': options['once'], 'stop_event': stop_event},
+                name=f'ingest-worker-{i}'
+            )
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(self.style.SUCCESS(f'✓ 已启动 {workers} 个入库工作进程'))
+
+        self.install_shutdown_handler(stop_event)
+        for process in processes:
+            process.join()
+        self.stdout.write(self.style.SUCCESS('✓ 入库工作进程已全部退出'))
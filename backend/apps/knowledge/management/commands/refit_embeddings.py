@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+在知识库全部语料上重新拟合嵌入模型的Django管理命令
+
+更换知识库的嵌入配置后需要执行；块数增长到拟合时 EMBEDDING_REFIT_GROWTH 倍的知识库由入库工作进程
+自动重新拟合，关闭该设置、同步入库或状态文件没有记录拟合块数（旧版本）时手动执行。
+"""
+
+from django.core.management.base import BaseCommand
+from apps.knowledge.models import KnowledgeBase, DocumentChunk, EmbeddingCache
+from apps.knowledge.rag_system_simple import RAGSystem
+
+
+class Command(BaseCommand):
+    help = '按知识库的嵌入模型配置重新拟合并重新编码所有文档块'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kb', type=int, action='append', help='知识库ID，可重复；不指定则处理所有激活的知识库')
+        parser.add_argument('--prune-cache', action='store_true', help='完成后删除不再被任何文档块使用的嵌入版本的缓存')
+
+    def handle(self, *args, **options):
+        """执行命令"""
+        kb_ids = options['kb'] or list(KnowledgeBase.objects.filter(is_active=True).values_list('id', flat=True))
+        rag_system = RAGSystem()
+        
+        for kb_id in kb_ids:
+            try:
+                result = rag_system.refit_embedding(kb_id)
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"✓ 知识库 {kb_id}: 版本 {result['embedding_version']}, "
+                        f"嵌入类型 {result['provider']}, 重新编码 {result['chunk_count']} 个块"
+                        f"（缓存命中 {result['cache_hits']} 个）"
+                    )
+                )
+            except Exception as e:
+                self.stdout.write(
+                    self.style.ERROR(f'✗ 知识库 {kb_id} 重新拟合失败: {str(e)}')
+                )
+        
+        if options['prune_cache']:
+            versions = set(DocumentChunk.objects.values_list('embedding_version', flat=True).distinct())
+            deleted, _ = EmbeddingCache.objects.exclude(embedding_version__in=versions).delete()
+            self.stdout.write(self.style.SUCCESS(f"✓ 清理嵌入缓存 {deleted} 条"))
@@ -0,0 +1,60 @@
+# 将DocumentChunk.embedding从JSON列表转换为float32二进制
+
+import numpy as np
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def json_to_blob(apps, schema_editor):
+    DocumentChunk = apps.get_model('knowledge', 'DocumentChunk')
+    batch = []
+    for chunk in DocumentChunk.objects.exclude(embedding__isnull=True).only('id', 'embedding').iterator(chunk_size=BATCH_SIZE):
+        if not chunk.embedding:
+            continue
+        chunk.embedding_blob = np.asarray(chunk.embedding, dtype=np.float32).tobytes()
+        batch.append(chunk)
+        if len(batch) >= BATCH_SIZE:
+            DocumentChunk.objects.bulk_update(batch, ['embedding_blob'])
+            batch = []
+    if batch:
+        DocumentChunk.objects.bulk_update(batch, ['embedding_blob'])
+
+
+def blob_to_json(apps, schema_editor):
+    DocumentChunk = apps.get_model('knowledge', 'DocumentChunk')
+    batch = []
+    for chunk in DocumentChunk.objects.exclude(embedding_blob__isnull=True).only('id', 'embedding_blob').iterator(chunk_size=BATCH_SIZE):
+        chunk.embedding = np.frombuffer(bytes(chunk.embedding_blob), dtype=np.float32).tolist()
+        batch.append(chunk)
+        if len(batch) >= BATCH_SIZE:
+            DocumentChunk.objects.bulk_update(batch, ['embedding'])
+            batch = []
+    if batch:
+        DocumentChunk.objects.bulk_update(batch, ['embedding'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0007_knowledgebase_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='embedding_blob',
+            field=models.BinaryField(blank=True, null=True, verbose_name='向量嵌入(float32)'),
+        ),
+        migrations.RunPython(json_to_blob, blob_to_json),
+        migrations.RemoveField(
+            model_name='documentchunk',
+            name='embedding',
+        ),
+        migrations.RenameField(
+            model_name='documentchunk',
+            old_name='embedding_blob',
+            new_name='embedding',
+        ),
+    ]
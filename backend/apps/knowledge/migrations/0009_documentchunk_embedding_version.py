@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 00:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0008_documentchunk_binary_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='embedding_version',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='嵌入模型版本'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-17 00:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0009_documentchunk_embedding_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='embedding_config',
+            field=models.ForeignKey(blank=True, help_text='为空时使用默认嵌入配置；修改后需执行 refit_embeddings 重新编码', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='knowledge_bases', to='knowledge.embeddingconfig', verbose_name='嵌入模型配置'),
+        ),
+    ]
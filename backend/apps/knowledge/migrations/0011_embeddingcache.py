@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-17 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0010_knowledgebase_embedding_config'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True, verbose_name='内容哈希')),
+                ('embedding_version', models.CharField(db_index=True, max_length=32, verbose_name='嵌入模型版本')),
+                ('embedding', models.BinaryField(verbose_name='向量嵌入(float32)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '嵌入缓存',
+                'verbose_name_plural': '嵌入缓存',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-17 00:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0011_embeddingcache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', '待处理'), ('processing', '处理中'), ('completed', '已完成'), ('failed', '失败')], db_index=True, default='pending', max_length=20, verbose_name='任务状态')),
+                ('stage', models.CharField(blank=True, max_length=50, verbose_name='当前阶段')),
+                ('progress', models.IntegerField(default=0, verbose_name='进度(%)')),
+                ('error', models.TextField(blank=True, verbose_name='错误信息')),
+                ('result', models.JSONField(default=dict, verbose_name='处理结果')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name='工作进程')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完成时间')),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to='knowledge.document')),
+                ('knowledge_base', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to='knowledge.knowledgebase')),
+            ],
+            options={
+                'verbose_name': '入库任务',
+                'verbose_name_plural': '入库任务',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0012_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='chunk_overlap',
+            field=models.IntegerField(default=200, verbose_name='分块重叠'),
+        ),
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='chunk_size',
+            field=models.IntegerField(default=1000, verbose_name='分块大小'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0013_knowledgebase_chunk_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='terms',
+            field=models.JSONField(blank=True, default=dict, help_text='入库时计算，用于关键词(BM25)检索', verbose_name='词频'),
+        ),
+    ]
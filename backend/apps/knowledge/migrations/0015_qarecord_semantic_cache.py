@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0014_documentchunk_terms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qarecord',
+            name='embedding_version',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='嵌入模型版本'),
+        ),
+        migrations.AddField(
+            model_name='qarecord',
+            name='kb_version',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='知识库版本'),
+        ),
+        migrations.AddField(
+            model_name='qarecord',
+            name='question_embedding',
+            field=models.BinaryField(blank=True, null=True, verbose_name='问题向量(float32)'),
+        ),
+    ]
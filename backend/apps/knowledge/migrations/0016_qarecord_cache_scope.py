@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0015_qarecord_semantic_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qarecord',
+            name='cache_scope',
+            field=models.CharField(blank=True, default='', help_text='生成回答时的模型配置ID、top_k和阈值，语义缓存只匹配相同范围的回答', max_length=64, verbose_name='缓存范围'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0016_qarecord_cache_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='处理中的任务由工作进程定期刷新，长时间未刷新时重新排队', null=True, verbose_name='心跳时间'),
+        ),
+    ]
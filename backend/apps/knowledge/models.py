@@ -13,6 +13,14 @@ class KnowledgeBase(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
     is_active = models.BooleanField(default=True, verbose_name="是否激活")
     vector_store_path = models.CharField(max_length=500, blank=True, verbose_name="向量库路径")
+    version = models.IntegerField(default=0, verbose_name="索引版本")
+    chunk_size = models.IntegerField(default=1000, verbose_name="分块大小")
+    chunk_overlap = models.IntegerField(default=200, verbose_name="分块重叠")
+    embedding_config = models.ForeignKey(
+        'EmbeddingConfig', on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='knowledge_bases', verbose_name="嵌入模型配置",
+        help_text="为空时使用默认嵌入配置；修改后需执行 refit_embeddings 重新编码"
+    )
     
     class Meta:
         verbose_name = "知识库"
@@ -65,8 +73,10 @@ class DocumentChunk(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='chunks')
     chunk_index = models.IntegerField(verbose_name="分块索引")
     content = models.TextField(verbose_name="分块内容")
-    embedding = models.JSONField(null=True, blank=True, verbose_name="向量嵌入")
+    embedding = models.BinaryField(null=True, blank=True, verbose_name="向量嵌入(float32)")
+    embedding_version = models.CharField(max_length=32, blank=True, default="", verbose_name="嵌入模型版本")
     metadata = models.JSONField(default=dict, verbose_name="分块元数据")
+    terms = models.JSONField(default=dict, blank=True, verbose_name="词频", help_text="入库时计算，用于关键词(BM25)检索")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     
     class Meta:
@@ -78,6 +88,31 @@ class DocumentChunk(models.Model):
         return f"{self.document.title} - 块{self.chunk_index}"
 
 
+class IngestionJob(models.Model):
+    """文档入库任务，由 process_ingestion_jobs 命令的工作进程领取执行"""
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    knowledge_base = models.ForeignKey(KnowledgeBase, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    status = models.CharField(max_length=20, choices=Document.STATUS_CHOICES, default='pending', db_index=True, verbose_name="任务状态")
+    stage = models.CharField(max_length=50, blank=True, verbose_name="当前阶段")
+    progress = models.IntegerField(default=0, verbose_name="进度(%)")
+    error = models.TextField(blank=True, verbose_name="错误信息")
+    result = models.JSONField(default=dict, verbose_name="处理结果")
+    worker = models.CharField(max_length=100, blank=True, verbose_name="工作进程")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="心跳时间",
+                                        help_text="处理中的任务由工作进程定期刷新，长时间未刷新时重新排队")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="完成时间")
+    
+    class Meta:
+        verbose_name = "入库任务"
+        verbose_name_plural = "入库任务"
+        ordering = ['id']
+        
+    def __str__(self):
+        return f"{self.document.title} - {self.get_status_display()}"
+
+
 class QASession(models.Model):
     """问答会话"""
     knowledge_base = models.ForeignKey(KnowledgeBase, on_delete=models.CASCADE, related_name='qa_sessions')
@@ -107,6 +142,12 @@ class QARecord(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     feedback_score = models.IntegerField(null=True, blank=True, verbose_name="反馈评分(1-5)")
     feedback_comment = models.TextField(blank=True, verbose_name="反馈评论")
+    # 语义缓存：回答生成时的知识库版本和问题向量，同一版本下相似的问题复用该回答
+    kb_version = models.IntegerField(null=True, blank=True, db_index=True, verbose_name="知识库版本")
+    question_embedding = models.BinaryField(null=True, blank=True, verbose_name="问题向量(float32)")
+    embedding_version = models.CharField(max_length=32, blank=True, default="", verbose_name="嵌入模型版本")
+    cache_scope = models.CharField(max_length=64, blank=True, default="", verbose_name="缓存范围",
+                                   help_text="生成回答时的模型配置ID、top_k和阈值，语义缓存只匹配相同范围的回答")
     
     class Meta:
         verbose_name = "问答记录"
@@ -168,3 +209,18 @@ class EmbeddingConfig(models.Model):
         
     def __str__(self):
         return f"{self.name} (dim: {self.dimension})"
+
+
+class EmbeddingCache(models.Model):
+    """按内容哈希缓存的块向量，相同文本在同一嵌入模型版本下只编码一次"""
+    content_hash = models.CharField(max_length=64, unique=True, verbose_name="内容哈希")
+    embedding_version = models.CharField(max_length=32, db_index=True, verbose_name="嵌入模型版本")
+    embedding = models.BinaryField(verbose_name="向量嵌入(float32)")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    
+    class Meta:
+        verbose_name = "嵌入缓存"
+        verbose_name_plural = "嵌入缓存"
+        
+    def __str__(self):
+        return f"{self.embedding_version}:{self.content_hash[:12]}"
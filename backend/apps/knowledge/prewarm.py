@@ -0,0 +1,114 @@
+"""
+工作进程启动时预热知识库索引
+
+每个工作进程的内存索引在该进程第一次回答某个知识库的问题时才加载（映射向量文件、读取块元数据、
+恢复嵌入模型），首个问题要承担全部加载时间。开启 PREWARM_ON_STARTUP 后，工作进程启动时
+（gunicorn 的 post_fork 钩子）在后台线程中按最近 PREWARM_DAYS 天的问答记录数选出最活跃的
+PREWARM_TOP_N 个知识库并提前同步，不阻塞工作进程开始接收请求。
+进度通过 /knowledge/health 的 prewarm 字段查看，ready 为 true 表示预热已结束。
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# 预热状态：disabled（未开启）、pending（等待应用加载）、running、ready、failed
+_status: Dict = {'state': 'disabled', 'pid': None}
+
+
+def status() -> Dict:
+    """当前进程的预热状态"""
+    with _lock:
+        if _status.get('pid') not in (None, os.getpid()):
+            # fork 前的状态不属于当前进程
+            return {'state': 'disabled', 'ready': True}
+        result = {key: value for key, value in _status.items() if key != 'pid'}
+    # 未开启预热时视为就绪
+    result['ready'] = result['state'] in ('disabled', 'ready', 'failed')
+    return result
+
+
+def _update(**changes):
+    with _lock:
+        _status.update(changes)
+
+
+def start_prewarm(wait_for_apps: float = 60.0) -> Optional[threading.Thread]:
+    """在后台线程中预热当前进程的知识库索引，未开启或已启动时返回None
+
+    gunicorn 未预加载应用时 post_fork 早于 Django 初始化，线程先等待应用加载完成（最多 wait_for_apps 秒）。
+    """
+    with _lock:
+        if _status.get('pid') == os.getpid() and _status['state'] != 'disabled':
+            return None
+        _status.clear()
+        _status.update({'state': 'pending', 'pid': os.getpid()})
+
+    thread = threading.Thread(target=_run, args=(wait_for_apps,), name='kb-prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+def _run(wait_for_apps: float):
+    from django.apps import apps
+
+    deadline = time.monotonic() + wait_for_apps
+    while not apps.ready:
+        if time.monotonic() > deadline:
+            _update(state='failed', error='Django应用未加载')
+            return
+        time.sleep(0.1)
+
+    from django.db import connection
+    from apps.knowledge.rag_system_simple import get_kb_setting
+
+    if not get_kb_setting('PREWARM_ON_STARTUP', False):
+        _update(state='disabled')
+        return
+
+    try:
+        prewarm_knowledge_bases(get_kb_setting('PREWARM_TOP_N', 5), get_kb_setting('PREWARM_DAYS', 7))
+    except Exception as e:
+        logger.error(f"预热知识库索引失败: {e}")
+        _update(state='failed', error=str(e), finished_at=datetime.now().isoformat())
+    finally:
+        connection.close()
+
+
+def most_active_knowledge_bases(limit: int, days: int) -> List[int]:
+    """最近 days 天问答记录最多的 limit 个知识库ID"""
+    from django.db.models import Count
+    from django.utils import timezone
+    from apps.knowledge.models import QARecord
+
+    return list(QARecord.objects.filter(
+        created_at__gte=timezone.now() - timedelta(days=days)
+    ).values('session__knowledge_base_id').annotate(
+        count=Count('id')
+    ).order_by('-count').values_list('session__knowledge_base_id', flat=True)[:limit])
+
+
+def prewarm_knowledge_bases(limit: int = 5, days: int = 7) -> Dict:
+    """同步最活跃的知识库的内存索引（同步方法），返回预热状态"""
+    from apps.knowledge.views import get_rag_system
+
+    start_time = time.time()
+    kb_ids = most_active_knowledge_bases(limit, days) if limit > 0 else []
+    _update(state='running', knowledge_bases=kb_ids, loaded={}, started_at=datetime.now().isoformat())
+    logger.info(f"开始预热知识库索引: {kb_ids}")
+
+    rag_system = get_rag_system()
+    loaded = {}
+    for kb_id in kb_ids:
+        loaded[kb_id] = rag_system.sync_knowledge_base(kb_id)
+        _update(loaded=dict(loaded))
+
+    elapsed = time.time() - start_time
+    _update(state='ready', finished_at=datetime.now().isoformat(), elapsed=round(elapsed, 3))
+    logger.info(f"知识库索引预热完成: {loaded}，耗时 {elapsed:.1f} 秒")
+    return status()
@@ -2,11 +2,17 @@
 简化的RAG系统实现，避免sklearn依赖问题
 """
 import os
+import bisect
+import codecs
+import time
 import json
 import logging
 import hashlib
 import asyncio
-from typing import List, Dict, Optional, Tuple, Any
+import itertools
+import random
+import threading
+from typing import List, Dict, Optional, Tuple, Any, Callable, Iterable, Iterator, AsyncIterator
 from datetime import datetime
 import uuid
 
@@ -42,50 +48,93 @@ except ImportError:
 
 import re
 
+from .ann_index import IVFIndex
+from .answer_cache import AnswerCache, SemanticAnswerCache
+from .chunk_store import MISSING_DOCUMENT, ChunkTable
+from .context_builder import build_context, estimate_tokens
+from .db_executor import run_db, run_db_sync
+from .keyword_index import KeywordIndex, term_counts
+
 logger = logging.getLogger(__name__)
 
 
+def get_kb_setting(name: str, default=None):
+    """读取 settings.KNOWLEDGE_BASE 中的配置项，Django未配置时返回默认值"""
+    try:
+        from django.conf import settings
+        if not settings.configured:
+            return default
+        return getattr(settings, 'KNOWLEDGE_BASE', {}).get(name, default)
+    except ImportError:
+        return default
+
+
 class DocumentProcessor:
-    """文档处理器"""
+    """文档处理器
+    
+    iter_file() 按页/段落/文本块逐段产出文本，大文件不会整体读入内存；
+    process_file() 返回拼接后的完整文本。
+    """
+    
+    # TXT文件每次读取的字符数
+    TEXT_BLOCK_SIZE = 1024 * 1024
     
     @staticmethod
     def process_file(file_path: str) -> Tuple[str, Dict]:
         """处理单个文件"""
+        segments, metadata = DocumentProcessor.iter_file(file_path)
+        text = ''.join(segments)
+        metadata['size'] = len(text)
+        return text, metadata
+    
+    @staticmethod
+    def iter_file(file_path: str) -> Tuple[Iterator[str], Dict]:
+        """逐段读取文件，返回 (文本段迭代器, 元数据)
+        
+        PDF按页、DOCX按段落、TXT按固定大小的文本块产出；Markdown/HTML需要整体解析，一次产出全文。
+        """
         file_ext = os.path.splitext(file_path)[1].lower()
         
         if file_ext == '.txt':
-            return DocumentProcessor._process_txt(file_path)
+            return DocumentProcessor._iter_txt(file_path), {'source': file_path, 'type': 'txt'}
         elif file_ext == '.md':
-            return DocumentProcessor._process_markdown(file_path)
+            return iter([DocumentProcessor._process_markdown(file_path)]), {'source': file_path, 'type': 'markdown'}
         elif file_ext == '.pdf' and HAS_PDF:
-            return DocumentProcessor._process_pdf(file_path)
+            f = open(file_path, 'rb')
+            # 传入文件对象而不是路径，PyPDF2 才不会把整个文件读进内存
+            reader = PyPDF2.PdfReader(f)
+            return DocumentProcessor._iter_pdf(f, reader), {'source': file_path, 'type': 'pdf', 'pages': len(reader.pages)}
         elif file_ext in ['.docx', '.doc'] and HAS_DOCX:
-            return DocumentProcessor._process_docx(file_path)
+            doc = docx.Document(file_path)
+            return DocumentProcessor._iter_docx(doc), {'source': file_path, 'type': 'docx', 'paragraphs': len(doc.paragraphs)}
         elif file_ext == '.html':
-            return DocumentProcessor._process_html(file_path)
+            return iter([DocumentProcessor._process_html(file_path)]), {'source': file_path, 'type': 'html'}
         else:
             raise ValueError(f"不支持的文件格式: {file_ext}")
     
     @staticmethod
-    def _process_txt(file_path: str) -> Tuple[str, Dict]:
-        """处理TXT文件"""
+    def _detect_encoding(file_path: str) -> str:
+        """逐块试解码判断TXT文件编码（utf-8，失败则按gbk处理）"""
+        decoder = codecs.getincrementaldecoder('utf-8')()
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(DocumentProcessor.TEXT_BLOCK_SIZE), b''):
+                    decoder.decode(block)
+                decoder.decode(b'', final=True)
+            return 'utf-8'
         except UnicodeDecodeError:
-            with open(file_path, 'r', encoding='gbk') as f:
-                content = f.read()
-        
-        metadata = {
-            'source': file_path,
-            'type': 'txt',
-            'size': len(content)
-        }
-        
-        return content, metadata
+            return 'gbk'
+    
+    @staticmethod
+    def _iter_txt(file_path: str) -> Iterator[str]:
+        """按固定大小的文本块读取TXT文件"""
+        encoding = DocumentProcessor._detect_encoding(file_path)
+        with open(file_path, 'r', encoding=encoding) as f:
+            for block in iter(lambda: f.read(DocumentProcessor.TEXT_BLOCK_SIZE), ''):
+                yield block
     
     @staticmethod
-    def _process_markdown(file_path: str) -> Tuple[str, Dict]:
+    def _process_markdown(file_path: str) -> str:
         """处理Markdown文件"""
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
@@ -94,311 +143,1025 @@ class DocumentProcessor:
         if HAS_MARKDOWN:
             html = markdown(content)
             soup = BeautifulSoup(html, 'html.parser')
-            text = soup.get_text()
-        else:
-            # 简单的markdown语法移除
-            text = re.sub(r'[#*`_\[\]()]', '', content)
-        
-        metadata = {
-            'source': file_path,
-            'type': 'markdown',
-            'size': len(text)
-        }
-        
-        return text, metadata
+            return soup.get_text()
+        # 简单的markdown语法移除
+        return re.sub(r'[#*`_\[\]()]', '', content)
     
     @staticmethod
-    def _process_pdf(file_path: str) -> Tuple[str, Dict]:
-        """处理PDF文件"""
-        text = ""
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
+    def _iter_pdf(f, reader) -> Iterator[str]:
+        """逐页提取PDF文本"""
+        try:
             for page in reader.pages:
-                text += page.extract_text() + "\n"
-        
-        metadata = {
-            'source': file_path,
-            'type': 'pdf',
-            'pages': len(reader.pages),
-            'size': len(text)
-        }
-        
-        return text, metadata
+                yield page.extract_text() + "\n"
+        finally:
+            f.close()
     
     @staticmethod
-    def _process_docx(file_path: str) -> Tuple[str, Dict]:
-        """处理DOCX文件"""
-        doc = docx.Document(file_path)
-        text = ""
+    def _iter_docx(doc) -> Iterator[str]:
+        """逐段落提取DOCX文本"""
         for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        
-        metadata = {
-            'source': file_path,
-            'type': 'docx',
-            'paragraphs': len(doc.paragraphs),
-            'size': len(text)
-        }
-        
-        return text, metadata
+            yield paragraph.text + "\n"
     
     @staticmethod
-    def _process_html(file_path: str) -> Tuple[str, Dict]:
+    def _process_html(file_path: str) -> str:
         """处理HTML文件"""
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
         
         if HAS_MARKDOWN:
             soup = BeautifulSoup(content, 'html.parser')
-            text = soup.get_text()
-        else:
-            # 简单的HTML标签移除
-            text = re.sub(r'<[^>]+>', '', content)
-        
-        metadata = {
-            'source': file_path,
-            'type': 'html',
-            'size': len(text)
-        }
-        
-        return text, metadata
+            return soup.get_text()
+        # 简单的HTML标签移除
+        return re.sub(r'<[^>]+>', '', content)
 
 
 class TextSplitter:
-    """文本分块器"""
+    """按句子边界分块的文本分块器
+    
+    句子边界为中英文句末标点和换行，块优先在Markdown标题前结束，其次在句子边界结束，
+    找不到超过半个块长的边界时才硬切；重叠部分从句子开头开始。
+    只在每个块的结束位置附近向前查找边界（通常只扫描最后一两句），不扫描和保存全文的边界列表，
+    用下标运算决定每个块的起止，只在输出块时切片一次。
+    """
+    
+    # 句子边界：句末标点或换行（连同其后的标点、换行和右引号/括号），英文句点只在后跟空白时算；
+    # 匹配的结束位置即下一句的起点。以单个字符类开头，正则引擎可以快速跳过普通字符
+    SENTENCE_BOUNDARY = re.compile(r'[。！？；…!?;.\n](?<!\.(?!\s))[。！？；…!?;\n”’」』）)]*')
+    # 可能属于同一个边界匹配的字符，从这些字符之后开始匹配与从文本开头逐个匹配的结果相同
+    BOUNDARY_CHARS = frozenset('。！？；…!?;.\n”’」』）)')
+    # Markdown标题行（含行尾换行）
+    HEADING_LINE = re.compile(r'^#{1,6}[ \t][^\n]*\n*', re.MULTILINE)
+    # 匹配到范围内最后一个句末标点为止
+    LAST_BOUNDARY_CHAR = re.compile(r'.*[。！？；…!?;.\n]', re.DOTALL)
+    # 匹配到范围内最后一个句子边界为止（范围末尾的边界可能被截断，需要另行确认）
+    LAST_BOUNDARY = re.compile(r'.*' + SENTENCE_BOUNDARY.pattern, re.DOTALL)
+    # 可以接在边界匹配末尾的字符
+    TRAILING_CHARS = frozenset('。！？；…!?;\n”’」』）)')
+    # 先在块末尾这么多字符内查找最后一个句子边界
+    TAIL_WINDOW = 128
+    LOOKAHEAD = 8
     
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
         self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+        self.chunk_overlap = min(chunk_overlap, chunk_size // 2)
     
     def split_text(self, text: str, metadata: Dict = None) -> List[Dict]:
         """分割文本为块"""
-        # 简单的文本分割
-        chunks = []
-        start = 0
+        return list(self.split_stream([text], metadata))
+    
+    def split_stream(self, segments: Iterable[str], metadata: Dict = None) -> Iterator[Dict]:
+        """增量分块：逐段读入文本，缓冲区只保留尚未切出的尾部
         
-        while start < len(text):
-            end = start + self.chunk_size
-            chunk = text[start:end]
-            
-            # 尝试在句号处分割
-            if end < len(text):
-                last_period = chunk.rfind('。')
-                if last_period > self.chunk_size // 2:
-                    chunk = chunk[:last_period + 1]
-                    end = start + last_period + 1
-            
-            chunk_metadata = {
-                'chunk_index': len(chunks),
-                'chunk_size': len(chunk),
-                'chunk_word_count': len(chunk.split()),
-                **(metadata or {})
-            }
-            
-            chunks.append({
-                'content': chunk.strip(),
-                'metadata': chunk_metadata
-            })
-            
-            start = end - self.chunk_overlap
+        缓冲区长度不超过一个块加一段；结果与对拼接后的全文调用 split_text 一致。
+        """
+        buffer = ''
+        chunk_index = 0
+        line_start = True  # 缓冲区开头是否是一行的开头
+        # 最后追加的None表示输入结束，缓冲区中剩余的文本全部切出
+        for segment in itertools.chain(segments, (None,)):
+            if segment is None:
+                reserve = 0
+            else:
+                buffer += segment
+                # 缓冲区中剩余文本超过一个块（加上标题识别需要的几个字符）时，块的结束位置才能确定
+                reserve = self.chunk_size + self.LOOKAHEAD
+            start = 0
+            while len(buffer) - start > reserve:
+                end, next_start = self._next_span(buffer, start, line_start)
+                chunk = buffer[start:end]
+                content = chunk.strip()
+                if content:
+                    # 不再统计按空白切分的词数（chunk_word_count）：没有地方使用，且 split() 占分块耗时的一半
+                    chunk_metadata = {'chunk_index': chunk_index, 'chunk_size': len(chunk)}
+                    if metadata:
+                        chunk_metadata.update(metadata)
+                    yield {'content': content, 'metadata': chunk_metadata}
+                    chunk_index += 1
+                start = next_start
+            if start > 0:
+                line_start = buffer[start - 1] == '\n'
+                buffer = buffer[start:]
+    
+    def _next_span(self, text: str, start: int, line_start: bool) -> Tuple[int, int]:
+        """返回从 start 开始的块的结束位置和下一个块的起点"""
+        limit = start + self.chunk_size
+        if limit >= len(text):
+            return len(text), len(text)
         
-        return chunks
+        # 在 (start + 半个块, start + 块长] 内找结束位置：优先最后一个标题之前，其次最后一个句子边界
+        lower = start + self.chunk_size // 2 + 1
+        end = self._last_heading(text, lower, limit)
+        if end is None:
+            end = self._last_boundary(text, lower, limit, line_start)
+            if end is None:
+                end = limit
+        
+        if self.chunk_overlap <= 0:
+            return end, end
+        # 重叠从 [end - overlap, end) 内的第一个句子起点开始
+        overlap_start = end - self.chunk_overlap
+        next_start = self._first_boundary(text, overlap_start, end, line_start)
+        if next_start is None:
+            next_start = overlap_start
+        return end, max(next_start, start + 1)
+    
+    def _run_start(self, text: str, position: int) -> int:
+        """position 所在边界字符串的起点：从这里开始匹配得到的边界与从文本开头匹配相同"""
+        boundary_chars = self.BOUNDARY_CHARS
+        while position > 0 and text[position - 1] in boundary_chars:
+            position -= 1
+        return position
+    
+    def _last_heading(self, text: str, lower: int, upper: int) -> Optional[int]:
+        """落在 (lower, upper] 内的最后一个标题起点"""
+        i = text.rfind('\n#', lower, upper + 1)
+        while i >= 0:
+            if self.HEADING_LINE.match(text, i + 1):
+                return i + 1
+            i = text.rfind('\n#', lower, i + 1)
+        return None
+    
+    def _last_boundary(self, text: str, lower: int, upper: int, line_start: bool) -> Optional[int]:
+        """落在 (lower, upper] 内的最后一个句子边界
+        
+        通常块末尾 TAIL_WINDOW 个字符内就有句子边界，一次匹配即可确定；
+        其余情况（窗口内没有边界、边界恰好被 upper 截断等）从 upper 开始逐句向前查找。
+        """
+        floor = self._run_start(text, lower)
+        if upper - self.TAIL_WINDOW > floor and text[upper - 1] != '.':
+            match = self.LAST_BOUNDARY.match(text, self._run_start(text, upper - self.TAIL_WINDOW), upper)
+            if match is not None:
+                boundary = match.end()
+                if boundary > lower and (boundary < upper or upper == len(text) or text[upper] not in self.TRAILING_CHARS) and not (
+                    text[boundary - 1] == '\n' and self._is_heading_end(text, boundary, line_start)
+                ):
+                    return boundary
+        
+        search = self.SENTENCE_BOUNDARY.search
+        stop = upper
+        while stop > floor:
+            # stop 之前最后一个句末标点 last，从它所在边界字符串的起点开始匹配 [begin, stop) 内开始的边界
+            match = self.LAST_BOUNDARY_CHAR.match(text, floor, stop)
+            if match is None:
+                return None
+            last = match.end() - 1
+            begin = self._run_start(text, last)
+            found = None
+            match = search(text, begin)
+            while match is not None and match.start() < stop:
+                boundary = match.end()
+                if lower < boundary <= upper and not (
+                    (text[boundary - 1] == '\n' or boundary == len(text))
+                    and self._is_heading_end(text, boundary, line_start)
+                ):
+                    found = boundary
+                if boundary > last:
+                    break
+                match = search(text, boundary)
+            if found is not None:
+                return found
+            stop = begin
+        return None
+    
+    def _first_boundary(self, text: str, lower: int, upper: int, line_start: bool) -> Optional[int]:
+        """落在 [lower, upper) 内的第一个句子边界"""
+        search = self.SENTENCE_BOUNDARY.search
+        match = search(text, self._run_start(text, lower))
+        while match is not None:
+            boundary = match.end()
+            if boundary >= upper:
+                return None
+            if boundary >= lower and not (
+                (text[boundary - 1] == '\n' or boundary == len(text))
+                and self._is_heading_end(text, boundary, line_start)
+            ):
+                return boundary
+            match = search(text, boundary)
+        return None
+    
+    def _is_heading_end(self, text: str, position: int, line_start: bool) -> bool:
+        """以换行结束（或位于文本末尾）的 position 是否为标题行（含其后空行）的结束位置，标题行末尾不作为块的结束位置"""
+        if position < len(text) and text[position] == '\n':
+            return False
+        line_end = position
+        while line_end > 0 and text[line_end - 1] == '\n':
+            line_end -= 1
+        line_begin = text.rfind('\n', 0, line_end) + 1
+        if line_begin == 0 and not line_start:
+            return False
+        match = self.HEADING_LINE.match(text, line_begin)
+        return match is not None and match.end() == position
+    
 
 
 class SimpleEmbedding:
-    """简单的嵌入模型实现"""
+    """简单的嵌入模型实现
+    
+    生命周期：fit() 在知识库语料上建立词汇表，get_state()/set_state() 在进程间持久化和恢复。
+    version 由词汇表内容决定，只有同一 version 编码的向量才互相可比。
+    """
+    
+    provider = 'simple'
     
     def __init__(self, vector_size=300):
         self.vector_size = vector_size
-        self.is_fitted = True  # 简化版本，不需要训练
+        self.is_fitted = False
         # 预定义词汇表和哈希函数
         self.vocab = {}
         self.vocab_size = 1000  # 限制词汇表大小
+        self.version = ''
+        self._lookup = None
     
     def _get_vocab(self, texts):
-        """建立词汇表"""
-        vocab = set()
+        """建立词汇表：按字符频次降序、同频按字符排序，结果与文本顺序和进程无关"""
+        from collections import Counter
+        char_counts = Counter()
         for text in texts:
             # 简单的中文分词（按字符）
-            chars = list(text)
-            vocab.update(chars)
+            char_counts.update(text)
         
         # 限制词汇表大小，选择最常见的字符
-        if len(vocab) > self.vocab_size:
-            from collections import Counter
-            all_chars = []
-            for text in texts:
-                all_chars.extend(list(text))
-            char_counts = Counter(all_chars)
-            vocab = [char for char, count in char_counts.most_common(self.vocab_size)]
-        else:
-            vocab = list(vocab)
-        
-        return vocab
+        ranked = sorted(char_counts.items(), key=lambda item: (-item[1], item[0]))
+        return [char for char, count in ranked[:self.vocab_size]]
+    
+    def fit(self, texts: List[str]) -> 'SimpleEmbedding':
+        """在语料上建立词汇表"""
+        vocab_list = self._get_vocab(texts)
+        self.vocab = {char: i for i, char in enumerate(vocab_list)}
+        self.version = self._compute_version()
+        self.is_fitted = True
+        self._lookup = None
+        return self
+    
+    def _compute_version(self) -> str:
+        """词汇表和向量维度的摘要"""
+        payload = json.dumps([self.vector_size, sorted(self.vocab, key=self.vocab.get)], ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
     
-    def encode(self, texts: List[str]) -> np.ndarray:
-        """编码文本为向量"""
+    def encode(self, texts: List[str], batch_size: int = 2048) -> np.ndarray:
+        """编码文本为向量（按批向量化计算，返回按行L2归一化的float32矩阵）"""
         if not texts:
             return np.array([])
         
-        # 如果是第一次编码，建立词汇表
-        if not self.vocab:
-            vocab_list = self._get_vocab(texts)
-            self.vocab = {char: i for i, char in enumerate(vocab_list)}
+        # 未拟合时在输入上建立词汇表（VectorStore会先显式拟合或恢复状态）
+        if not self.is_fitted:
+            self.fit(texts)
         
-        vectors = []
-        for text in texts:
-            # 创建固定大小的向量
-            vector = np.zeros(self.vector_size)
-            
-            # 字符级别的简单编码
-            chars = list(text)
-            for i, char in enumerate(chars):
-                if char in self.vocab:
-                    idx = self.vocab[char]
-                    # 使用哈希函数映射到固定大小的向量
-                    pos = idx % self.vector_size
-                    vector[pos] += 1
-            
-            # 归一化
-            norm = np.linalg.norm(vector)
-            if norm > 0:
-                vector = vector / norm
-            
-            vectors.append(vector)
+        lookup = self._get_lookup()
+        vectors = np.empty((len(texts), self.vector_size), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            vectors[start:start + len(batch)] = self._encode_batch(batch, lookup)
+        return vectors
+    
+    def _get_lookup(self) -> np.ndarray:
+        """码点 -> 向量位置的查找表，不在词汇表中的字符为-1"""
+        if self._lookup is None:
+            codes = [ord(char) for char in self.vocab]
+            lookup = np.full(max(codes, default=0) + 1, -1, dtype=np.int64)
+            for char, idx in self.vocab.items():
+                # 使用哈希函数映射到固定大小的向量
+                lookup[ord(char)] = idx % self.vector_size
+            self._lookup = lookup
+        return self._lookup
+    
+    def _encode_batch(self, texts: List[str], lookup: np.ndarray) -> np.ndarray:
+        """一批文本拼接后整体转为码点数组，用bincount一次累加所有字符计数"""
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        codes = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        
+        positions = np.full(len(codes), -1, dtype=np.int64)
+        in_table = codes < len(lookup)
+        positions[in_table] = lookup[codes[in_table]]
         
-        return np.array(vectors, dtype=float)
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+        known = positions >= 0
+        flat = rows[known] * self.vector_size + positions[known]
+        counts = np.bincount(flat, minlength=len(texts) * self.vector_size)
+        vectors = counts.reshape(len(texts), self.vector_size).astype(np.float32)
+        
+        # 归一化
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    def get_state(self) -> Dict:
+        """导出词汇表状态，与向量文件一起持久化"""
+        return {
+            'provider': self.provider,
+            'vector_size': self.vector_size,
+            'vocab': sorted(self.vocab, key=self.vocab.get),
+            'version': self.version
+        }
+    
+    def set_state(self, state: Dict):
+        """恢复词汇表状态，使查询向量与持久化的向量可比"""
+        self.vector_size = state.get('vector_size', self.vector_size)
+        self.vocab = {char: i for i, char in enumerate(state.get('vocab', []))}
+        self.version = state.get('version') or self._compute_version()
+        self.is_fitted = bool(self.vocab)
+        self._lookup = None
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """转换为连续的float32矩阵并按行L2归一化（零向量保持为零）"""
+    matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def content_hash(embedding_version: str, text: str) -> str:
+    """嵌入缓存键：嵌入模型版本 + 文本内容的sha256"""
+    return hashlib.sha256(f"{embedding_version}\n{text}".encode('utf-8')).hexdigest()
+
+
+def encode_with_cache(model, texts: List[str], stats: Optional[Dict] = None, batch_size: int = 500) -> np.ndarray:
+    """按内容哈希查询嵌入缓存，只编码未命中的文本，新向量写回缓存
+
+    model 必须已拟合；返回与 texts 一一对应的归一化向量，stats 中累加 hits/misses。
+    """
+    if not texts:
+        return np.array([])
+    if not get_kb_setting('EMBEDDING_CACHE', True):
+        return normalize_rows(model.encode(texts))
+
+    from apps.knowledge.models import EmbeddingCache
+
+    keys = [content_hash(model.version, text) for text in texts]
+    cached = {}
+    try:
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), batch_size):
+            cached.update(EmbeddingCache.objects.filter(
+                content_hash__in=unique_keys[i:i + batch_size]
+            ).values_list('content_hash', 'embedding'))
+    except Exception as e:
+        logger.warning(f"读取嵌入缓存失败: {e}")
+        cached = {}
+
+    vectors = [bytes_to_vector(cached[key]) if key in cached else None for key in keys]
+    missing = {}
+    for i, key in enumerate(keys):
+        if vectors[i] is None:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        missing_keys = list(missing)
+        encoded = normalize_rows(model.encode([texts[missing[key][0]] for key in missing_keys]))
+        for key, vector in zip(missing_keys, encoded):
+            for i in missing[key]:
+                vectors[i] = vector
+        try:
+            EmbeddingCache.objects.bulk_create([
+                EmbeddingCache(content_hash=key, embedding_version=model.version, embedding=vector_to_bytes(vector))
+                for key, vector in zip(missing_keys, encoded)
+            ], batch_size=batch_size, ignore_conflicts=True)
+        except Exception as e:
+            logger.warning(f"写入嵌入缓存失败: {e}")
+
+    if stats is not None:
+        miss_count = sum(len(indexes) for indexes in missing.values())
+        stats['hits'] = stats.get('hits', 0) + len(texts) - miss_count
+        stats['misses'] = stats.get('misses', 0) + miss_count
+    return normalize_rows(np.vstack(vectors))
+
+
+def state_provider(state: Dict) -> str:
+    """嵌入模型状态所属的模型类型，旧版本的状态文件没有该字段，均为 SimpleEmbedding"""
+    return state.get('provider', SimpleEmbedding.provider)
+
+
+def vector_to_bytes(vector) -> bytes:
+    """向量序列化为float32二进制（300维约1.2KB，JSON文本约6KB）"""
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def bytes_to_vector(data) -> np.ndarray:
+    """float32二进制反序列化为向量"""
+    return np.frombuffer(bytes(data), dtype=np.float32)
+
+
+def align_rows(keys: np.ndarray, target: np.ndarray) -> Optional[np.ndarray]:
+    """返回使 keys[order] 与 target 逐行相同的行号数组，两者的行集合不同时返回None
+
+    keys/target 为每行的 (document_id, chunk_index)。
+    """
+    if keys.shape != target.shape:
+        return None
+    if np.array_equal(keys, target):
+        return np.arange(len(keys), dtype=np.int64)
+    own = np.lexsort((keys[:, 1], keys[:, 0]))
+    other = np.lexsort((target[:, 1], target[:, 0]))
+    if not np.array_equal(keys[own], target[other]):
+        return None
+    order = np.empty(len(keys), dtype=np.int64)
+    order[other] = own
+    return order
+
+
+class IndexSnapshot:
+    """某一时刻的内存索引：块元数据表、向量矩阵、关键词索引和IVF索引按行对齐
+
+    发布后不再修改，更新时构造新的快照整体替换。检索开始时取一次快照，
+    之后即使索引被更新，本次检索看到的各部分仍然一致。
+    """
+
+    __slots__ = ('table', 'vectors', 'keyword_index', 'ann_index')
+
+    def __init__(self, table: Optional[ChunkTable] = None, vectors: Optional[np.ndarray] = None,
+                 keyword_index: Optional[KeywordIndex] = None, ann_index: Optional[IVFIndex] = None):
+        self.table = table if table is not None else ChunkTable()
+        self.vectors = vectors
+        self.keyword_index = keyword_index
+        self.ann_index = ann_index
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def replace(self, **changes) -> 'IndexSnapshot':
+        """返回替换了部分字段的新快照"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return IndexSnapshot(**fields)
+
+    def appended(self, table: ChunkTable, new_vectors: np.ndarray, terms_list: Optional[List] = None,
+                 contents: Optional[List[str]] = None) -> 'IndexSnapshot':
+        """追加已归一化的新向量和块的词频，返回新快照
+
+        terms_list 中缺少词频的块按 contents 中对应的内容重新分词。
+        """
+        keyword_index = self.keyword_index
+        if keyword_index is not None:
+            keyword_index = keyword_index.copy()
+            terms_list = terms_list or [None] * len(table)
+            keyword_index.add(
+                terms if terms else term_counts(contents[i] if contents else '') for i, terms in enumerate(terms_list)
+            )
+            # 发布前合并倒排表，检索时不再修改索引
+            keyword_index.compact()
+
+        ann_index = self.ann_index
+        if ann_index is not None:
+            ann_index = ann_index.copy()
+            ann_index.add(new_vectors)
+
+        if self.vectors is None or len(self.vectors) == 0:
+            vectors = new_vectors
+        else:
+            vectors = np.concatenate([self.vectors, new_vectors])
+        return IndexSnapshot(self.table.concat(table), vectors, keyword_index, ann_index)
+
+    def kept(self, keep: np.ndarray) -> 'IndexSnapshot':
+        """只保留给定的行（升序），返回新快照"""
+        keyword_index = self.keyword_index
+        if keyword_index is not None:
+            keyword_index = keyword_index.copy()
+            keyword_index.keep(keep)
+        ann_index = self.ann_index
+        if ann_index is not None:
+            ann_index = ann_index.copy()
+            ann_index.keep(keep)
+        vectors = self.vectors
+        if vectors is not None and len(vectors) > 0:
+            vectors = np.ascontiguousarray(vectors[keep]) if len(keep) else None
+        return IndexSnapshot(self.table.take(keep), vectors, keyword_index, ann_index)
 
 
 class VectorStore:
-    """向量存储器"""
+    """向量存储器
+    
+    vectors 始终是按行归一化的连续float32矩阵，检索时一次矩阵乘法即可得到全部余弦相似度。
+    索引数据保存在不可变的 IndexSnapshot 中，每次修改都发布新快照（写时复制），
+    并发的检索不加锁，也不会看到只更新了一半的索引。
+    块内容不常驻内存，检索结果按行从数据库读取（见 ChunkTable）。
+    """
     
-    def __init__(self, embedding_model=None):
+    EMBEDDING_STATE_NAME = 'embedding.json'
+    
+    def __init__(self, embedding_model=None, state_dir: Optional[str] = None):
         self.embedding_model = embedding_model or SimpleEmbedding()
-        self.chunks = []
-        self.vectors = None
-        self.metadata = []
+        # BM25倒排索引与向量矩阵按行对齐，关闭混合检索时为None；
+        # 大规模知识库的IVF近似检索索引在写入向量文件时按需训练
+        self._snapshot = IndexSnapshot(
+            keyword_index=KeywordIndex() if get_kb_setting('HYBRID_SEARCH', True) else None
+        )
+        # 嵌入缓存命中统计
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        # 知识库的向量目录，嵌入模型状态保存在其中
+        self.state_dir = state_dir
+        if state_dir and not self.load_embedding_state() and self.embedding_model.is_fitted:
+            # 无需拟合的模型（如远程API）直接记录其状态，供其他进程判断嵌入版本是否变化
+            try:
+                self.write_embedding_state(state_dir, self.embedding_model.get_state())
+            except OSError as e:
+                logger.warning(f"保存嵌入模型状态失败: {e}")
+
+    @property
+    def snapshot(self) -> IndexSnapshot:
+        """当前发布的索引快照"""
+        return self._snapshot
+
+    @property
+    def table(self) -> ChunkTable:
+        return self._snapshot.table
+
+    @property
+    def vectors(self) -> Optional[np.ndarray]:
+        return self._snapshot.vectors
+
+    @property
+    def keyword_index(self) -> Optional[KeywordIndex]:
+        return self._snapshot.keyword_index
+
+    @property
+    def ann_index(self) -> Optional[IVFIndex]:
+        return self._snapshot.ann_index
+
+    def _publish(self, snapshot: IndexSnapshot):
+        """原子替换当前快照（单次属性赋值）"""
+        self._snapshot = snapshot
+
+    def fork(self) -> 'VectorStore':
+        """复制出共享当前快照和嵌入模型的暂存副本，在副本上更新后再整体替换原存储"""
+        clone = VectorStore.__new__(VectorStore)
+        clone.__dict__.update(self.__dict__)
+        clone.cache_stats = dict(self.cache_stats)
+        return clone
+    
+    def load_embedding_state(self) -> bool:
+        """从向量目录恢复嵌入模型状态（状态文件属于其他类型的嵌入模型时忽略）"""
+        state = self.read_embedding_state(self.state_dir) if self.state_dir else None
+        if state and state_provider(state) == self.embedding_model.provider:
+            self.embedding_model.set_state(state)
+            return self.embedding_model.is_fitted
+        return False
+    
+    @staticmethod
+    def read_embedding_state(directory: str) -> Optional[Dict]:
+        """读取嵌入模型状态文件，不存在或损坏时返回None"""
+        try:
+            with open(os.path.join(directory, VectorStore.EMBEDDING_STATE_NAME), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    @staticmethod
+    def write_embedding_state(directory: str, state: Dict, exclusive: bool = False) -> Dict:
+        """写入嵌入模型状态文件
+        
+        exclusive=True 时仅在文件不存在时写入（多个进程同时首次拟合只保留一个），
+        返回最终生效的状态。
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, VectorStore.EMBEDDING_STATE_NAME)
+        tmp_path = f"{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**state, 'fitted_at': datetime.now().isoformat()}, f, ensure_ascii=False)
+        try:
+            if exclusive:
+                try:
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    return VectorStore.read_embedding_state(directory) or state
+            else:
+                os.replace(tmp_path, path)
+                tmp_path = None
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return state
+    
+    def ensure_fitted(self, texts: List[str], corpus_size: Optional[int] = None):
+        """编码前确保嵌入模型已拟合：优先恢复知识库已持久化的状态，否则在给定语料上拟合并保存
+
+        texts 可以是语料的抽样，corpus_size 为抽样所代表的块数（默认为 len(texts)），
+        与状态一起保存为 fitted_chunks，知识库增长到其 EMBEDDING_REFIT_GROWTH 倍后重新拟合。
+        """
+        model = self.embedding_model
+        if model.is_fitted or self.load_embedding_state():
+            return
+        
+        model.fit(texts)
+        if self.state_dir:
+            try:
+                state = self.write_embedding_state(
+                    self.state_dir, {**model.get_state(), 'fitted_chunks': corpus_size or len(texts)}, exclusive=True
+                )
+                if state_provider(state) != model.provider:
+                    # 知识库更换了嵌入模型类型，旧状态作废
+                    self.write_embedding_state(self.state_dir, model.get_state())
+                elif state.get('version') != model.version:
+                    # 其他进程先完成了拟合，使用其结果
+                    model.set_state(state)
+            except OSError as e:
+                logger.warning(f"保存嵌入模型状态失败: {e}")
     
-    def add_documents(self, chunks: List[Dict]):
-        """添加文档块并持久化到数据库"""
+    def add_documents(self, chunks: List[Dict], batch_size: int = 500) -> Dict:
+        """编码文档块并写入数据库
+        
+        只对新块编码（内容相同的块命中嵌入缓存），块内容与float32向量一起按批 bulk_create，不触碰知识库中已有的块。
+        同时计算每个块的词频一并保存，供关键词索引加载时使用。
+        只写数据库，不追加到内存索引（由知识库版本号递增后的同步加载）；所属文档已不存在的块被丢弃。
+        返回写入的块数和编码/分词/写库耗时统计。
+        """
         from django.db import transaction
         from apps.knowledge.models import DocumentChunk, Document
         
+        if not chunks:
+            return {'chunk_count': 0, 'embed_time': 0.0, 'index_time': 0.0, 'persist_time': 0.0}
+        
+        contents = [chunk['content'] for chunk in chunks]
+        metadata_list = [chunk['metadata'] for chunk in chunks]
+        
+        start_time = time.time()
+        self.ensure_fitted(contents)
+        new_vectors = encode_with_cache(self.embedding_model, contents, self.cache_stats)
+        embed_time = time.time() - start_time
+        
+        start_time = time.time()
+        terms_list = [term_counts(content) for content in contents] if self.keyword_index is not None else None
+        index_time = time.time() - start_time
+        
+        # 持久化到数据库：一次查询确认文档存在，再分批写入
+        start_time = time.time()
+        document_ids = {meta['document_id'] for meta in metadata_list if 'document_id' in meta}
+        existing_ids = set(Document.objects.filter(id__in=document_ids).values_list('id', flat=True))
+        for missing_id in document_ids - existing_ids:
+            logger.warning(f"Document with ID {missing_id} not found")
+        
+        objects = [
+            DocumentChunk(
+                document_id=meta['document_id'],
+                chunk_index=meta.get('chunk_index', 0),
+                content=content,
+                embedding=vector_to_bytes(vector),
+                embedding_version=self.embedding_model.version,
+                metadata=meta,
+                terms=terms or {}
+            )
+            for content, meta, vector, terms in zip(contents, metadata_list, new_vectors, terms_list or [None] * len(contents))
+            if meta.get('document_id') in existing_ids
+        ]
         with transaction.atomic():
-            for chunk in chunks:
-                self.chunks.append(chunk['content'])
-                self.metadata.append(chunk['metadata'])
-                
-                # 持久化到数据库
-                if 'document_id' in chunk['metadata']:
-                    try:
-                        document = Document.objects.get(id=chunk['metadata']['document_id'])
-                        DocumentChunk.objects.create(
-                            document=document,
-                            chunk_index=chunk['metadata'].get('chunk_index', 0),
-                            content=chunk['content'],
-                            embedding=None,  # 向量将在_update_vectors中更新
-                            metadata=chunk['metadata']
-                        )
-                    except Document.DoesNotExist:
-                        logger.warning(f"Document with ID {chunk['metadata']['document_id']} not found")
-        
-        # 重新计算向量
-        self._update_vectors()
-    
-    def _update_vectors(self):
-        """更新向量并持久化到数据库"""
-        if self.chunks:
-            self.vectors = self.embedding_model.encode(self.chunks)
-            
-            # 更新数据库中的向量 - 处理异步环境
-            from apps.knowledge.models import DocumentChunk
-            import asyncio
-            import threading
-            import queue
-            
-            # 检查是否在异步环境中
+            for i in range(0, len(objects), batch_size):
+                DocumentChunk.objects.bulk_create(objects[i:i + batch_size])
+        persist_time = time.time() - start_time
+        
+        return {
+            'chunk_count': len(objects),
+            'embed_time': round(embed_time, 3),
+            'index_time': round(index_time, 3),
+            'persist_time': round(persist_time, 3)
+        }
+
+    def add_chunks(self, table: ChunkTable, contents: List[str], stored_vectors: Optional[List] = None,
+                   stored_terms: Optional[List] = None):
+        """增量追加已持久化的文档块，不写数据库
+
+        table 为这些块的元数据，contents 与其逐行对应，只用于编码和分词，不保存在索引中。
+        stored_vectors 元素为数据库中同一嵌入版本的向量或None，只有缺少可用向量的块才重新编码；
+        stored_terms 同理，缺少词频的块（旧数据）重新分词。
+        """
+        if not contents:
+            return
+
+        self.ensure_fitted(contents)
+        stored_vectors = stored_vectors or [None] * len(contents)
+        missing = [i for i, vector in enumerate(stored_vectors) if vector is None]
+        if missing:
+            encoded = encode_with_cache(self.embedding_model, [contents[i] for i in missing], self.cache_stats)
+            stored_vectors = list(stored_vectors)
+            for i, vector in zip(missing, encoded):
+                stored_vectors[i] = vector
+
+        self._append(table, normalize_rows(np.vstack(stored_vectors)), stored_terms, contents)
+
+    def _append(self, table: ChunkTable, new_vectors: np.ndarray, terms_list: Optional[List] = None,
+                contents: Optional[List[str]] = None):
+        """把已归一化的新向量和块的词频追加到内存索引"""
+        self._publish(self._snapshot.appended(table, new_vectors, terms_list, contents))
+
+    def remove_documents(self, document_ids) -> int:
+        """从内存索引中移除指定文档的所有块，返回移除的块数"""
+        document_ids = list(set(document_ids))
+        snapshot = self._snapshot
+        if not document_ids or not len(snapshot):
+            return 0
+
+        keep = np.flatnonzero(~np.isin(snapshot.table.document_ids, document_ids))
+        removed = len(snapshot) - len(keep)
+        if removed == 0:
+            return 0
+
+        self._publish(snapshot.kept(keep))
+        return removed
+
+    def document_ids(self) -> set:
+        """当前内存索引中包含的文档ID集合"""
+        return self._snapshot.table.document_id_set()
+
+    MANIFEST_NAME = 'manifest.json'
+
+    @staticmethod
+    def read_manifest(directory: str) -> Optional[Dict]:
+        """读取持久化索引的清单文件，不存在或损坏时返回None"""
+        path = os.path.join(directory, VectorStore.MANIFEST_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, directory: str, version: int) -> Dict:
+        """把向量矩阵写成float32内存映射文件并原子替换清单
+
+        文件名带版本号和随机后缀，已映射旧文件的其他进程不受影响；
+        写入完成后本进程也改用只读memmap，由操作系统页缓存在进程间共享。
+        """
+        os.makedirs(directory, exist_ok=True)
+        token = f"{version}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        snapshot = self._snapshot
+        count = len(snapshot)
+        dim = int(snapshot.vectors.shape[1]) if count and snapshot.vectors is not None else 0
+
+        vectors_file = None
+        if count and dim:
+            vectors_file = f"vectors-{token}.f32"
+            mapped = np.memmap(os.path.join(directory, vectors_file), dtype=np.float32, mode='w+', shape=(count, dim))
+            mapped[:] = snapshot.vectors
+            mapped.flush()
+            del mapped
+
+        # 每行对应的(document_id, chunk_index)，加载时据此对齐块内容
+        keys_file = f"keys-{token}.npy"
+        np.save(os.path.join(directory, keys_file), snapshot.table.keys())
+
+        ann_index = self._ensure_ann_index(snapshot) if vectors_file else None
+        ann_file = None
+        if ann_index is not None and ann_index.nprobe:
+            ann_file = f"ivf-{token}.npz"
+            ann_index.save(os.path.join(directory, ann_file))
+
+        manifest = {
+            'version': version,
+            'count': count,
+            'dim': dim,
+            'vectors_file': vectors_file,
+            'keys_file': keys_file,
+            'ann_file': ann_file,
+            'embedding': self.embedding_model.get_state(),
+            'updated_at': datetime.now().isoformat()
+        }
+        tmp_path = os.path.join(directory, f"{VectorStore.MANIFEST_NAME}.{token}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(directory, VectorStore.MANIFEST_NAME))
+
+        self._remove_stale_files(directory, version)
+        # 改用只读memmap并换上（重新训练的）IVF索引；保存期间快照若已被替换则不覆盖
+        if self._snapshot is snapshot:
+            vectors = self.open_vectors(directory, manifest) if vectors_file else snapshot.vectors
+            self._publish(snapshot.replace(vectors=vectors, ann_index=ann_index))
+        return manifest
+
+    def _ensure_ann_index(self, snapshot: IndexSnapshot) -> Optional[IVFIndex]:
+        """块数达到 ANN_MIN_CHUNKS 时返回可用的IVF索引：首次或规模翻倍后重新训练，否则沿用增量分配的索引
+
+        训练后校准 nprobe，召回率达不到 ANN_MIN_RECALL 时索引的 nprobe 为None：不保存、不用于检索（继续精确检索），
+        但留在快照中，规模翻倍前不再重复训练。
+        """
+        count = len(snapshot)
+        if not get_kb_setting('ANN_INDEX', False) or count < get_kb_setting('ANN_MIN_CHUNKS', 100000):
+            return None
+        ann_index = snapshot.ann_index
+        if ann_index is None or len(ann_index) != count or count > 2 * ann_index.trained_count:
+            start_time = time.time()
+            ann_index = IVFIndex.train(snapshot.vectors, nlist=get_kb_setting('ANN_NLIST'))
+            ann_index.calibrate(
+                snapshot.vectors, target_recall=get_kb_setting('ANN_MIN_RECALL', 0.95),
+                min_nprobe=get_kb_setting('ANN_NPROBE', 16)
+            )
+            logger.info(f"训练IVF索引完成: {count} 个向量, {ann_index.nlist} 个簇, nprobe {ann_index.nprobe}, "
+                        f"耗时 {time.time() - start_time:.1f} 秒")
+        return ann_index
+
+    @staticmethod
+    def load_ann_index(directory: str, manifest: Dict) -> Optional[IVFIndex]:
+        """读取清单对应的IVF索引，没有、读取失败或未校准 nprobe 时返回None"""
+        if not manifest.get('ann_file') or not get_kb_setting('ANN_INDEX', False):
+            return None
+        try:
+            ann_index = IVFIndex.load(os.path.join(directory, manifest['ann_file']))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"读取IVF索引失败，改为精确检索: {e}")
+            return None
+        return ann_index if ann_index.nprobe else None
+
+    @staticmethod
+    def open_vectors(directory: str, manifest: Dict) -> Optional[np.ndarray]:
+        """以只读memmap方式打开清单对应的向量文件"""
+        if not manifest.get('vectors_file'):
+            return None
+        return np.memmap(
+            os.path.join(directory, manifest['vectors_file']),
+            dtype=np.float32, mode='r', shape=(manifest['count'], manifest['dim'])
+        )
+
+    @staticmethod
+    def load_keys(directory: str, manifest: Dict) -> np.ndarray:
+        """读取向量文件每行对应的(document_id, chunk_index)"""
+        return np.load(os.path.join(directory, manifest['keys_file']))
+
+    def is_mapped(self, directory: str, manifest: Dict) -> bool:
+        """向量矩阵是否已经是清单对应文件的memmap"""
+        vectors = self._snapshot.vectors
+        return (isinstance(vectors, np.memmap) and bool(manifest.get('vectors_file'))
+                and os.path.abspath(vectors.filename) == os.path.abspath(os.path.join(directory, manifest['vectors_file'])))
+
+    def adopt_persisted(self, directory: str, manifest: Dict) -> bool:
+        """改用其他进程为同一版本写入的向量文件，行集合与内存索引不一致时返回False
+
+        行顺序不同时先把内存索引按文件的行顺序重排，再把向量矩阵换成共享的只读memmap，
+        同一知识库版本的各工作进程由此共享同一份页缓存。
+        """
+        if self.is_mapped(directory, manifest):
+            return True
+        snapshot = self._snapshot
+        if not manifest.get('vectors_file') or manifest.get('count') != len(snapshot):
+            return False
+        if manifest.get('embedding', {}).get('version') != self.embedding_model.version:
+            return False
+        try:
+            keys = self.load_keys(directory, manifest)
+            vectors = self.open_vectors(directory, manifest)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取向量文件失败: {e}")
+            return False
+
+        order = align_rows(snapshot.table.keys(), keys)
+        if order is None:
+            return False
+        if not np.array_equal(order, np.arange(len(order))):
+            snapshot = snapshot.kept(order)
+        ann_index = self.load_ann_index(directory, manifest)
+        if ann_index is None or len(ann_index) != len(snapshot):
+            ann_index = snapshot.ann_index
+        self._publish(snapshot.replace(vectors=vectors, ann_index=ann_index))
+        return True
+
+    @staticmethod
+    def acquire_write_lock(path: str, stale_after: float) -> bool:
+        """创建锁文件，已被其他进程持有时返回False（超过 stale_after 秒的锁视为写入进程已退出）"""
+        for _ in range(2):
             try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    # 在异步环境中，使用线程来执行同步数据库操作
-                    def sync_update_embeddings():
-                        for i, vector in enumerate(self.vectors):
-                            if i < len(self.metadata) and 'document_id' in self.metadata[i]:
-                                try:
-                                    chunk = DocumentChunk.objects.filter(
-                                        document_id=self.metadata[i]['document_id'],
-                                        chunk_index=self.metadata[i].get('chunk_index', 0)
-                                    ).first()
-                                    if chunk:
-                                        chunk.embedding = vector.tolist()
-                                        chunk.save()
-                                except Exception as e:
-                                    logger.warning(f"Failed to update embedding for chunk {i}: {e}")
-                    
-                    # 在独立线程中执行数据库更新
-                    thread = threading.Thread(target=sync_update_embeddings)
-                    thread.start()
-                    thread.join()
-                    return
-                    
-            except RuntimeError:
-                # 没有事件循环，可以进行同步操作
-                pass
-            
-            # 同步环境中的正常更新
-            for i, vector in enumerate(self.vectors):
-                if i < len(self.metadata) and 'document_id' in self.metadata[i]:
-                    try:
-                        chunk = DocumentChunk.objects.filter(
-                            document_id=self.metadata[i]['document_id'],
-                            chunk_index=self.metadata[i].get('chunk_index', 0)
-                        ).first()
-                        if chunk:
-                            chunk.embedding = vector.tolist()
-                            chunk.save()
-                    except Exception as e:
-                        logger.warning(f"Failed to update embedding for chunk {i}: {e}")
-    
-    def similarity_search(self, query: str, top_k: int = 5, threshold: float = 0.1) -> List[Dict]:
-        """相似度搜索"""
-        if not self.chunks or self.vectors is None:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < stale_after:
+                        return False
+                    os.remove(path)
+                except OSError:
+                    pass
+        return False
+
+    @staticmethod
+    def _remove_stale_files(directory: str, version: int):
+        """删除低于当前版本的向量文件（同版本的并发写入不受影响）"""
+        for name in os.listdir(directory):
+            match = re.match(r'^(?:vectors|keys|ivf)-(\d+)-', name)
+            if match and int(match.group(1)) < version:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def similarity_search(self, query: str, top_k: int = 5, threshold: float = 0.1,
+                          query_vector: Optional[np.ndarray] = None) -> List[Dict]:
+        """相似度搜索：开启混合检索时与BM25关键词检索的结果融合
+
+        query_vector 为调用方已编码的查询向量，提供时不再重复编码。
+        整个检索使用开始时的同一个快照。
+        """
+        snapshot = self._snapshot
+        if not len(snapshot) or snapshot.vectors is None:
+            return []
+        
+        # 未拟合的模型不能编码查询，否则会用查询本身建立词汇表
+        if not self.embedding_model.is_fitted and not self.load_embedding_state():
             return []
         
         # 编码查询
-        query_vector = self.embedding_model.encode([query])
-        
-        # 简单的余弦相似度计算
-        def cosine_sim(a, b):
-            dot_product = np.dot(a, b)
-            norm_a = np.linalg.norm(a)
-            norm_b = np.linalg.norm(b)
-            if norm_a == 0 or norm_b == 0:
-                return 0
-            return dot_product / (norm_a * norm_b)
-        
-        similarities = []
-        for vector in self.vectors:
-            sim = cosine_sim(query_vector[0], vector)
-            similarities.append(sim)
-        similarities = np.array(similarities)
-        
-        # 获取top_k结果
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+        if query_vector is None:
+            query_vector = self.embedding_model.encode([query])[0]
+        if snapshot.keyword_index is None or len(snapshot.keyword_index) != len(snapshot):
+            return self.search_by_vector(query_vector, top_k=top_k, threshold=threshold, snapshot=snapshot)
+        return self.hybrid_search(query, query_vector, top_k=top_k, threshold=threshold, snapshot=snapshot)
+    
+    def hybrid_search(self, query: str, query_vector: np.ndarray, top_k: int = 5, threshold: float = 0.1,
+                      snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
+        """向量检索和关键词检索各取 top_k*HYBRID_CANDIDATES 个候选，按倒数排名融合(RRF)得分 Σ1/(RRF_K+排名) 排序
         
-        results = []
-        for idx in top_indices:
-            score = similarities[idx]
-            if score >= threshold:
-                results.append({
-                    'content': self.chunks[idx],
-                    'score': float(score),
-                    'metadata': self.metadata[idx],
-                    'index': int(idx)
-                })
+        相似度低于阈值但命中关键词的块同样保留；score 仍为余弦相似度，另附 bm25_score 和 rrf_score。
+        """
+        if snapshot is None:
+            snapshot = self._snapshot
+        rrf_k = get_kb_setting('RRF_K', 60)
+        candidates = top_k * get_kb_setting('HYBRID_CANDIDATES', 4)
+        vector_rows, _ = self._vector_candidates(snapshot, query_vector, candidates, threshold)
+        keyword_rows, keyword_scores = snapshot.keyword_index.search(query, top_k=candidates)
+        
+        fused = {}
+        for rank, row in enumerate(vector_rows.tolist(), 1):
+            fused[row] = 1.0 / (rrf_k + rank)
+        bm25_scores = {}
+        for rank, (row, score) in enumerate(zip(keyword_rows.tolist(), keyword_scores.tolist()), 1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank)
+            bm25_scores[row] = score
+        if not fused:
+            return []
+        
+        # 融合得分相同时关键词得分高的在前
+        top_rows = sorted(fused, key=lambda row: (fused[row], bm25_scores.get(row, 0.0)), reverse=True)[:top_k]
+        similarities = np.asarray(snapshot.vectors[top_rows]) @ normalize_rows(query_vector)[0]
+        similarities = dict(zip(top_rows, similarities.tolist()))
+        results = self.fetch_rows(top_rows, snapshot=snapshot)
+        for result in results:
+            row = result['index']
+            result.update({
+                'score': float(similarities[row]),
+                'bm25_score': round(bm25_scores.get(row, 0.0), 4),
+                'rrf_score': round(fused[row], 6)
+            })
+        return results
+    
+    def search_by_vector(self, query_vector: np.ndarray, top_k: int = 5, threshold: float = 0.1,
+                         snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
+        """用已编码的查询向量检索：矩阵-向量乘积计算全部得分，argpartition选出top_k
         
+        有校准过的IVF索引时只扫描最接近查询的 nprobe 个簇（近似结果）。
+        """
+        if snapshot is None:
+            snapshot = self._snapshot
+        rows, scores = self._vector_candidates(snapshot, query_vector, top_k, threshold)
+        scores = dict(zip(rows.tolist(), scores.tolist()))
+        results = self.fetch_rows(rows, snapshot=snapshot)
+        for result in results:
+            result['score'] = float(scores[result['index']])
         return results
 
+    @staticmethod
+    def _vector_candidates(snapshot: IndexSnapshot, query_vector: np.ndarray, top_k: int,
+                           threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+        """返回得分不低于阈值的前 top_k 行及其余弦相似度（按得分降序）"""
+        vectors = snapshot.vectors
+        if vectors is None or len(vectors) == 0 or top_k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        
+        query = normalize_rows(query_vector)[0]
+        ann_index = snapshot.ann_index
+        if ann_index is not None and ann_index.nprobe and len(ann_index) == len(vectors):
+            top_indices, top_scores = ann_index.search(vectors, query, top_k=top_k, nprobe=ann_index.nprobe)
+        else:
+            similarities = vectors @ query
+            
+            # 获取top_k结果：先O(N)划分出前k个，再只对这k个排序
+            k = min(top_k, len(similarities))
+            if k < len(similarities):
+                candidates = np.argpartition(-similarities, k - 1)[:k]
+            else:
+                candidates = np.arange(len(similarities))
+            top_indices = candidates[np.argsort(-similarities[candidates], kind='stable')]
+            top_scores = similarities[top_indices]
+        
+        mask = top_scores >= threshold
+        return np.asarray(top_indices)[mask], np.asarray(top_scores)[mask]
+
+    def fetch_rows(self, rows, snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
+        """读取给定行的块内容和元数据，返回 [{'content', 'metadata', 'index'}]
+
+        块内容在数据库中，异步代码须通过 await run_db(...) 调用，在事件循环线程中直接调用会抛出 RuntimeError。
+        数据库中已删除（内存索引尚未同步）的行被跳过，结果可能少于给定的行数。
+        """
+        if snapshot is None:
+            snapshot = self._snapshot
+        rows = [int(row) for row in rows]
+        if not rows:
+            return []
+        return [
+            {'content': content, 'metadata': metadata, 'index': row}
+            for row, content, metadata in run_db_sync(snapshot.table.fetch, rows)
+        ]
+
+
+# 提示模板（不含知识库内容和问题）的token数上限，以及知识库内容的最小预算
+PROMPT_TEMPLATE_TOKENS = 400
+MIN_CONTEXT_TOKENS = 500
+
 
 class LLMInterface:
     """大语言模型接口"""
@@ -426,26 +1189,51 @@ class LLMInterface:
         self.model_type = self.model_config.get('model_type', 'mock')
         self.model_name = self.model_config.get('model_name', 'mock')
     
-    async def generate(self, prompt: str, context: str = "") -> str:
-        """生成回答"""
+    def context_token_budget(self) -> int:
+        """提示词中知识库内容的token预算
+        
+        模型上下文窗口扣除回答的 max_tokens 和提示模板，且不超过 CONTEXT_TOKEN_BUDGET。
+        """
+        available = (get_kb_setting('LLM_CONTEXT_WINDOW', 8192) - int(self.model_config.get('max_tokens') or 0)
+                     - PROMPT_TEMPLATE_TOKENS)
+        return max(MIN_CONTEXT_TOKENS, min(get_kb_setting('CONTEXT_TOKEN_BUDGET', 3000), available))
+    
+    async def generate(self, prompt: str, context: str = "", usage: Optional[Dict] = None) -> str:
+        """生成回答，API调用失败时抛出异常
+        
+        传入 usage 字典时，API返回的token用量写入 usage['total_tokens']。
+        """
         if self.model_type == 'mock' or self.model_name == 'mock':
             return f"基于提供的上下文信息：{context[:100]}...\n\n对于问题「{prompt}」，这是一个模拟回答。请配置真实的大语言模型以获得准确回答。"
         
         # 真实API调用
         if self.model_type == 'api':
-            try:
-                return await self._call_real_api(prompt, context)
-            except Exception as e:
-                logger.error(f"API调用失败: {e}")
-                return f"抱歉，调用AI模型时出现错误：{str(e)}"
+            return await self._call_real_api(prompt, context, usage)
         
         return "请配置大语言模型"
     
-    async def _call_real_api(self, prompt: str, context: str = "") -> str:
-        """调用真实的API"""
-        import aiohttp
-        import json
+    async def stream_generate(self, prompt: str, usage: Optional[Dict] = None) -> AsyncIterator[str]:
+        """流式生成回答，逐段产出文本，API调用失败时抛出异常
+        
+        OpenAI兼容接口使用 stream=true，Gemini使用 streamGenerateContent；
+        模拟模型和未配置密钥时整段产出。token用量在流结束后写入 usage['total_tokens']。
+        """
+        api_key = self.model_config.get('api_key')
+        if self.model_type != 'api' or self.model_name == 'mock' or not api_key:
+            yield await self.generate(prompt, "", usage)
+            return
         
+        api_base_url = self.model_config.get('api_base_url')
+        logger.info(f"发送给API的提示预览(流式): {prompt[:200]}...")
+        if 'gemini' in self.model_name.lower() or 'google' in api_base_url.lower():
+            stream = self._stream_gemini_api(prompt, api_key, api_base_url, usage)
+        else:
+            stream = self._stream_openai_api(prompt, api_key, api_base_url, self.model_name, usage)
+        async for delta in stream:
+            yield delta
+    
+    async def _call_real_api(self, prompt: str, context: str = "", usage: Optional[Dict] = None) -> str:
+        """调用真实的API"""
         api_key = self.model_config.get('api_key')
         api_base_url = self.model_config.get('api_base_url')
         model_name = self.model_config.get('model_name')
@@ -460,97 +1248,95 @@ class LLMInterface:
         # 记录发送给API的提示内容（截取前200字符）
         logger.info(f"发送给API的提示预览: {full_prompt[:200]}...")
         
-        try:
-            # 支持不同的API格式
-            if 'gemini' in model_name.lower() or 'google' in api_base_url.lower():
-                return await self._call_gemini_api(full_prompt, api_key, api_base_url)
-            elif 'openai' in api_base_url.lower():
-                return await self._call_openai_api(full_prompt, api_key, api_base_url, model_name)
-            else:
-                return await self._call_generic_api(full_prompt, api_key, api_base_url, model_name)
-        except Exception as e:
-            logger.error(f"API调用异常: {e}")
-            return f"API调用失败：{str(e)}"
-    
-    async def _call_gemini_api(self, prompt: str, api_key: str, api_base_url: str) -> str:
-        """调用Gemini API - 使用同步方式确保稳定性"""
-        import requests
-        import json
-        import asyncio
-        
-        # 在线程池中执行同步请求，避免阻塞事件循环
-        def sync_request():
-            # Gemini API URL格式 - 使用v1beta
-            if not api_base_url.endswith('/'):
-                api_base_url_fixed = api_base_url + '/'
-            else:
-                api_base_url_fixed = api_base_url
-            
-            # 使用配置中的模型名称
-            model_name = self.model_config.get('model_name', 'gemini-pro')
-            url = f"{api_base_url_fixed}v1beta/models/{model_name}:generateContent"
-            
-            # 正确的请求头格式 - 使用x-goog-api-key
-            headers = {
-                'Content-Type': 'application/json',
-                'x-goog-api-key': api_key
-            }
-            
-            # 正确的请求体格式
-            data = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": self.model_config.get('temperature', 0.7),
-                    "maxOutputTokens": self.model_config.get('max_tokens', 4096),
+        # 支持不同的API格式
+        if 'gemini' in model_name.lower() or 'google' in api_base_url.lower():
+            return await self._call_gemini_api(full_prompt, api_key, api_base_url, usage)
+        elif 'openai' in api_base_url.lower():
+            return await self._call_openai_api(full_prompt, api_key, api_base_url, model_name, usage)
+        else:
+            return await self._call_generic_api(full_prompt, api_key, api_base_url, model_name, usage)
+    
+    def _gemini_request(self, prompt: str, api_key: str, api_base_url: str, method: str) -> Tuple[str, Dict, Dict]:
+        """构建Gemini请求的 (URL, 请求头, 请求体)，method 为 generateContent 或 streamGenerateContent"""
+        # Gemini API URL格式 - 使用v1beta
+        if not api_base_url.endswith('/'):
+            api_base_url = api_base_url + '/'
+        
+        # 使用配置中的模型名称
+        model_name = self.model_config.get('model_name', 'gemini-pro')
+        url = f"{api_base_url}v1beta/models/{model_name}:{method}"
+        
+        # 正确的请求头格式 - 使用x-goog-api-key
+        headers = {
+            'Content-Type': 'application/json',
+            'x-goog-api-key': api_key
+        }
+        
+        # 正确的请求体格式
+        data = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [
+                        {
+                            "text": prompt
+                        }
+                    ]
                 }
+            ],
+            "generationConfig": {
+                "temperature": self.model_config.get('temperature', 0.7),
+                "maxOutputTokens": self.model_config.get('max_tokens', 4096),
             }
-            
-            logger.info(f"Gemini API URL: {url}")
-            logger.info(f"Gemini API Headers: {headers}")
-            
-            try:
-                response = requests.post(url, headers=headers, json=data, timeout=30)
-                logger.info(f"Gemini API Response Status: {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    candidates = result.get('candidates', [])
-                    if candidates and candidates[0].get('content'):
-                        parts = candidates[0]['content'].get('parts', [])
-                        if parts:
-                            answer = parts[0].get('text', '未获得有效回复')
-                            logger.info(f"Gemini API Success: {answer[:100]}...")
-                            return answer
-                    logger.warning("Gemini API响应格式不正确")
-                    return '未获得有效回复'
-                else:
-                    logger.error(f"Gemini API请求失败 ({response.status_code}): {response.text}")
-                    raise Exception(f"API请求失败 ({response.status_code}): {response.text}")
-                    
-            except Exception as e:
-                logger.error(f"Gemini API调用异常: {e}")
-                raise e
+        }
         
-        # 在线程池中执行同步请求
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, sync_request)
-        return result
+        return url, headers, data
+    
+    @staticmethod
+    def _gemini_text(result: Dict) -> str:
+        candidates = result.get('candidates', [])
+        if candidates and candidates[0].get('content'):
+            return ''.join(part.get('text', '') for part in candidates[0]['content'].get('parts', []))
+        return ''
+    
+    async def _call_gemini_api(self, prompt: str, api_key: str, api_base_url: str,
+                               usage: Optional[Dict] = None) -> str:
+        """调用Gemini API（共享连接池）"""
+        from apps.knowledge.llm_client import post_json
+        
+        url, headers, data = self._gemini_request(prompt, api_key, api_base_url, 'generateContent')
+        logger.info(f"Gemini API URL: {url}")
+        result = await post_json(url, data, headers)
+        if usage is not None and result.get('usageMetadata'):
+            usage['total_tokens'] = result['usageMetadata'].get('totalTokenCount', 0)
+        candidates = result.get('candidates', [])
+        if candidates and candidates[0].get('content'):
+            parts = candidates[0]['content'].get('parts', [])
+            if parts:
+                answer = parts[0].get('text', '未获得有效回复')
+                logger.info(f"Gemini API Success: {answer[:100]}...")
+                return answer
+        logger.warning("Gemini API响应格式不正确")
+        return '未获得有效回复'
     
-    async def _call_openai_api(self, prompt: str, api_key: str, api_base_url: str, model_name: str) -> str:
-        """调用OpenAI API"""
-        import aiohttp
-        import json
+    async def _stream_gemini_api(self, prompt: str, api_key: str, api_base_url: str,
+                                 usage: Optional[Dict] = None) -> AsyncIterator[str]:
+        """流式调用Gemini API（streamGenerateContent?alt=sse），每个事件是一个完整的响应片段"""
+        from apps.knowledge.llm_client import post_stream
         
-        url = f"{api_base_url}/chat/completions"
+        url, headers, data = self._gemini_request(prompt, api_key, api_base_url, 'streamGenerateContent')
+        logger.info(f"Gemini API URL(流式): {url}")
+        async for event in post_stream(f"{url}?alt=sse", data, headers):
+            if usage is not None and event.get('usageMetadata'):
+                # 每个片段携带截至当前的累计用量，取最后一个
+                usage['total_tokens'] = event['usageMetadata'].get('totalTokenCount', 0)
+            text = self._gemini_text(event)
+            if text:
+                yield text
+    
+    def _openai_request(self, prompt: str, api_key: str, api_base_url: str, model_name: str) -> Tuple[str, Dict, Dict]:
+        """构建OpenAI兼容接口请求的 (URL, 请求头, 请求体)"""
+        url = f"{api_base_url.rstrip('/')}/chat/completions"
         
         headers = {
             'Content-Type': 'application/json',
@@ -565,31 +1351,43 @@ class LLMInterface:
             "temperature": self.model_config.get('temperature', 0.7),
             "max_tokens": self.model_config.get('max_tokens', 4096),
         }
+        return url, headers, data
+    
+    async def _call_openai_api(self, prompt: str, api_key: str, api_base_url: str, model_name: str,
+                               usage: Optional[Dict] = None) -> str:
+        """调用OpenAI API（共享连接池）"""
+        from apps.knowledge.llm_client import post_json
         
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    choices = result.get('choices', [])
-                    if choices:
-                        return choices[0]['message']['content']
-                    return '未获得有效回复'
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"API请求失败 ({response.status}): {error_text}")
+        url, headers, data = self._openai_request(prompt, api_key, api_base_url, model_name)
+        result = await post_json(url, data, headers)
+        if usage is not None and result.get('usage'):
+            usage['total_tokens'] = result['usage'].get('total_tokens', 0)
+        choices = result.get('choices', [])
+        if choices:
+            return choices[0]['message']['content']
+        return '未获得有效回复'
     
-    async def _call_generic_api(self, prompt: str, api_key: str, api_base_url: str, model_name: str) -> str:
-        """调用通用API"""
-        import aiohttp
-        import json
+    async def _stream_openai_api(self, prompt: str, api_key: str, api_base_url: str, model_name: str,
+                                 usage: Optional[Dict] = None) -> AsyncIterator[str]:
+        """流式调用OpenAI兼容接口（stream=true），最后一个事件携带token用量"""
+        from apps.knowledge.llm_client import post_stream
         
-        # 尝试OpenAI格式
-        try:
-            return await self._call_openai_api(prompt, api_key, api_base_url, model_name)
-        except Exception as e:
-            logger.error(f"通用API调用失败: {e}")
-            return f"API调用失败：{str(e)}"
+        url, headers, data = self._openai_request(prompt, api_key, api_base_url, model_name)
+        data['stream'] = True
+        data['stream_options'] = {'include_usage': True}
+        async for event in post_stream(url, data, headers):
+            if usage is not None and event.get('usage'):
+                usage['total_tokens'] = event['usage'].get('total_tokens', 0)
+            choices = event.get('choices') or []
+            if choices:
+                delta = (choices[0].get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+    
+    async def _call_generic_api(self, prompt: str, api_key: str, api_base_url: str, model_name: str,
+                                usage: Optional[Dict] = None) -> str:
+        """调用通用API（OpenAI兼容格式）"""
+        return await self._call_openai_api(prompt, api_key, api_base_url, model_name, usage)
     
     async def generate_response(self, prompt: str, context: str = "") -> Dict:
         """生成回答并返回详细信息"""
@@ -602,7 +1400,8 @@ class LLMInterface:
         
         try:
             # 注意：这里不传递context，因为prompt已经包含了完整的提示词
-            answer = await self.generate(prompt, "")
+            usage = {}
+            answer = await self.generate(prompt, "", usage)
             response_time = round((time.time() - start_time), 3)  # 保持为秒，保留3位小数
             
             logger.info(f"LLM 回答生成成功，耗时: {response_time}秒")
@@ -612,6 +1411,7 @@ class LLMInterface:
                 'answer': answer,
                 'response_time': response_time,
                 'model_used': f"{self.model_name}",
+                'tokens_used': usage.get('total_tokens', 0),
                 'success': True
             }
         except Exception as e:
@@ -626,6 +1426,40 @@ class LLMInterface:
             }
 
 
+def _timed(iterable: Iterable, stats: Dict, key: str) -> Iterator:
+    """迭代时把每次取下一个元素的耗时累加到 stats[key]"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stats[key] = stats.get(key, 0.0) + time.perf_counter() - start
+            return
+        stats[key] = stats.get(key, 0.0) + time.perf_counter() - start
+        yield item
+
+
+def parse_and_split_file(file_path: str, document_id: Optional[int] = None,
+                         chunk_size: int = 1000, chunk_overlap: int = 200) -> Tuple[List[Dict], Dict, Dict]:
+    """解析并分块单个文件（在进程池中执行，不访问数据库）
+    
+    返回 (块列表, 文档元数据, 耗时统计)。
+    """
+    stats = {'parse_time': 0.0, 'split_time': 0.0}
+    start = time.perf_counter()
+    text, metadata = DocumentProcessor.process_file(file_path)
+    stats['parse_time'] = time.perf_counter() - start
+    
+    if document_id:
+        metadata['document_id'] = document_id
+    chunk_metadata = {key: value for key, value in metadata.items() if key != 'size'}
+    start = time.perf_counter()
+    chunks = TextSplitter(chunk_size, chunk_overlap).split_text(text, chunk_metadata)
+    stats['split_time'] = time.perf_counter() - start
+    return chunks, metadata, stats
+
+
 class RAGSystem:
     """RAG系统主类"""
     
@@ -633,444 +1467,841 @@ class RAGSystem:
         self.document_processor = DocumentProcessor()
         self.text_splitter = TextSplitter()
         self.knowledge_bases = {}  # 存储每个知识库的向量存储
+        self.kb_versions = {}  # 每个知识库内存索引已同步到的版本号
+        # 每个知识库的写锁：同步、删除等更新操作串行执行，检索不加锁
+        self._kb_locks: Dict[int, threading.RLock] = {}
+        self._kb_locks_guard = threading.Lock()
         self.llm_configs = {}  # 存储LLM配置
+        # 问答结果缓存，键中含知识库版本号，文档变化后自动失效
+        self.answer_cache = AnswerCache(
+            max_size=get_kb_setting('ANSWER_CACHE_SIZE', 1000),
+            ttl=get_kb_setting('ANSWER_CACHE_TTL', 3600)
+        )
+        # 语义缓存：相似的问题复用同一知识库版本下已保存的回答
+        self.semantic_cache = SemanticAnswerCache(
+            threshold=get_kb_setting('SEMANTIC_CACHE_THRESHOLD', 0.95)
+        ) if get_kb_setting('SEMANTIC_CACHE', True) else None
         
-    def get_or_create_vector_store(self, kb_id: int) -> VectorStore:
-        """获取或创建知识库的向量存储"""
-        if kb_id not in self.knowledge_bases:
-            self.knowledge_bases[kb_id] = VectorStore()
-            # 注意：不在这里自动加载文档，由ask_question方法控制加载时机
-        return self.knowledge_bases[kb_id]
+    def _kb_lock(self, kb_id: int) -> threading.RLock:
+        """知识库的写锁（可重入），首次使用时创建"""
+        with self._kb_locks_guard:
+            return self._kb_locks.setdefault(kb_id, threading.RLock())
+
+    def get_or_create_vector_store(self, kb_id: int, store_path: Optional[str] = None) -> VectorStore:
+        """获取或创建知识库的向量存储（创建时恢复该知识库已持久化的嵌入模型状态）"""
+        vector_store = self.knowledge_bases.get(kb_id)
+        if vector_store is not None:
+            return vector_store
+        with self._kb_lock(kb_id):
+            if kb_id not in self.knowledge_bases:
+                self.knowledge_bases[kb_id] = self._new_vector_store(kb_id, store_path)
+                # 注意：不在这里自动加载文档，由ask_question方法控制加载时机
+            return self.knowledge_bases[kb_id]
+
+    def _new_vector_store(self, kb_id: int, store_path: Optional[str] = None) -> VectorStore:
+        return VectorStore(
+            embedding_model=self._create_embedding_model(kb_id),
+            state_dir=self._vector_store_dir(kb_id, store_path)
+        )
     
-    def _load_existing_documents(self, kb_id: int):
-        """从数据库加载已有的文档数据到向量存储"""
+    def _create_embedding_model(self, kb_id: int):
+        """按知识库的 EmbeddingConfig 创建嵌入模型：知识库指定的配置 > 默认配置 > SimpleEmbedding"""
+        from apps.knowledge.embeddings import get_embedding_model
+
         try:
-            from apps.knowledge.models import DocumentChunk
-            import asyncio
-            
-            # 检查是否在异步环境中
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    # 在异步环境中，使用同步方式强制加载
-                    logger.info(f"在异步环境中强制加载知识库 {kb_id} 的数据")
-                    # 创建新的线程来执行同步数据库操作
-                    import threading
-                    import queue
-                    
-                    result_queue = queue.Queue()
-                    
-                    def sync_load():
-                        try:
-                            # 获取知识库中所有已完成的文档块
-                            chunks = DocumentChunk.objects.filter(
-                                document__knowledge_base_id=kb_id,
-                                document__status='completed'
-                            ).select_related('document')
-                            
-                            chunk_data = []
-                            for chunk in chunks:
-                                chunk_data.append({
-                                    'content': chunk.content,
-                                    'metadata': {
-                                        'document_id': chunk.document.id,
-                                        'chunk_index': chunk.chunk_index,
-                                        'source': chunk.document.file_path,
-                                        'type': chunk.document.file_type,
-                                        **chunk.metadata
-                                    }
-                                })
-                            result_queue.put(chunk_data)
-                        except Exception as e:
-                            result_queue.put(e)
-                    
-                    thread = threading.Thread(target=sync_load)
-                    thread.start()
-                    thread.join()
-                    
-                    chunk_data = result_queue.get()
-                    if isinstance(chunk_data, Exception):
-                        raise chunk_data
-                    
-                    vector_store = self.knowledge_bases[kb_id]
-                    for chunk_info in chunk_data:
-                        vector_store.chunks.append(chunk_info['content'])
-                        vector_store.metadata.append(chunk_info['metadata'])
-                    
-                    # 重建向量
-                    if vector_store.chunks:
-                        vector_store._update_vectors()
-                    
-                    logger.info(f"从数据库加载知识库 {kb_id} 的文档数据: {len(vector_store.chunks)} 个块")
-                    return
-                    
-            except RuntimeError:
-                # 没有事件循环，可以进行同步操作
-                pass
-            
-            # 同步环境中的正常加载
-            # 获取知识库中所有已完成的文档块
-            chunks = DocumentChunk.objects.filter(
-                document__knowledge_base_id=kb_id,
-                document__status='completed'
-            ).select_related('document')
-            
-            vector_store = self.knowledge_bases[kb_id]
-            
-            for chunk in chunks:
-                # 添加文档内容和元数据
-                vector_store.chunks.append(chunk.content)
-                vector_store.metadata.append({
-                    'document_id': chunk.document.id,
-                    'chunk_index': chunk.chunk_index,
-                    'source': chunk.document.file_path,
-                    'type': chunk.document.file_type,
-                    **chunk.metadata
-                })
-            
-            # 重建向量
-            if vector_store.chunks:
-                vector_store._update_vectors()
-                
-            logger.info(f"从数据库加载知识库 {kb_id} 的文档数据: {len(vector_store.chunks)} 个块")
-            
+            from apps.knowledge.models import EmbeddingConfig, KnowledgeBase
+            kb = KnowledgeBase.objects.filter(id=kb_id).select_related('embedding_config').first()
+            config = kb.embedding_config if kb and kb.embedding_config and kb.embedding_config.is_active else None
+            if config is None:
+                config = EmbeddingConfig.objects.filter(is_active=True, is_default=True).first()
+            return get_embedding_model(config)
         except Exception as e:
-            logger.error(f"加载知识库 {kb_id} 的文档数据失败: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.warning(f"创建知识库 {kb_id} 的嵌入模型失败，使用 SimpleEmbedding: {e}")
+            return SimpleEmbedding()
+
+    def _vector_store_dir(self, kb_id: int, store_path: Optional[str] = None) -> Optional[str]:
+        """知识库向量目录：优先使用 KnowledgeBase.vector_store_path"""
+        if store_path:
+            return store_path
+        try:
+            from apps.knowledge.models import KnowledgeBase
+            store_path = KnowledgeBase.objects.filter(id=kb_id).values_list('vector_store_path', flat=True).first()
+            return store_path or self._default_vector_store_dir(kb_id)
+        except Exception as e:
+            logger.warning(f"获取知识库 {kb_id} 的向量目录失败: {e}")
+            return None
     
-    def manually_load_documents(self, kb_id: int):
-        """手动加载知识库文档数据（同步方法）- 确保每次都能成功加载"""
+    def _chunk_count(self, kb_id: int) -> int:
+        vector_store = self.knowledge_bases.get(kb_id)
+        return len(vector_store.snapshot) if vector_store is not None else 0
+
+    def sync_knowledge_base(self, kb_id: int, rebuild: bool = False) -> int:
+        """按知识库版本号增量同步内存索引（同步方法）
+
+        版本号未变化时直接返回；新进程优先映射磁盘上的向量文件，然后只加载新增的已完成文档、
+        移除已删除的文档，已在内存中的块不会重新查询或重新编码。
+        更新在当前存储的副本上完成，最后一次性替换，同步期间的检索继续使用旧索引。
+        rebuild=True 时丢弃内存索引全量重建。返回同步后的块数量。
+        """
+        from apps.knowledge.models import KnowledgeBase
+
         try:
-            from apps.knowledge.models import DocumentChunk, Document
-            
-            logger.info(f"开始强制加载知识库 {kb_id} 的文档数据")
-            
-            # 首先检查数据库中是否有文档 - 使用线程安全的方式
-            doc_count = 0
-            try:
-                import threading
-                count_holder = [0]
-                exception_holder = [None]
-                
-                def count_docs():
-                    try:
-                        count = Document.objects.filter(
-                            knowledge_base_id=kb_id,
-                            status='completed'
-                        ).count()
-                        count_holder[0] = count
-                    except Exception as e:
-                        exception_holder[0] = e
-                
-                thread = threading.Thread(target=count_docs)
-                thread.start()
-                thread.join()
-                
-                if exception_holder[0]:
-                    raise exception_holder[0]
-                    
-                doc_count = count_holder[0]
-                
-            except Exception as e:
-                logger.error(f"查询文档数量失败: {e}")
-                return 0
-            
-            logger.info(f"数据库中知识库 {kb_id} 有 {doc_count} 个已完成文档")
-            
-            if doc_count == 0:
-                logger.info(f"知识库 {kb_id} 中没有已完成的文档")
-                return 0
-            
-            # 确保向量存储已初始化
-            if kb_id not in self.knowledge_bases:
-                self.knowledge_bases[kb_id] = VectorStore()
-                logger.info(f"为知识库 {kb_id} 创建新的向量存储")
-            
-            vector_store = self.knowledge_bases[kb_id]
-            
-            # 强制清空现有数据，重新加载以确保数据同步
-            vector_store.chunks.clear()
-            vector_store.metadata.clear()
-            logger.info(f"清空知识库 {kb_id} 的现有向量数据")
-            
-            # 获取知识库中所有已完成的文档块 - 简化查询并包装为线程安全
-            try:
-                # 在新线程中执行数据库查询以避免异步上下文问题
-                import threading
-                chunks_list = []
-                exception_holder = [None]
-                
-                def fetch_chunks():
-                    try:
-                        chunks = DocumentChunk.objects.filter(
-                            document__knowledge_base_id=kb_id,
-                            document__status='completed'
-                        ).select_related('document').order_by('id')
-                        chunks_list.extend(list(chunks))
-                    except Exception as e:
-                        exception_holder[0] = e
-                
-                thread = threading.Thread(target=fetch_chunks)
-                thread.start()
-                thread.join()
-                
-                if exception_holder[0]:
-                    raise exception_holder[0]
-                    
-                chunks = chunks_list
-                
-            except Exception as e:
-                logger.error(f"数据库查询失败: {e}")
-                return 0
-            
-            chunk_count = 0
-            for chunk in chunks:
-                try:
-                    # 添加文档内容和元数据
-                    vector_store.chunks.append(chunk.content)
-                    vector_store.metadata.append({
-                        'document_id': chunk.document.id,
-                        'chunk_index': chunk.chunk_index,
-                        'source': chunk.document.file_path,
-                        'type': chunk.document.file_type,
-                        **chunk.metadata
-                    })
-                    chunk_count += 1
-                    
-                    # 每处理10个chunk记录一次日志
-                    if chunk_count % 10 == 0:
-                        logger.info(f"已处理 {chunk_count} 个文档块")
-                        
-                except Exception as e:
-                    logger.error(f"处理文档块 {chunk.id} 时出错: {e}")
-                    continue
-            
-            logger.info(f"总共处理了 {chunk_count} 个文档块")
-            
-            # 验证数据加载
-            if vector_store.chunks:
-                logger.info(f"向量存储中现在有 {len(vector_store.chunks)} 个块")
-                logger.info(f"第一个块内容预览: {vector_store.chunks[0][:100]}...")
-                
-                # 重建向量
-                try:
-                    vector_store._update_vectors()
-                    logger.info(f"知识库 {kb_id} 成功重建向量索引")
-                except Exception as e:
-                    logger.error(f"重建向量索引失败: {e}")
-            else:
-                logger.error(f"知识库 {kb_id} 加载后仍然没有任何数据块！")
-            
-            logger.info(f"成功强制加载知识库 {kb_id} 的文档数据: {chunk_count} 个块")
-            return chunk_count
-            
+            # 先读版本号再读文档列表：两者之间若有变更，下一次问答会再次同步
+            kb_row = KnowledgeBase.objects.filter(id=kb_id).values_list('version', 'vector_store_path').first()
+            if kb_row is None:
+                logger.warning(f"知识库 {kb_id} 不存在，跳过同步")
+                return self._chunk_count(kb_id)
+
+            version, store_path = kb_row
+            if not rebuild and kb_id in self.knowledge_bases and self.kb_versions.get(kb_id) == version:
+                return self._chunk_count(kb_id)
+
+            with self._kb_lock(kb_id):
+                # 等锁期间其他线程可能已同步到该版本
+                if not rebuild and kb_id in self.knowledge_bases and self.kb_versions.get(kb_id) == version:
+                    return self._chunk_count(kb_id)
+                return self._sync_locked(kb_id, version, store_path, rebuild)
+
         except Exception as e:
-            logger.error(f"强制加载知识库 {kb_id} 的文档数据失败: {e}")
+            logger.error(f"同步知识库 {kb_id} 的文档数据失败: {e}")
             import traceback
             traceback.print_exc()
-            return 0
+            return self._chunk_count(kb_id)
+
+    def _sync_locked(self, kb_id: int, version: int, store_path: Optional[str], rebuild: bool) -> int:
+        """持有知识库写锁时执行同步：在暂存副本上更新，完成后替换 knowledge_bases 中的存储"""
+        from apps.knowledge.models import Document
+
+        directory = store_path or self._default_vector_store_dir(kb_id)
+        current = self.knowledge_bases.get(kb_id)
+        if current is not None and not rebuild:
+            # 嵌入模型被重新拟合过（其他进程执行了refit）时，内存中的向量已不可比，全量重建
+            state = VectorStore.read_embedding_state(directory)
+            model = current.embedding_model
+            if state and model.is_fitted and (state_provider(state) != model.provider or state.get('version') != model.version):
+                logger.info(f"知识库 {kb_id} 的嵌入模型版本已变化，重建内存索引")
+                rebuild = True
+        vector_store = current.fork() if current is not None and not rebuild else self._new_vector_store(kb_id, directory)
+
+        use_mmap = get_kb_setting('VECTOR_MMAP', True)
+        manifest = VectorStore.read_manifest(directory) if use_mmap else None
+        if manifest and not len(vector_store.snapshot):
+            self._load_persisted_index(vector_store, directory, manifest)
+
+        completed_ids = set(Document.objects.filter(
+            knowledge_base_id=kb_id,
+            status='completed'
+        ).values_list('id', flat=True))
+        loaded_ids = vector_store.document_ids()
+
+        removed_ids = loaded_ids - completed_ids
+        added_ids = completed_ids - loaded_ids
+
+        removed_count = vector_store.remove_documents(removed_ids)
+
+        contents = []
+        if added_ids:
+            embedding_version = vector_store.embedding_model.version if vector_store.embedding_model.is_fitted else None
+            with_terms = vector_store.keyword_index is not None
+            table, contents, stored_vectors, stored_terms = self._fetch_chunk_columns(added_ids, embedding_version, with_terms)
+            vector_store.add_chunks(table, contents, stored_vectors, stored_terms)
+
+        if use_mmap:
+            # 只映射入库工作进程已写好的该版本向量文件，尚未写好时直接使用内存中的副本，不等待也不在请求中写文件
+            manifest = VectorStore.read_manifest(directory)
+            if manifest and manifest.get('version') == version:
+                vector_store.adopt_persisted(directory, manifest)
+
+        # 先替换存储再更新版本号，读到新版本号的问答一定使用新索引
+        self.knowledge_bases[kb_id] = vector_store
+        self.kb_versions[kb_id] = version
+        logger.info(
+            f"知识库 {kb_id} 同步到版本 {version}: 新增文档 {len(added_ids)} 个/块 {len(contents)} 个, "
+            f"移除文档 {len(removed_ids)} 个/块 {removed_count} 个, 当前共 {len(vector_store.snapshot)} 个块"
+        )
+        return len(vector_store.snapshot)
+
+    def persist_knowledge_base(self, kb_id: int) -> Optional[Dict]:
+        """把知识库当前版本的内存索引写成共享向量文件（同步方法，由入库工作进程和管理命令调用）
+
+        每个版本只由一个进程写入：取得 write-{版本}.lock 的进程同步内存索引并写文件，
+        其他进程（包括问答请求中的同步）只映射写好的文件。向量文件已是最新、未开启 VECTOR_MMAP
+        或其他进程正在写入时返回None，否则返回写入的清单。
+        """
+        from apps.knowledge.models import KnowledgeBase
+
+        if not get_kb_setting('VECTOR_MMAP', True):
+            return None
+        kb_row = KnowledgeBase.objects.filter(id=kb_id).values_list('version', 'vector_store_path').first()
+        if kb_row is None:
+            return None
+        version, store_path = kb_row
+        directory = store_path or self._default_vector_store_dir(kb_id)
+        manifest = VectorStore.read_manifest(directory)
+        if manifest and manifest.get('version', -1) >= version:
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        lock_path = os.path.join(directory, f"write-{version}.lock")
+        if not VectorStore.acquire_write_lock(lock_path, get_kb_setting('VECTOR_WRITE_LOCK_TIMEOUT', 600)):
+            return None
+        try:
+            with self._kb_lock(kb_id):
+                self.sync_knowledge_base(kb_id)
+                vector_store = self.knowledge_bases.get(kb_id)
+                synced_version = self.kb_versions.get(kb_id)
+                # 取得锁后再确认一次，其他进程可能刚刚写完该版本
+                manifest = VectorStore.read_manifest(directory)
+                if vector_store is None or synced_version is None or (
+                        manifest and manifest.get('version', -1) >= synced_version):
+                    return None
+                manifest = vector_store.save(directory, synced_version)
+        except OSError as e:
+            logger.warning(f"写入知识库 {kb_id} 的向量文件失败: {e}")
+            return None
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+        if not store_path:
+            KnowledgeBase.objects.filter(id=kb_id).update(vector_store_path=directory)
+        logger.info(f"知识库 {kb_id} 的向量文件已写入: 版本 {manifest['version']}, {manifest['count']} 个块")
+        return manifest
+
+    def persist_stale_knowledge_bases(self) -> List[int]:
+        """为向量文件落后于知识库版本的所有激活知识库写入新文件，返回写入的知识库ID"""
+        from apps.knowledge.models import KnowledgeBase
+
+        if not get_kb_setting('VECTOR_MMAP', True):
+            return []
+        persisted = []
+        for kb_id, version, store_path in KnowledgeBase.objects.filter(is_active=True).values_list(
+            'id', 'version', 'vector_store_path'
+        ):
+            manifest = VectorStore.read_manifest(store_path or self._default_vector_store_dir(kb_id))
+            if manifest and manifest.get('version', -1) >= version:
+                continue
+            try:
+                if self.persist_knowledge_base(kb_id):
+                    persisted.append(kb_id)
+            finally:
+                # 写入进程不常驻知识库的内存索引
+                self.knowledge_bases.pop(kb_id, None)
+                self.kb_versions.pop(kb_id, None)
+        return persisted
+
+    @staticmethod
+    def _default_vector_store_dir(kb_id: int) -> str:
+        """知识库向量文件默认目录，与上传文档目录并列"""
+        from django.conf import settings
+        return os.path.join(str(settings.MEDIA_ROOT), 'knowledge_bases', str(kb_id), 'vectors')
+
+    @staticmethod
+    def _document_info(document_ids) -> Dict[int, Tuple[str, str]]:
+        """文档ID -> (来源路径, 文件类型)"""
+        from apps.knowledge.models import Document
+
+        return {
+            document_id: (file_path, file_type)
+            for document_id, file_path, file_type in Document.objects.filter(
+                id__in=document_ids
+            ).values_list('id', 'file_path', 'file_type')
+        }
+
+    @classmethod
+    def _fetch_chunk_columns(cls, document_ids, embedding_version: Optional[str] = None,
+                             with_terms: bool = False) -> Tuple[ChunkTable, List[str], List, List]:
+        """按文档ID批量读取块，按(document_id, chunk_index)排序
+
+        返回 (元数据表, 块内容, 向量, 词频) 四列；只有给定 embedding_version 且与入库时一致时，
+        向量才是数据库中保存的向量，否则为None。with_terms=False 时词频为None。
+        按元组逐行读取，不为每个块构造元数据字典。
+        """
+        from apps.knowledge.models import DocumentChunk
+
+        fields = ['document_id', 'chunk_index', 'content']
+        if embedding_version:
+            fields += ['embedding', 'embedding_version']
+        if with_terms:
+            fields.append('terms')
+        document_column, index_column, contents, vectors, terms_list = [], [], [], [], []
+        for row in DocumentChunk.objects.filter(
+            document_id__in=document_ids
+        ).order_by('document_id', 'chunk_index').values_list(*fields).iterator(chunk_size=2000):
+            document_column.append(row[0])
+            index_column.append(row[1])
+            contents.append(row[2])
+            vector = None
+            if embedding_version and row[3] and row[4] == embedding_version:
+                vector = bytes_to_vector(row[3])
+            vectors.append(vector)
+            terms_list.append(row[-1] if with_terms else None)
+        table = ChunkTable(document_column, index_column, cls._document_info(set(document_column)))
+        return table, contents, vectors, terms_list
+
+    def _load_persisted_index(self, vector_store: VectorStore, directory: str, manifest: Dict):
+        """从磁盘映射向量矩阵，元数据表直接由向量文件的行键构造，不读取块内容，也不做任何编码"""
+        try:
+            vectors = VectorStore.open_vectors(directory, manifest)
+            keys = VectorStore.load_keys(directory, manifest)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取向量文件失败，改为重新编码: {e}")
+            return
+
+        if vectors is None or len(keys) == 0:
+            return
+
+        # 向量文件必须与知识库当前的嵌入模型版本一致
+        file_state = manifest.get('embedding', {})
+        model = vector_store.embedding_model
+        if model.is_fitted:
+            if file_state.get('version') != model.version:
+                logger.info(f"向量文件的嵌入版本与当前模型不一致，忽略 {directory}")
+                return
+        elif file_state.get('vocab') and model.provider == SimpleEmbedding.provider:
+            # 旧版本只在清单中保存了词汇表，迁移为独立的状态文件
+            model.set_state(file_state)
+            VectorStore.write_embedding_state(directory, model.get_state(), exclusive=True)
+
+        from apps.knowledge.models import DocumentChunk
+
+        # 只读取行键（和关键词索引需要的词频），确认文件中的行在数据库中仍然存在
+        with_terms = vector_store.keyword_index is not None
+        fields = ['document_id', 'chunk_index'] + (['terms'] if with_terms else [])
+        stored = {
+            (row[0], row[1]): row[2] if with_terms else None
+            for row in DocumentChunk.objects.filter(
+                document_id__in=set(keys[:, 0].tolist())
+            ).values_list(*fields).iterator(chunk_size=2000)
+        }
+        keep, terms_list = [], []
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            if key in stored:
+                keep.append(i)
+                terms_list.append(stored[key])
+        keep = np.asarray(keep, dtype=np.int64)
+        document_ids = keys[keep, 0]
+        table = ChunkTable(document_ids, keys[keep, 1], self._document_info(set(document_ids.tolist())))
+
+        # 缺少词频的旧数据需要块内容重新分词；读取期间被删除的块没有词频，下次同步时移除
+        contents = None
+        missing = [row for row, terms in enumerate(terms_list) if with_terms and not terms]
+        if missing:
+            contents = [''] * len(table)
+            for row, content, _ in table.fetch(missing):
+                contents[row] = content
+
+        # 文件中已不存在于数据库的行被丢弃；全部命中时直接使用共享的memmap
+        vector_store._append(
+            table,
+            vectors if len(keep) == len(keys) else np.ascontiguousarray(vectors[keep]),
+            terms_list, contents
+        )
+        ann_index = VectorStore.load_ann_index(directory, manifest)
+        if ann_index is not None and len(ann_index) == len(keys):
+            if len(keep) != len(keys):
+                ann_index.keep(keep)
+            vector_store._publish(vector_store.snapshot.replace(ann_index=ann_index))
+        logger.info(f"从 {directory} 映射了 {len(keep)} 个向量（文件版本 {manifest.get('version')}）")
+
+    def refit_embedding(self, kb_id: int, batch_size: int = 500) -> Dict:
+        """在知识库全部语料上重新拟合嵌入模型，重新编码并持久化所有块的向量
+
+        嵌入模型按知识库当前的 EmbeddingConfig 创建，更换配置后需执行一次。新的模型状态覆盖保存到向量目录，版本号递增后各进程会发现嵌入版本变化并重建内存索引。
+        """
+        from apps.knowledge.models import DocumentChunk
+
+        directory = self._vector_store_dir(kb_id)
+        chunk_ids = []
+        contents = []
+        for row in DocumentChunk.objects.filter(
+            document__knowledge_base_id=kb_id,
+            document__status='completed'
+        ).order_by('id').values('id', 'content'):
+            chunk_ids.append(row['id'])
+            contents.append(row['content'])
+
+        model = self._create_embedding_model(kb_id).fit(contents)
+        if directory:
+            VectorStore.write_embedding_state(directory, {**model.get_state(), 'fitted_chunks': len(contents)})
+
+        cache_stats = {'hits': 0, 'misses': 0}
+        for i in range(0, len(contents), batch_size):
+            vectors = encode_with_cache(model, contents[i:i + batch_size], cache_stats)
+            DocumentChunk.objects.bulk_update([
+                DocumentChunk(id=chunk_id, embedding=vector_to_bytes(vector), embedding_version=model.version)
+                for chunk_id, vector in zip(chunk_ids[i:i + batch_size], vectors)
+            ], ['embedding', 'embedding_version'])
+
+        with self._kb_lock(kb_id):
+            self.knowledge_bases.pop(kb_id, None)
+            self.kb_versions.pop(kb_id, None)
+        self._bump_kb_version(kb_id)
+        logger.info(f"知识库 {kb_id} 嵌入模型重新拟合完成: 版本 {model.version}, {len(contents)} 个块")
+        return {
+            'embedding_version': model.version,
+            'provider': model.provider,
+            'chunk_count': len(contents),
+            'cache_hits': cache_stats['hits']
+        }
+
+    def refit_embedding_if_grown(self, kb_id: int) -> Optional[Dict]:
+        """知识库的块数增长到拟合时的 EMBEDDING_REFIT_GROWTH 倍后重新拟合（由入库工作进程在任务完成后调用）
+
+        SimpleEmbedding 的词汇表、HashedTfidfEmbedding 的idf只反映拟合时的语料，后续入库的文档不会更新它们；
+        按倍数触发使重新编码的总量与知识库大小成正比。不依赖语料的模型（嵌入API）和没有记录拟合块数的
+        旧状态文件不自动重新拟合，可执行 python manage.py refit_embeddings。返回 refit_embedding 的结果或None。
+        """
+        from apps.knowledge.models import DocumentChunk
+
+        growth = get_kb_setting('EMBEDDING_REFIT_GROWTH', 4)
+        directory = self._vector_store_dir(kb_id)
+        state = VectorStore.read_embedding_state(directory) if growth and directory else None
+        if not state or not state.get('fitted_chunks'):
+            return None
+        model = self._create_embedding_model(kb_id)
+        if model.is_fitted or state_provider(state) != model.provider:
+            return None
+        chunk_count = DocumentChunk.objects.filter(
+            document__knowledge_base_id=kb_id, document__status='completed'
+        ).count()
+        if chunk_count < growth * state['fitted_chunks']:
+            return None
+        logger.info(f"知识库 {kb_id} 已有 {chunk_count} 个块，拟合时为 {state['fitted_chunks']} 个，重新拟合嵌入模型")
+        return self.refit_embedding(kb_id)
+
+    def _bump_kb_version(self, kb_id: int):
+        """递增知识库版本号，通知所有进程的内存索引需要同步"""
+        from django.db.models import F
+        from apps.knowledge.models import KnowledgeBase
+
+        KnowledgeBase.objects.filter(id=kb_id).update(version=F('version') + 1)
+
+    def delete_document(self, kb_id: int, document_id: int):
+        """文档删除后同步内存索引并递增版本号"""
+        with self._kb_lock(kb_id):
+            vector_store = self.knowledge_bases.get(kb_id)
+            if vector_store is not None:
+                vector_store.remove_documents([document_id])
+        self.answer_cache.invalidate(kb_id)
+        self._bump_kb_version(kb_id)
+
+    def delete_knowledge_base(self, kb_id: int):
+        """知识库删除后释放内存索引并递增版本号"""
+        with self._kb_lock(kb_id):
+            self.knowledge_bases.pop(kb_id, None)
+            self.kb_versions.pop(kb_id, None)
+        self.answer_cache.invalidate(kb_id)
+        if self.semantic_cache is not None:
+            self.semantic_cache.invalidate(kb_id)
+        self._bump_kb_version(kb_id)
 
     def configure_llm(self, config_id: int, model_config: Dict):
         """配置大语言模型"""
         self.llm_configs[config_id] = LLMInterface(model_config)
     
-    def process_document(self, kb_id: int, file_path: str, document_id: Optional[int] = None) -> Dict:
-        """处理文档"""
+    def process_document(self, kb_id: int, file_path: str, document_id: Optional[int] = None,
+                         progress_callback: Optional[Callable[[str, int], None]] = None) -> Dict:
+        """处理文档
+        
+        文本按页/段落流式读取、增量分块，每凑满 INGEST_BATCH_SIZE 个块就编码并写库，
+        峰值内存与文件大小无关。新块不直接加入内存索引，由版本号递增后的同步加载。
+        progress_callback(stage, progress) 报告进度，progress 为0-100的整数。
+        """
+        start_time = time.time()
+        report = progress_callback or (lambda stage, progress: None)
+        ingest_stats = {'parse_time': 0.0, 'split_time': 0.0}
+        
         try:
             # 处理文档
-            content, metadata = self.document_processor.process_file(file_path)
+            report('parse', 5)
+            segments, metadata = self.document_processor.iter_file(file_path)
             
             # 为每个块添加document_id到元数据中
             if document_id:
                 metadata['document_id'] = document_id
             
-            # 分块
-            chunks = self.text_splitter.split_text(content, metadata)
+            content_length = 0
+            total_units = metadata.get('pages') or metadata.get('paragraphs')
             
-            # 获取向量存储并添加文档
-            vector_store = self.get_or_create_vector_store(kb_id)
-            vector_store.add_documents(chunks)
+            def read_segments():
+                nonlocal content_length
+                for i, segment in enumerate(_timed(segments, ingest_stats, 'parse_time'), 1):
+                    content_length += len(segment)
+                    if total_units and i % 10 == 0:
+                        report('embed', 10 + 85 * i // total_units)
+                    yield segment
             
-            return {
-                'success': True,
-                'chunk_count': len(chunks),
-                'content_length': len(content),
-                'metadata': metadata
-            }
+            text_splitter = self.get_text_splitter(kb_id)
+            self._fit_on_sample(kb_id, file_path, text_splitter)
+            report('embed', 10)
+            chunks = _timed(text_splitter.split_stream(read_segments(), metadata), ingest_stats, 'split_time')
+            self._ingest_chunks(kb_id, document_id, chunks, ingest_stats)
+            # 分块计时包含了拉取文本段的时间
+            ingest_stats['split_time'] = max(ingest_stats['split_time'] - ingest_stats['parse_time'], 0.0)
+            report('finalize', 95)
+            
+            self._complete_document(kb_id, document_id, ingest_stats['chunk_count'])
+            return self._ingest_result(ingest_stats, {**metadata, 'size': content_length}, start_time)
             
         except Exception as e:
             logger.error(f"处理文档失败: {e}")
+            self._discard_chunks(document_id)
             return {
                 'success': False,
                 'error': str(e),
                 'chunk_count': 0
             }
     
+    def process_documents_parallel(self, kb_id: int, documents: List[Tuple[str, Optional[int]]],
+                                   max_workers: Optional[int] = None,
+                                   progress_callback: Optional[Callable[[int, str, int], None]] = None) -> List[Dict]:
+        """批量处理文档：解析和分块分散到进程池，编码和写库在当前进程串行执行
+        
+        documents 为 (file_path, document_id) 列表，返回与之一一对应的处理结果，
+        每个结果的 ingest_stats 含 parse/split/embed/persist 各阶段耗时。
+        子进程整份读取文件并把全部块传回当前进程，只适合小文件，大文件应使用 process_document 流式入库。
+        progress_callback(序号, stage, progress) 报告第几个文档的进度。
+        只由入库工作进程调用：进程池以 spawn 方式启动，子进程不继承当前进程的线程、锁和数据库连接。
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        
+        if not documents:
+            return []
+        
+        max_workers = max_workers or get_kb_setting('PARSE_WORKERS', min(os.cpu_count() or 1, 4))
+        max_workers = max(1, min(max_workers, len(documents)))
+        report = progress_callback or (lambda index, stage, progress: None)
+        text_splitter = self.get_text_splitter(kb_id)
+        splitter_args = (text_splitter.chunk_size, text_splitter.chunk_overlap)
+        results = []
+        
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(parse_and_split_file, file_path, document_id, *splitter_args)
+                for file_path, document_id in documents
+            ]
+            # 按提交顺序在主进程中写库，先完成解析的文件等待前面的文件入库
+            for index, ((file_path, document_id), future) in enumerate(zip(documents, futures)):
+                start_time = time.time()
+                try:
+                    chunks, metadata, ingest_stats = future.result()
+                    self.get_or_create_vector_store(kb_id).ensure_fitted([chunk['content'] for chunk in chunks])
+                    report(index, 'embed', 10)
+                    self._ingest_chunks(kb_id, document_id, chunks, ingest_stats)
+                    report(index, 'finalize', 95)
+                    self._complete_document(kb_id, document_id, ingest_stats['chunk_count'])
+                    result = self._ingest_result(ingest_stats, metadata, start_time)
+                    # 解析在子进程中与其他文件并行进行，总耗时按主进程等待+入库计算
+                    result['ingest_stats']['total_time'] = round(time.time() - start_time, 3)
+                    results.append(result)
+                except Exception as e:
+                    logger.error(f"处理文档失败 {file_path}: {e}")
+                    self._discard_chunks(document_id)
+                    results.append({'success': False, 'error': str(e), 'chunk_count': 0})
+        
+        logger.info(f"批量处理 {len(documents)} 个文档完成, 解析进程 {max_workers} 个")
+        return results
+    
+    def _fit_on_sample(self, kb_id: int, file_path: str, text_splitter: TextSplitter):
+        """知识库的嵌入模型尚未拟合时（第一个文档），先完整读一遍文件，在均匀抽样的块上拟合
+
+        流式入库按批编码，若在第一批上拟合，词汇表只反映文件开头的内容。抽样最多保留
+        EMBEDDING_FIT_SAMPLE_SIZE 个块（蓄水池抽样），内存占用与文件大小无关。
+        """
+        vector_store = self.get_or_create_vector_store(kb_id)
+        if vector_store.embedding_model.is_fitted or vector_store.load_embedding_state():
+            return
+        sample_size = get_kb_setting('EMBEDDING_FIT_SAMPLE_SIZE', 5000)
+        rng = random.Random(0)
+        sample = []
+        count = 0
+        segments, metadata = self.document_processor.iter_file(file_path)
+        for count, chunk in enumerate(text_splitter.split_stream(segments, metadata), 1):
+            if len(sample) < sample_size:
+                sample.append(chunk['content'])
+            else:
+                slot = rng.randrange(count)
+                if slot < sample_size:
+                    sample[slot] = chunk['content']
+        if sample:
+            vector_store.ensure_fitted(sample, corpus_size=count)
+
+    def get_text_splitter(self, kb_id: int) -> TextSplitter:
+        """按知识库的分块大小和重叠创建分块器"""
+        from apps.knowledge.models import KnowledgeBase
+        
+        row = KnowledgeBase.objects.filter(id=kb_id).values_list('chunk_size', 'chunk_overlap').first()
+        return TextSplitter(*row) if row else self.text_splitter
+    
+    def _ingest_chunks(self, kb_id: int, document_id: Optional[int], chunks: Iterable[Dict], ingest_stats: Dict):
+        """按批编码并写库，耗时和块数累加到 ingest_stats"""
+        from apps.knowledge.models import DocumentChunk
+        
+        if document_id:
+            # 任务重试时清理上次未完成的块
+            DocumentChunk.objects.filter(document_id=document_id).delete()
+        
+        vector_store = self.get_or_create_vector_store(kb_id)
+        batch_size = get_kb_setting('INGEST_BATCH_SIZE', 256)
+        for key in ('chunk_count', 'embed_time', 'index_time', 'persist_time'):
+            ingest_stats.setdefault(key, 0.0 if key != 'chunk_count' else 0)
+        batch = []
+        
+        def flush():
+            stats = vector_store.add_documents(batch)
+            for key in ('chunk_count', 'embed_time', 'index_time', 'persist_time'):
+                ingest_stats[key] += stats[key]
+            batch.clear()
+        
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    
+    def _complete_document(self, kb_id: int, document_id: Optional[int], chunk_count: int):
+        """先标记文档完成再递增版本号，保证其他进程同步时能看到该文档"""
+        if document_id:
+            from django.utils import timezone
+            from apps.knowledge.models import Document
+            Document.objects.filter(id=document_id).update(
+                status='completed',
+                chunk_count=chunk_count,
+                processed_at=timezone.now()
+            )
+            self._bump_kb_version(kb_id)
+    
+    @staticmethod
+    def _discard_chunks(document_id: Optional[int]):
+        """处理失败时删除已写入的部分块"""
+        if document_id:
+            from apps.knowledge.models import DocumentChunk
+            DocumentChunk.objects.filter(document_id=document_id).delete()
+    
+    @staticmethod
+    def _ingest_result(ingest_stats: Dict, metadata: Dict, start_time: float) -> Dict:
+        chunk_count = ingest_stats['chunk_count']
+        total_time = time.time() - start_time
+        for key in ('parse_time', 'split_time', 'embed_time', 'index_time', 'persist_time'):
+            ingest_stats[key] = round(ingest_stats.get(key, 0.0), 3)
+        ingest_stats['total_time'] = round(total_time, 3)
+        ingest_stats['chunks_per_sec'] = round(chunk_count / total_time, 1) if total_time > 0 else 0.0
+        logger.info(f"文档入库完成: {chunk_count} 个块, {ingest_stats['chunks_per_sec']} 块/秒, {ingest_stats}")
+        
+        return {
+            'success': True,
+            'chunk_count': chunk_count,
+            'content_length': metadata.get('size', 0),
+            'metadata': metadata,
+            'ingest_stats': ingest_stats
+        }
+    
     async def ask_question(self, kb_id: int, question: str, config_id: Optional[int] = None, 
-                          top_k: int = 5, threshold: float = 0.5) -> Dict:
-        """智能问答"""
-        import time
+                          top_k: int = 5, threshold: float = 0.5, record_fields: Optional[Dict] = None) -> Dict:
+        """智能问答
+        
+        新生成的回答可供语义缓存复用时，向 record_fields 中写入随问答记录保存的字段
+        （kb_version、question_embedding、embedding_version、cache_scope），返回结果本身不含这些字段。
+        """
         start_time = time.time()
         
         try:
-            # 获取向量存储
-            vector_store = self.get_or_create_vector_store(kb_id)
-            
-            # 每次问答都重新检查并加载文档，确保文档数据是最新的
-            logger.info(f"知识库 {kb_id} 开始检查文档状态")
-            
-            # 强制重新加载文档数据以确保数据完整性
-            loaded_count = self.manually_load_documents(kb_id)
-            logger.info(f"知识库 {kb_id} 重新加载了 {loaded_count} 个文档块")
-            
-            # 重新获取向量存储（确保获取最新数据）
-            vector_store = self.get_or_create_vector_store(kb_id)
+            prepared = await self._prepare_answer(kb_id, question, config_id, top_k, threshold, start_time)
+            if 'result' in prepared:
+                return self._public_result(prepared['result'])
             
-            # 检索相关文档 - 使用更低的阈值确保能检索到文档
-            relevant_docs = vector_store.similarity_search(question, top_k=top_k, threshold=max(threshold, 0.1))
+            # 使用构建好的完整提示词
+            llm_result = await prepared['llm'].generate_response(prepared['prompt'], "")
+            return self._public_result(self._finish_answer(prepared, llm_result, start_time, record_fields))
             
-            logger.info(f"检索到 {len(relevant_docs)} 个相关文档片段，阈值: {max(threshold, 0.1)}")
-            
-            # 如果没有检索到文档，尝试降低阈值再次检索
-            if not relevant_docs and threshold > 0.0:
-                logger.info("未找到相关文档，尝试降低阈值重新检索")
-                relevant_docs = vector_store.similarity_search(question, top_k=top_k, threshold=0.0)
-                logger.info(f"降低阈值后检索到 {len(relevant_docs)} 个文档片段")
-            
-            # 构建上下文 - 强制使用知识库内容，确保总是有内容
-            context = ""
-            context_info = ""
-            
-            # 首先尝试使用检索到的相关文档
-            if relevant_docs:
-                context = "\n".join([doc['content'] for doc in relevant_docs])
-                context_info = f"基于知识库中的 {len(relevant_docs)} 个相关文档片段："
-                logger.info(f"使用相关文档构建上下文，长度: {len(context)} 字符")
+        except Exception as e:
+            logger.error(f"问答失败: {e}")
+            return self._public_result(self._error_result(e, start_time))
+    
+    async def ask_question_stream(self, kb_id: int, question: str, config_id: Optional[int] = None,
+                                  top_k: int = 5, threshold: float = 0.5,
+                                  record_fields: Optional[Dict] = None) -> AsyncIterator[Dict]:
+        """流式智能问答
+        
+        依次产出 {'type': 'sources', 'sources': [...]}、若干 {'type': 'delta', 'content': 文本片段}，
+        最后产出 {'type': 'done', 'result': 与 ask_question 相同结构的完整结果}。
+        命中缓存或未配置大模型时整段回答作为一个片段产出。record_fields 同 ask_question。
+        """
+        start_time = time.time()
+        
+        try:
+            prepared = await self._prepare_answer(kb_id, question, config_id, top_k, threshold, start_time)
+        except Exception as e:
+            logger.error(f"问答失败: {e}")
+            result = self._error_result(e, start_time)
+            yield {'type': 'delta', 'content': result['answer']}
+            yield {'type': 'done', 'result': self._public_result(result)}
+            return
+        
+        if 'result' in prepared:
+            result = prepared['result']
+            yield {'type': 'sources', 'sources': result['sources']}
+            yield {'type': 'delta', 'content': result['answer']}
+            yield {'type': 'done', 'result': self._public_result(result)}
+            return
+        
+        yield {'type': 'sources', 'sources': self._format_sources(prepared['relevant_docs'])}
+        llm = prepared['llm']
+        parts = []
+        usage = {}
+        try:
+            async for delta in llm.stream_generate(prepared['prompt'], usage):
+                parts.append(delta)
+                yield {'type': 'delta', 'content': delta}
+            llm_result = {'answer': ''.join(parts), 'model_used': llm.model_name, 'success': True}
+        except Exception as e:
+            logger.error(f"LLM 流式生成失败: {e}")
+            error_text = f"生成回答时出错: {str(e)}"
+            yield {'type': 'delta', 'content': error_text}
+            llm_result = {'answer': ''.join(parts) + error_text, 'model_used': llm.model_name, 'success': False}
+        llm_result['tokens_used'] = usage.get('total_tokens', 0)
+        result = self._finish_answer(prepared, llm_result, start_time, record_fields)
+        yield {'type': 'done', 'result': self._public_result(result)}
+    
+    async def _prepare_answer(self, kb_id: int, question: str, config_id: Optional[int], top_k: int,
+                              threshold: float, start_time: float) -> Dict:
+        """问答的检索阶段：同步索引、查询缓存、检索并构建提示词
+        
+        命中缓存或无需调用大模型时返回 {'result': 完整结果}；
+        否则返回交给 _finish_answer 的上下文，其中 'llm' 为大模型接口，'prompt' 为完整提示词。
+        """
+        # 按版本号增量同步索引，版本未变化时不访问文档块表
+        loaded_count = await run_db(self.sync_knowledge_base, kb_id)
+        logger.info(f"知识库 {kb_id} 当前索引共 {loaded_count} 个文档块")
+        
+        # 同一版本的知识库上重复的问题直接返回缓存的回答
+        cache_key = None
+        cache_scope = AnswerCache.make_scope(config_id, top_k, threshold)
+        if kb_id in self.kb_versions:
+            cache_key = AnswerCache.make_key(kb_id, self.kb_versions[kb_id], question, config_id, top_k, threshold)
+            cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"问答缓存命中: 知识库 {kb_id}, 问题: {question[:50]}")
+                return {'result': {**cached, 'cached': True, 'cache_type': 'exact', 'prompt_tokens': 0, 'tokens_used': 0,
+                                   'response_time': round(time.time() - start_time, 3)}}
+        
+        # 未命中时会查询数据库；API嵌入模型编码问题是阻塞的HTTP请求，两者都不在事件循环线程中执行
+        vector_store = await run_db(self.get_or_create_vector_store, kb_id)
+        
+        # 问题向量同时用于语义缓存和检索
+        model = vector_store.embedding_model
+        question_vector = None
+        if model.is_fitted:
+            question_vector = normalize_rows(await run_db(model.encode, [question]))[0]
+        if cache_key is not None and question_vector is not None and self.semantic_cache is not None:
+            cached = await run_db(
+                self._semantic_cache_lookup, kb_id, cache_scope, self.kb_versions[kb_id], model.version, question_vector
+            )
+            if cached is not None:
+                # 提升到精确缓存时去掉语义命中特有的字段，之后的精确命中不带相似问题和相似度
+                self.answer_cache.set(cache_key, {
+                    key: value for key, value in cached.items() if key not in self.SEMANTIC_HIT_KEYS
+                })
+                return {'result': {**cached, 'response_time': round(time.time() - start_time, 3)}}
+        
+        # 检索相关文档 - 使用更低的阈值确保能检索到文档
+        # 检索结果的块内容需要读取数据库，整个检索交给数据库线程池
+        relevant_docs = await run_db(
+            vector_store.similarity_search, question, top_k=top_k, threshold=max(threshold, 0.1), query_vector=question_vector
+        )
+        
+        logger.info(f"检索到 {len(relevant_docs)} 个相关文档片段，阈值: {max(threshold, 0.1)}")
+        
+        # 如果没有检索到文档，尝试降低阈值再次检索
+        if not relevant_docs and threshold > 0.0:
+            logger.info("未找到相关文档，尝试降低阈值重新检索")
+            relevant_docs = await run_db(
+                vector_store.similarity_search, question, top_k=top_k, threshold=0.0, query_vector=question_vector
+            )
+            logger.info(f"降低阈值后检索到 {len(relevant_docs)} 个文档片段")
+        
+        # 构建上下文 - 强制使用知识库内容，确保总是有内容
+        # 知识库内容按所用模型的token预算拼接：相邻块合并去重叠，按相关度填满预算
+        llm = self.llm_configs.get(config_id) if config_id else None
+        token_budget = llm.context_token_budget() if llm else get_kb_setting('CONTEXT_TOKEN_BUDGET', 3000)
+        context = ""
+        context_info = ""
+        context_tokens = 0
+        
+        # 首先尝试使用检索到的相关文档
+        if relevant_docs:
+            context, context_tokens = build_context(relevant_docs, token_budget)
+            context_info = f"基于知识库中的 {len(relevant_docs)} 个相关文档片段："
+            logger.info(f"使用相关文档构建上下文，长度: {len(context)} 字符，约 {context_tokens} tokens（预算 {token_budget}）")
+        
+        # 如果没有相关文档但有知识库内容，强制使用前几个块
+        snapshot = vector_store.snapshot
+        if not context and len(snapshot):
+            logger.info("没有找到相关文档，强制使用知识库前几个文档块")
             
-            # 如果没有相关文档但有知识库内容，强制使用前几个块
-            if not context and vector_store.chunks:
-                logger.info("没有找到相关文档，强制使用知识库前几个文档块")
-                context = "\n".join(vector_store.chunks[:min(10, len(vector_store.chunks))])
-                context_info = f"基于知识库中的前 {min(10, len(vector_store.chunks))} 个文档片段："
-                logger.info(f"强制构建的上下文长度: {len(context)} 字符")
+            # 同时将前几个块当作relevant_docs处理，保证后续逻辑正确；
+            # 已删除的块读不到，多取一些行再保留前10个，全部读不到时由下面的数据库查询兜底
+            relevant_docs = (await run_db(vector_store.fetch_rows, range(min(50, len(snapshot))), snapshot))[:10]
+            for doc in relevant_docs:
+                doc['score'] = 0.1  # 给一个默认分数
+            context, context_tokens = build_context(relevant_docs, token_budget)
+            context_info = f"基于知识库中的前 {len(relevant_docs)} 个文档片段："
+            logger.info(f"强制构建的上下文长度: {len(context)} 字符，约 {context_tokens} tokens")
+        
+        # 最后的保险：如果仍然没有context，检查是否真的没有数据
+        if not context:
+            # 再次尝试直接从数据库获取一些内容
+            try:
+                from apps.knowledge.models import DocumentChunk
                 
-                # 同时将前几个块当作relevant_docs处理，保证后续逻辑正确
-                relevant_docs = []
-                for i, chunk in enumerate(vector_store.chunks[:min(10, len(vector_store.chunks))]):
-                    relevant_docs.append({
-                        'content': chunk,
-                        'score': 0.1,  # 给一个默认分数
-                        'metadata': vector_store.metadata[i] if i < len(vector_store.metadata) else {},
-                        'index': i
-                    })
-            
-            # 最后的保险：如果仍然没有context，检查是否真的没有数据
-            if not context:
-                # 再次尝试直接从数据库获取一些内容
-                try:
-                    from apps.knowledge.models import DocumentChunk
-                    import threading
-                    
-                    db_content = []
-                    db_chunks_data = []
-                    exception_holder = [None]
-                    
-                    def fetch_db_chunks():
-                        try:
-                            db_chunks = DocumentChunk.objects.filter(
-                                document__knowledge_base_id=kb_id,
-                                document__status='completed'
-                            ).select_related('document')[:5]
-                            
-                            for chunk in db_chunks:
-                                db_content.append(chunk.content)
-                                db_chunks_data.append(chunk)
-                        except Exception as e:
-                            exception_holder[0] = e
-                    
-                    thread = threading.Thread(target=fetch_db_chunks)
-                    thread.start()
-                    thread.join()
-                    
-                    if exception_holder[0]:
-                        raise exception_holder[0]
+                db_chunks_data = await run_db(lambda: list(DocumentChunk.objects.filter(
+                    document__knowledge_base_id=kb_id,
+                    document__status='completed'
+                ).only('content', 'document_id', 'chunk_index')[:5]))
+                
+                if db_chunks_data:
+                    logger.warning("向量存储为空但数据库有数据，直接从数据库获取")
                     
-                    if db_content:
-                        logger.warning("向量存储为空但数据库有数据，直接从数据库获取")
-                        context = "\n".join(db_content)
-                        context_info = f"直接从数据库获取的 {len(db_content)} 个文档片段："
-                        logger.info(f"从数据库直接获取的上下文长度: {len(context)} 字符")
-                        
-                        # 构造相应的relevant_docs
-                        relevant_docs = []
-                        for i, chunk in enumerate(db_chunks_data):
-                            relevant_docs.append({
-                                'content': chunk.content,
-                                'score': 0.05,  # 更低的分数表示这是直接获取的
-                                'metadata': {'document_id': chunk.document.id, 'chunk_index': chunk.chunk_index},
-                                'index': i
-                            })
-                    else:
-                        context = ""
-                        context_info = "知识库中没有找到任何文档"
-                        logger.error(f"知识库 {kb_id} 数据库中也没有任何文档内容")
-                except Exception as e:
-                    logger.error(f"从数据库获取备用内容失败: {e}")
+                    # 构造相应的relevant_docs
+                    relevant_docs = []
+                    for i, chunk in enumerate(db_chunks_data):
+                        relevant_docs.append({
+                            'content': chunk.content,
+                            'score': 0.05,  # 更低的分数表示这是直接获取的
+                            'metadata': {'document_id': chunk.document_id, 'chunk_index': chunk.chunk_index},
+                            'index': i
+                        })
+                    context, context_tokens = build_context(relevant_docs, token_budget)
+                    context_info = f"直接从数据库获取的 {len(db_chunks_data)} 个文档片段："
+                    logger.info(f"从数据库直接获取的上下文长度: {len(context)} 字符")
+                else:
                     context = ""
-                    context_info = "知识库读取失败"
+                    context_info = "知识库中没有找到任何文档"
+                    logger.error(f"知识库 {kb_id} 数据库中也没有任何文档内容")
+            except Exception as e:
+                logger.error(f"从数据库获取备用内容失败: {e}")
+                context = ""
+                context_info = "知识库读取失败"
+        
+        # 记录最终的context状态
+        logger.info(f"最终context状态: 长度={len(context)}, 信息={context_info}")
+        if context:
+            logger.info(f"Context前200字符: {context[:200]}...")
+        
+        # 生成回答 - 确保总是将知识库内容传递给大模型
+        if llm:
+            logger.info(f"使用LLM配置ID: {config_id}")
+            logger.info(f"检查上下文状态: context长度={len(context) if context else 0}, 索引块数量={len(vector_store.snapshot)}, relevant_docs数量={len(relevant_docs)}")
             
-            # 记录最终的context状态
-            logger.info(f"最终context状态: 长度={len(context)}, 信息={context_info}")
+            # 现在context应该总是有内容（除非知识库真的为空）
             if context:
-                logger.info(f"Context前200字符: {context[:200]}...")
-            
-            # 生成回答 - 确保总是将知识库内容传递给大模型
-            llm = self.llm_configs.get(config_id) if config_id else None
-            if llm:
-                logger.info(f"使用LLM配置ID: {config_id}")
-                logger.info(f"检查上下文状态: context长度={len(context) if context else 0}, vector_store.chunks数量={len(vector_store.chunks)}, relevant_docs数量={len(relevant_docs)}")
-                
-                # 最后的强制保险：如果context仍然为空，直接从数据库强制获取
-                if not context:
-                    logger.error("严重警告: context为空，执行最终兜底操作")
-                    try:
-                        from apps.knowledge.models import DocumentChunk
-                        import threading
-                        
-                        emergency_content = []
-                        exception_holder = [None]
-                        
-                        def fetch_emergency_chunks():
-                            try:
-                                emergency_chunks = DocumentChunk.objects.filter(
-                                    document__knowledge_base_id=kb_id,
-                                    document__status='completed'
-                                )[:3]
-                                
-                                for chunk in emergency_chunks:
-                                    emergency_content.append(chunk.content)
-                            except Exception as e:
-                                exception_holder[0] = e
-                        
-                        thread = threading.Thread(target=fetch_emergency_chunks)
-                        thread.start()
-                        thread.join()
-                        
-                        if exception_holder[0]:
-                            raise exception_holder[0]
-                        
-                        if emergency_content:
-                            context = "\n".join(emergency_content)
-                            logger.error(f"紧急兜底: 从数据库获取到 {len(emergency_content)} 个块")
-                    except Exception as emergency_e:
-                        logger.error(f"紧急兜底也失败: {emergency_e}")
-                
-                # 现在context应该总是有内容（除非知识库真的为空）
-                if context:
-                    logger.info(f"使用有内容的context构建提示词，context前100字符: {context[:100]}")
-                    # 构建极其明确的提示，强制大模型按格式回答
-                    enhanced_question = f"""【严格指令 - 必须遵守】你是专业知识库助手，必须严格按照以下格式回答，不得违反：
+                logger.info(f"使用有内容的context构建提示词，context前100字符: {context[:100]}")
+                # 构建极其明确的提示，强制大模型按格式回答
+                enhanced_question = f"""【严格指令 - 必须遵守】你是专业知识库助手，必须严格按照以下格式回答，不得违反：
 
 🔴 强制要求：
 1. 第一句话必须是："基于知识库内容，我为您回答："
@@ -1089,10 +2320,10 @@ class RAGSystem:
 ⚠️ 重要提醒：无论如何都必须以"基于知识库内容，我为您回答："开头，这是不可违反的规则！
 
 现在请严格按照格式开始回答："""
-                else:
-                    # 这种情况现在应该极少发生
-                    logger.error("即使经过所有兜底措施，context仍然为空！这不应该发生。")
-                    enhanced_question = f"""【严格指令】知识库助手必须回答：
+            else:
+                # 这种情况现在应该极少发生
+                logger.error("即使经过所有兜底措施，context仍然为空！这不应该发生。")
+                enhanced_question = f"""【严格指令】知识库助手必须回答：
 
 第一句话必须是："基于知识库内容，我为您回答："
 然后说明："当前知识库系统出现问题，无法读取文档内容。"
@@ -1100,75 +2331,179 @@ class RAGSystem:
 用户问题：{question}
 
 请严格按照上述格式回答。"""
-                
-                logger.info(f"发送给大模型的完整提示长度: {len(enhanced_question)} 字符")
-                logger.info(f"上下文内容预览: {context[:300]}..." if context else "上下文为空")
-                
-                # 使用构建好的完整提示词
-                llm_result = await llm.generate_response(enhanced_question, "")
-                answer = llm_result.get('answer', '生成回答失败')
-                model_used = llm_result.get('model_used', f"config_{config_id}" if config_id else "default")
-            else:
-                logger.warning(f"没有找到LLM配置，配置ID: {config_id}")
-                # 如果没有配置LLM，才返回"未找到相关信息"的提示
-                if not relevant_docs:
-                    response_time = round((time.time() - start_time), 3)
-                    return {
-                        'answer': '抱歉，我在知识库中没有找到相关信息，且未配置大语言模型。请配置模型以获得智能回答。',
-                        'sources': [],
-                        'confidence': 0.0,
-                        'retrieved_chunks': [],
-                        'model_used': f"config_{config_id}" if config_id else "default",
-                        'response_time': response_time
-                    }
-                else:
-                    answer = f"基于知识库内容，找到了 {len(relevant_docs)} 个相关片段，但未配置大语言模型。请配置模型以获得智能回答。"
-                    model_used = f"config_{config_id}" if config_id else "default"
-            
-            response_time = round((time.time() - start_time), 3)  # 保持为秒，保留3位小数
-            
-            logger.info(f"问答完成: 回答长度={len(answer)}, 源文档数={len(relevant_docs)}, 使用模型={model_used}, 响应时间={response_time}秒")
-            
-            return {
-                'answer': answer,
-                'sources': [
-                    {
-                        'content': doc['content'][:200] + '...' if len(doc['content']) > 200 else doc['content'],
-                        'score': doc['score'],
-                        'metadata': doc['metadata']
-                    }
-                    for doc in relevant_docs
-                ],
-                'confidence': relevant_docs[0]['score'] if relevant_docs else 0.0,
-                'retrieved_chunks': relevant_docs,
-                'model_used': model_used,
-                'response_time': response_time
-            }
             
-        except Exception as e:
-            logger.error(f"问答失败: {e}")
-            response_time = round((time.time() - start_time), 3)  # 保持为秒，保留3位小数
-            return {
-                'answer': f'查询过程中出现错误: {str(e)}',
+        prepared = {
+            'config_id': config_id,
+            'cache_key': cache_key,
+            'cache_scope': cache_scope,
+            'question_vector': question_vector,
+            'embedding_version': model.version,
+            'relevant_docs': relevant_docs,
+            'has_context': bool(context),
+            'llm': llm
+        }
+        if llm:
+            prepared['prompt_tokens'] = estimate_tokens(enhanced_question)
+            logger.info(f"发送给大模型的完整提示长度: {len(enhanced_question)} 字符，约 {prepared['prompt_tokens']} tokens")
+            logger.info(f"上下文内容预览: {context[:300]}..." if context else "上下文为空")
+            prepared['prompt'] = enhanced_question
+            return prepared
+        
+        logger.warning(f"没有找到LLM配置，配置ID: {config_id}")
+        model_used = f"config_{config_id}" if config_id else "default"
+        # 如果没有配置LLM，才返回"未找到相关信息"的提示
+        if not relevant_docs:
+            return {'result': {
+                'answer': '抱歉，我在知识库中没有找到相关信息，且未配置大语言模型。请配置模型以获得智能回答。',
                 'sources': [],
                 'confidence': 0.0,
                 'retrieved_chunks': [],
-                'model_used': "error",
-                'response_time': response_time
+                'model_used': model_used,
+                'response_time': round((time.time() - start_time), 3)
+            }}
+        answer = f"基于知识库内容，找到了 {len(relevant_docs)} 个相关片段，但未配置大语言模型。请配置模型以获得智能回答。"
+        return {'result': self._finish_answer(prepared, {'answer': answer, 'model_used': model_used, 'success': True}, start_time)}
+    
+    def _finish_answer(self, prepared: Dict, llm_result: Dict, start_time: float,
+                       record_fields: Optional[Dict] = None) -> Dict:
+        """组装问答结果，成功的回答写入缓存，语义缓存需要的字段写入 record_fields"""
+        relevant_docs = prepared['relevant_docs']
+        config_id = prepared['config_id']
+        cache_key = prepared['cache_key']
+        answer = llm_result.get('answer', '生成回答失败')
+        model_used = llm_result.get('model_used', f"config_{config_id}" if config_id else "default")
+        response_time = round((time.time() - start_time), 3)  # 保持为秒，保留3位小数
+        
+        logger.info(f"问答完成: 回答长度={len(answer)}, 源文档数={len(relevant_docs)}, 使用模型={model_used}, 响应时间={response_time}秒")
+        
+        result = {
+            'answer': answer,
+            'sources': self._format_sources(relevant_docs),
+            'confidence': relevant_docs[0]['score'] if relevant_docs else 0.0,
+            'retrieved_chunks': relevant_docs,
+            'model_used': model_used,
+            'response_time': response_time,
+            'prompt_tokens': prepared.get('prompt_tokens', 0),
+            # API未返回用量时按提示词和回答估算
+            'tokens_used': llm_result.get('tokens_used') or (
+                prepared.get('prompt_tokens', 0) + estimate_tokens(answer) if prepared['llm'] else 0
+            )
+        }
+        # 大模型调用失败或没有可用上下文时不缓存
+        cacheable = llm_result.get('success', False) and (prepared['llm'] is None or prepared['has_context'])
+        if cache_key is not None and cacheable:
+            # 缓存副本，调用方修改返回的结果不影响缓存项
+            self.answer_cache.set(cache_key, dict(result))
+            if record_fields is not None and prepared['question_vector'] is not None and prepared['llm']:
+                # 由调用方随问答记录保存，供语义缓存匹配
+                record_fields.update({
+                    'kb_version': cache_key[1],
+                    'question_embedding': prepared['question_vector'],
+                    'embedding_version': prepared['embedding_version'],
+                    'cache_scope': prepared['cache_scope']
+                })
+        return result
+    
+    # 所有问答结果（新生成、精确缓存、语义缓存、出错）都包含的字段及其默认值
+    RESULT_DEFAULTS = {
+        'cached': False,
+        'cache_type': None,
+        'matched_question': None,
+        'similarity': None,
+        'prompt_tokens': 0,
+        'tokens_used': 0
+    }
+    # 只随问答记录保存、不返回给调用方的字段
+    INTERNAL_RESULT_KEYS = ('question_embedding', 'kb_version', 'embedding_version', 'cache_scope')
+    # 只属于语义缓存命中的字段
+    SEMANTIC_HIT_KEYS = ('matched_question', 'similarity')
+    
+    @classmethod
+    def _public_result(cls, result: Dict) -> Dict:
+        """补齐默认字段并去掉内部字段，命中缓存与否返回的结构相同"""
+        return {
+            **cls.RESULT_DEFAULTS,
+            **{key: value for key, value in result.items() if key not in cls.INTERNAL_RESULT_KEYS}
+        }
+    
+    @staticmethod
+    def _error_result(error: Exception, start_time: float) -> Dict:
+        return {
+            'answer': f'查询过程中出现错误: {str(error)}',
+            'sources': [],
+            'confidence': 0.0,
+            'retrieved_chunks': [],
+            'model_used': "error",
+            'response_time': round((time.time() - start_time), 3)  # 保持为秒，保留3位小数
+        }
+    
+    @staticmethod
+    def _format_sources(relevant_docs: List[Dict]) -> List[Dict]:
+        """返回给前端的来源列表，内容截取前200字符"""
+        return [
+            {
+                'content': doc['content'][:200] + '...' if len(doc['content']) > 200 else doc['content'],
+                'score': doc['score'],
+                'metadata': doc['metadata']
             }
+            for doc in relevant_docs
+        ]
+    
+    def _semantic_cache_lookup(self, kb_id: int, cache_scope: str, kb_version: int, embedding_version: str,
+                               question_vector: np.ndarray) -> Optional[Dict]:
+        """在语义缓存中查找以相同模型配置和检索参数回答过的相似问题，命中时按问答记录构造结果（同步方法）"""
+        from apps.knowledge.models import QARecord
+        
+        match = self.semantic_cache.lookup(kb_id, cache_scope, kb_version, embedding_version, question_vector)
+        if match is None:
+            return None
+        record_id, similarity = match
+        record = QARecord.objects.filter(id=record_id).values('question', 'answer', 'retrieved_chunks', 'model_used').first()
+        if record is None:
+            return None
+        relevant_docs = record['retrieved_chunks'] or []
+        logger.info(f"语义缓存命中: 知识库 {kb_id}, 相似度 {similarity:.3f}, 相似问题: {record['question'][:50]}")
+        return {
+            'answer': record['answer'],
+            'sources': self._format_sources(relevant_docs),
+            'confidence': relevant_docs[0]['score'] if relevant_docs else 0.0,
+            'retrieved_chunks': relevant_docs,
+            'model_used': record['model_used'],
+            'cached': True,
+            'cache_type': 'semantic',
+            'prompt_tokens': 0,
+            'tokens_used': 0,
+            'matched_question': record['question'],
+            'similarity': round(similarity, 4)
+        }
     
     def get_knowledge_base_stats(self, kb_id: int) -> Dict:
         """获取知识库统计信息"""
         if kb_id in self.knowledge_bases:
             vector_store = self.knowledge_bases[kb_id]
+            snapshot = vector_store.snapshot
             return {
-                'total_chunks': len(vector_store.chunks),
-                'total_documents': len(set(chunk.get('document_id', 0) for chunk in vector_store.metadata)),
-                'vector_dimension': vector_store.vectors.shape[1] if vector_store.vectors is not None else 0
+                'total_chunks': len(snapshot),
+                'total_documents': len(snapshot.table.document_id_set()),
+                'vector_dimension': snapshot.vectors.shape[1] if snapshot.vectors is not None else 0,
+                'index_version': self.kb_versions.get(kb_id),
+                'embedding_cache': self._cache_stats_summary(vector_store.cache_stats)
             }
         else:
             return {
                 'total_chunks': 0,
                 'total_documents': 0,
-                'vector_dimension': 0
+                'vector_dimension': 0,
+                'index_version': None,
+                'embedding_cache': self._cache_stats_summary({'hits': 0, 'misses': 0})
             }
+
+    @staticmethod
+    def _cache_stats_summary(stats: Dict) -> Dict:
+        """嵌入缓存命中统计（当前进程）"""
+        total = stats['hits'] + stats['misses']
+        return {
+            'hits': stats['hits'],
+            'misses': stats['misses'],
+            'hit_rate': round(stats['hits'] / total, 4) if total else 0.0
+        }
@@ -16,12 +16,15 @@ from .models import (
 class KnowledgeBaseSchema(ModelSchema):
     class Meta:
         model = KnowledgeBase
-        fields = ['id', 'name', 'description', 'created_at', 'updated_at', 'is_active']
+        fields = ['id', 'name', 'description', 'created_at', 'updated_at', 'is_active', 'chunk_size', 'chunk_overlap']
 
 
 class KnowledgeBaseCreateSchema(Schema):
     name: str = Field(..., description="知识库名称")
     description: str = Field("", description="知识库描述")
+    embedding_config_id: Optional[int] = Field(None, description="嵌入模型配置ID（可选，默认使用默认配置）")
+    chunk_size: int = Field(1000, description="分块大小", ge=100, le=5000)
+    chunk_overlap: int = Field(200, description="分块重叠", ge=0, le=500)
 
 
 class DocumentSchema(ModelSchema):
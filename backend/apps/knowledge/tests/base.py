@@ -0,0 +1,44 @@
+"""
+知识库测试的公共数据
+"""
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+
+from apps.knowledge.models import Document, KnowledgeBase
+from apps.knowledge.rag_system_simple import RAGSystem
+from apps.user.models import User
+
+SENTENCES = [
+    '变压器的额定容量是指其长期运行时允许输出的视在功率。',
+    '继电保护装置应满足选择性、速动性、灵敏性和可靠性的要求。',
+    '电力系统的频率调整分为一次调频和二次调频。',
+    '配电线路的巡视周期应根据季节和负荷情况确定。',
+]
+
+
+class KnowledgeBaseMixin:
+    """在临时 MEDIA_ROOT 下创建知识库并写入文档"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='kb-tester', password='x')
+        self.kb = KnowledgeBase.objects.create(name='测试知识库', created_by=self.user, chunk_size=200, chunk_overlap=20)
+
+    def add_document(self, rag_system: RAGSystem, name: str, repeat: int = 20) -> Document:
+        path = os.path.join(self.media_root, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join(SENTENCES[(i + len(name)) % len(SENTENCES)] for i in range(repeat)))
+        document = Document.objects.create(
+            knowledge_base=self.kb, title=name, file_path=path, file_type='txt', uploaded_by=self.user
+        )
+        result = rag_system.process_document(self.kb.id, path, document.id)
+        self.assertTrue(result.get('success'), result)
+        return document
@@ -0,0 +1,63 @@
+"""
+IVF近似检索的测试：校准后的召回率与精确检索对比
+"""
+import os
+import tempfile
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.knowledge.ann_index import IVFIndex
+from apps.knowledge.rag_system_simple import normalize_rows
+
+
+def clustered_vectors(rng, size, dim, clusters, noise):
+    centers = normalize_rows(rng.standard_normal((clusters, dim)).astype(np.float32))
+    vectors = centers[rng.integers(0, clusters, size)] + noise * rng.standard_normal((size, dim)).astype(np.float32)
+    return normalize_rows(vectors), centers
+
+
+def recall_at_k(index, vectors, queries, top_k, nprobe):
+    hits = 0
+    for query in queries:
+        similarities = vectors @ query
+        exact = np.argpartition(-similarities, top_k - 1)[:top_k]
+        found = index.search(vectors, query, top_k=top_k, nprobe=nprobe)[0]
+        hits += len(set(exact.tolist()) & set(found.tolist()))
+    return hits / (top_k * len(queries))
+
+
+class IVFIndexTests(SimpleTestCase):
+    def test_calibrated_nprobe_reaches_target_recall(self):
+        rng = np.random.default_rng(3)
+        vectors, centers = clustered_vectors(rng, 20000, 32, 200, 0.05)
+        index = IVFIndex.train(vectors, seed=3)
+        nprobe = index.calibrate(vectors, target_recall=0.95, top_k=10)
+
+        self.assertIsNotNone(nprobe)
+        self.assertLessEqual(nprobe, index.nlist // 4)
+        # 校准时没有用到的查询
+        queries = centers[rng.integers(0, len(centers), 100)]
+        queries = normalize_rows(queries + 0.06 * rng.standard_normal(queries.shape).astype(np.float32))
+        self.assertGreaterEqual(recall_at_k(index, vectors, queries, 10, nprobe), 0.95)
+
+    def test_unclustered_vectors_are_rejected(self):
+        rng = np.random.default_rng(5)
+        vectors = normalize_rows(rng.standard_normal((20000, 64)).astype(np.float32))
+        index = IVFIndex.train(vectors, seed=5)
+
+        self.assertIsNone(index.calibrate(vectors, target_recall=0.95, top_k=10))
+        self.assertIsNone(index.nprobe)
+
+    def test_nprobe_survives_save_and_copy(self):
+        rng = np.random.default_rng(7)
+        vectors, _ = clustered_vectors(rng, 5000, 16, 50, 0.05)
+        index = IVFIndex.train(vectors, seed=7)
+        nprobe = index.calibrate(vectors)
+        self.assertIsNotNone(nprobe)
+        self.assertEqual(index.copy().nprobe, nprobe)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ivf.npz')
+            index.save(path)
+            self.assertEqual(IVFIndex.load(path).nprobe, nprobe)
@@ -0,0 +1,111 @@
+"""
+问答缓存的测试
+"""
+import asyncio
+from unittest import mock
+
+from django.test import TransactionTestCase
+
+from apps.knowledge.models import QARecord, QASession
+from apps.knowledge.rag_system_simple import LLMInterface, RAGSystem, vector_to_bytes
+
+from .base import KnowledgeBaseMixin
+
+QUESTION = '变压器的额定容量是什么'
+
+
+class AnswerCacheTests(KnowledgeBaseMixin, TransactionTestCase):
+    """问答在线程池中查询数据库，使用 TransactionTestCase 让其他线程看到测试数据"""
+
+    def setUp(self):
+        super().setUp()
+        self.rag_system = RAGSystem()
+        self.add_document(self.rag_system, 'a.txt')
+        for config_id in (1, 2):
+            self.rag_system.configure_llm(config_id, {
+                'model_type': 'api', 'model_name': f'model-{config_id}',
+                'api_key': 'key', 'api_base_url': 'http://llm.invalid'
+            })
+        self.session = QASession.objects.create(knowledge_base=self.kb, user=self.user, session_id='test-session')
+        self.calls = []
+
+        async def generate_response(llm, prompt, context=''):
+            self.calls.append(llm.model_name)
+            return {'answer': f'基于知识库内容，我为您回答：{llm.model_name}', 'model_used': llm.model_name, 'success': True}
+
+        patcher = mock.patch.object(LLMInterface, 'generate_response', generate_response)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ask(self, rag_system: RAGSystem, config_id: int, top_k: int = 5):
+        record_fields = {}
+        result = asyncio.run(rag_system.ask_question(
+            self.kb.id, QUESTION, config_id=config_id, top_k=top_k, threshold=0.1, record_fields=record_fields
+        ))
+        if record_fields:
+            QARecord.objects.create(
+                session=self.session, question=QUESTION, answer=result['answer'],
+                retrieved_chunks=result['retrieved_chunks'], model_used=result['model_used'],
+                response_time=result['response_time'],
+                **{**record_fields, 'question_embedding': vector_to_bytes(record_fields['question_embedding'])}
+            )
+        return result
+
+    def worker(self) -> RAGSystem:
+        """另一个工作进程：进程内缓存为空，大模型配置相同"""
+        rag_system = RAGSystem()
+        rag_system.llm_configs = self.rag_system.llm_configs
+        return rag_system
+
+    def test_exact_cache_is_scoped_by_config(self):
+        first = self.ask(self.rag_system, 1)
+        self.assertFalse(first.get('cached'))
+        self.assertTrue(self.ask(self.rag_system, 1)['cached'])
+
+        other = self.ask(self.rag_system, 2)
+        self.assertFalse(other.get('cached'))
+        self.assertEqual(other['model_used'], 'model-2')
+        self.assertEqual(self.calls, ['model-1', 'model-2'])
+
+    def test_semantic_cache_is_scoped_by_config_and_params(self):
+        self.ask(self.rag_system, 1)
+        self.assertEqual(QARecord.objects.exclude(cache_scope='').count(), 1)
+
+        # 其他工作进程：不同模型配置或不同 top_k 不复用该回答
+        worker = self.worker()
+        self.assertFalse(self.ask(worker, 2).get('cached'))
+        self.assertFalse(self.ask(worker, 1, top_k=3).get('cached'))
+        self.assertEqual(self.calls, ['model-1', 'model-2', 'model-1'])
+
+        hit = self.ask(self.worker(), 1)
+        self.assertEqual(hit['cache_type'], 'semantic')
+        self.assertEqual(hit['model_used'], 'model-1')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_promoted_semantic_hit_is_reported_as_exact(self):
+        self.ask(self.rag_system, 1)
+        worker = self.worker()
+        semantic = self.ask(worker, 1)
+        self.assertEqual(semantic['cache_type'], 'semantic')
+        self.assertEqual(semantic['matched_question'], QUESTION)
+
+        exact = self.ask(worker, 1)
+        self.assertEqual(exact['cache_type'], 'exact')
+        self.assertIsNone(exact['matched_question'])
+        self.assertIsNone(exact['similarity'])
+        self.assertEqual(exact['answer'], semantic['answer'])
+
+    def test_cached_entry_is_not_mutated(self):
+        result = self.ask(self.rag_system, 1)
+        result['answer'] = 'changed'
+        self.assertNotEqual(self.ask(self.rag_system, 1)['answer'], 'changed')
+
+    def test_cached_and_uncached_results_have_same_shape(self):
+        fresh = self.ask(self.rag_system, 1)
+        exact = self.ask(self.rag_system, 1)
+        semantic = self.ask(self.worker(), 1)
+        self.assertEqual((exact['cache_type'], semantic['cache_type']), ('exact', 'semantic'))
+        self.assertEqual(set(fresh), set(exact))
+        self.assertEqual(set(fresh), set(semantic))
+        for key in RAGSystem.INTERNAL_RESULT_KEYS:
+            self.assertNotIn(key, fresh)
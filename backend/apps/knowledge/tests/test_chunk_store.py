@@ -0,0 +1,73 @@
+"""
+列式块元数据的测试：按 (document_id, chunk_index) 精确读取块内容
+"""
+import asyncio
+
+import numpy as np
+from django.test import TestCase
+
+from apps.knowledge.chunk_store import MISSING_DOCUMENT, ChunkTable
+from apps.knowledge.models import DocumentChunk
+from apps.knowledge.rag_system_simple import RAGSystem
+
+from .base import KnowledgeBaseMixin
+
+
+class ChunkTableFetchTests(KnowledgeBaseMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.rag_system = RAGSystem()
+        self.first = self.add_document(self.rag_system, 'a.txt')
+        self.second = self.add_document(self.rag_system, 'b.txt')
+        self.rag_system.sync_knowledge_base(self.kb.id)
+        self.vector_store = self.rag_system.knowledge_bases[self.kb.id]
+
+    def chunk(self, document, chunk_index):
+        return DocumentChunk.objects.get(document=document, chunk_index=chunk_index)
+
+    def test_fetch_reads_exact_pairs_in_request_order(self):
+        table = ChunkTable(
+            [self.second.id, self.first.id, MISSING_DOCUMENT], [0, 1, 0],
+            {self.first.id: ('a.txt', 'txt'), self.second.id: ('b.txt', 'txt')}
+        )
+        with self.assertNumQueries(1):
+            fetched = table.fetch([1, 0, 2])
+
+        self.assertEqual([row for row, _, _ in fetched], [1, 0])
+        self.assertEqual(fetched[0][1], self.chunk(self.first, 1).content)
+        self.assertEqual(fetched[1][1], self.chunk(self.second, 0).content)
+        self.assertEqual((fetched[0][2]['document_id'], fetched[0][2]['chunk_index']), (self.first.id, 1))
+        self.assertEqual((fetched[1][2]['document_id'], fetched[1][2]['chunk_index']), (self.second.id, 0))
+
+    def test_deleted_chunks_are_dropped(self):
+        table = self.vector_store.snapshot.table
+        rows = np.flatnonzero(table.document_ids == self.first.id)[:3]
+        self.chunk(self.first, int(table.chunk_indexes[rows[0]])).delete()
+
+        fetched = table.fetch(rows)
+        self.assertEqual([row for row, _, _ in fetched], rows[1:].tolist())
+        self.assertEqual([meta['chunk_index'] for _, _, meta in fetched], table.chunk_indexes[rows[1:]].tolist())
+
+    def test_search_scores_stay_aligned_when_rows_are_missing(self):
+        snapshot = self.vector_store.snapshot
+        query = self.chunk(self.first, 0).content
+        query_vector = self.vector_store.embedding_model.encode([query])[0]
+        expected = self.vector_store.search_by_vector(query_vector, top_k=5, threshold=0.0, snapshot=snapshot)
+        self.assertEqual(len(expected), 5)
+
+        # 删除排名第一的块，内存索引尚未同步
+        top = expected[0]['metadata']
+        DocumentChunk.objects.filter(document_id=top['document_id'], chunk_index=top['chunk_index']).delete()
+        results = self.vector_store.search_by_vector(query_vector, top_k=5, threshold=0.0, snapshot=snapshot)
+
+        self.assertEqual([result['index'] for result in results], [result['index'] for result in expected[1:]])
+        self.assertEqual([result['score'] for result in results], [result['score'] for result in expected[1:]])
+
+    def test_fetch_rows_refuses_to_block_event_loop(self):
+        async def fetch_in_loop():
+            return self.vector_store.fetch_rows(range(3))
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(fetch_in_loop())
+        self.assertEqual(len(self.vector_store.fetch_rows(range(3))), 3)
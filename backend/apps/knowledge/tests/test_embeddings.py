@@ -0,0 +1,67 @@
+"""
+嵌入API客户端的测试：重试、维度检查、共享请求线程池
+"""
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.knowledge import embeddings
+from apps.knowledge.embeddings import APIEmbedding
+
+
+def response(status_code: int, vectors=None, headers=None):
+    return mock.Mock(
+        status_code=status_code, text='error', headers=headers or {},
+        json=mock.Mock(return_value={'data': [{'index': i, 'embedding': v} for i, v in enumerate(vectors or [])]})
+    )
+
+
+class APIEmbeddingTests(SimpleTestCase):
+
+    def setUp(self):
+        sleep = mock.patch.object(embeddings.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def model(self, responses, dimension=2, batch_size=None):
+        model = APIEmbedding('embed', 'http://embed.invalid/v1', dimension=dimension, batch_size=batch_size)
+        session = mock.Mock()
+        session.post.side_effect = responses
+        model._session = session
+        return model, session
+
+    def test_retries_rate_limit_and_server_errors(self):
+        model, session = self.model([
+            response(429, headers={'Retry-After': '1'}), response(503), response(200, [[1.0, 0.0]])
+        ])
+        np.testing.assert_allclose(model.encode(['a']), [[1.0, 0.0]])
+        self.assertEqual(session.post.call_count, 3)
+        self.assertEqual(self.sleep.call_args_list[0], mock.call(1.0))
+
+    def test_client_errors_are_not_retried(self):
+        model, session = self.model([response(401), response(200, [[1.0, 0.0]])])
+        with self.assertRaisesRegex(Exception, '401'):
+            model.encode(['a'])
+        self.assertEqual(session.post.call_count, 1)
+
+    def test_dimension_mismatch_is_rejected(self):
+        model, _ = self.model([response(200, [[1.0, 0.0, 0.0]])])
+        with self.assertRaisesRegex(Exception, '维度'):
+            model.encode(['a'])
+
+    def test_dimension_defaults_to_first_response(self):
+        model, _ = self.model([response(200, [[1.0, 0.0, 0.0]]), response(200, [[1.0, 0.0]])], dimension=None)
+        model.encode(['a'])
+        self.assertEqual(model.dimension, 3)
+        with self.assertRaisesRegex(Exception, '维度'):
+            model.encode(['b'])
+
+    def test_batches_share_one_request_executor(self):
+        vectors = {'a': [1.0, 0.0], 'b': [0.0, 1.0]}
+        model, _ = self.model(lambda url, json, **kwargs: response(200, [vectors[json['input'][0]]]), batch_size=1)
+        executor = embeddings.get_request_executor()
+        with mock.patch.object(executor, 'map', wraps=executor.map) as executor_map:
+            np.testing.assert_allclose(model.encode(['a', 'b']), [[1.0, 0.0], [0.0, 1.0]])
+        self.assertEqual(executor_map.call_count, 1)
+        self.assertIs(embeddings.get_request_executor(), executor)
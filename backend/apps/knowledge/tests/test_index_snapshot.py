@@ -0,0 +1,87 @@
+"""
+内存索引快照的测试：更新发布新快照，检索持有的快照各部分始终按行对齐
+"""
+import threading
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.knowledge.chunk_store import ChunkTable
+from apps.knowledge.rag_system_simple import VectorStore
+
+DIM = 16
+
+
+def add_document(store: VectorStore, document_id: int, count: int = 5):
+    """追加一个文档的块：向量在 document_id % DIM 维上为1，词频含 doc<document_id>"""
+    table = ChunkTable([document_id] * count, list(range(count)), {document_id: (f'{document_id}.txt', 'txt')})
+    vectors = np.zeros((count, DIM), dtype=np.float32)
+    vectors[:, document_id % DIM] = 1.0
+    store._append(table, vectors, [{'变压器': 1, f'doc{document_id}': 1} for _ in range(count)])
+
+
+def check_aligned(snapshot) -> list:
+    """返回快照中各部分不一致之处"""
+    errors = []
+    table, vectors, keyword_index = snapshot.table, snapshot.vectors, snapshot.keyword_index
+    if vectors is None:
+        return errors if len(table) == len(keyword_index) == 0 else ['向量为空但有块']
+    if not len(table) == len(vectors) == len(keyword_index):
+        return [f'行数不一致: {len(table)} {len(vectors)} {len(keyword_index)}']
+    if not np.array_equal(np.argmax(vectors, axis=1), table.document_ids % DIM):
+        errors.append('向量与块元数据错位')
+    for document_id in table.document_id_set():
+        rows, _ = keyword_index.search(f'doc{document_id}', top_k=len(table))
+        if set(table.document_ids[rows].tolist()) != {document_id}:
+            errors.append(f'关键词索引与块元数据错位: doc{document_id}')
+    rows, _ = VectorStore._vector_candidates(snapshot, np.ones(DIM, dtype=np.float32), len(table), -1.0)
+    if len(rows) and rows.max() >= len(table):
+        errors.append('检索返回的行超出快照')
+    return errors
+
+
+class IndexSnapshotTests(SimpleTestCase):
+
+    def test_held_snapshot_is_unchanged_by_updates(self):
+        store = VectorStore()
+        add_document(store, 1)
+        held = store.snapshot
+        held_vectors = np.array(held.vectors)
+
+        add_document(store, 2)
+        store.remove_documents([1])
+
+        self.assertEqual((len(held), held.table.document_id_set()), (5, {1}))
+        np.testing.assert_array_equal(held.vectors, held_vectors)
+        self.assertEqual(len(held.keyword_index), 5)
+        self.assertEqual(check_aligned(held), [])
+        self.assertEqual((len(store.snapshot), store.snapshot.table.document_id_set()), (5, {2}))
+        self.assertEqual(check_aligned(store.snapshot), [])
+
+    def test_concurrent_readers_always_see_aligned_snapshots(self):
+        store = VectorStore()
+        done = threading.Event()
+        errors = []
+
+        def write():
+            try:
+                for document_id in range(1, 200):
+                    add_document(store, document_id, count=document_id % 7 + 1)
+                    if document_id > 2:
+                        store.remove_documents([document_id - 2])
+            finally:
+                done.set()
+
+        def read():
+            while not done.is_set():
+                errors.extend(check_aligned(store.snapshot))
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        write()
+        for reader in readers:
+            reader.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(store.snapshot.table.document_id_set(), {198, 199})
@@ -0,0 +1,139 @@
+"""
+入库任务队列的测试：领取、心跳超时重新排队
+"""
+import os
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from apps.knowledge.ingestion import (
+    claim_jobs, claim_next_job, enqueue_document, requeue_stale_jobs, run_job, run_jobs, worker_loop
+)
+from apps.knowledge.models import Document, IngestionJob, KnowledgeBase
+from apps.knowledge.rag_system_simple import RAGSystem, VectorStore
+
+from .base import KnowledgeBaseMixin, SENTENCES
+
+
+class IngestionQueueTests(KnowledgeBaseMixin, TestCase):
+
+    def create_document(self, name: str, kb=None, repeat: int = 5) -> Document:
+        path = os.path.join(self.media_root, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join(SENTENCES * repeat))
+        return Document.objects.create(
+            knowledge_base=kb or self.kb, title=name, file_path=path, file_type='txt', uploaded_by=self.user
+        )
+
+    def test_each_job_is_claimed_once(self):
+        first = enqueue_document(self.create_document('a.txt'))
+        second = enqueue_document(self.create_document('b.txt'))
+
+        claimed = [claim_next_job('worker-a'), claim_next_job('worker-b')]
+        self.assertEqual([job.id for job in claimed], [first.id, second.id])
+        self.assertEqual([job.worker for job in claimed], ['worker-a', 'worker-b'])
+        self.assertTrue(all(job.status == 'processing' and job.heartbeat_at for job in claimed))
+        self.assertIsNone(claim_next_job('worker-c'))
+
+    def test_batch_claims_jobs_of_one_knowledge_base(self):
+        other_kb = KnowledgeBase.objects.create(name='其他知识库', created_by=self.user)
+        first = enqueue_document(self.create_document('a.txt'))
+        other = enqueue_document(self.create_document('b.txt', other_kb))
+        third = enqueue_document(self.create_document('c.txt'))
+
+        self.assertEqual([job.id for job in claim_jobs('worker-a', 4)], [first.id, third.id])
+        self.assertEqual([job.id for job in claim_jobs('worker-b', 4)], [other.id])
+        self.assertEqual(claim_jobs('worker-c', 4), [])
+
+    def test_batch_is_parsed_in_parallel(self):
+        jobs = [enqueue_document(self.create_document(name)) for name in ('a.txt', 'b.txt')]
+
+        self.assertEqual(run_jobs(RAGSystem(), claim_jobs('worker-a', 2)), 2)
+        # 任务完成后工作进程写入了新版本的向量文件
+        self.kb.refresh_from_db()
+        manifest = VectorStore.read_manifest(RAGSystem._default_vector_store_dir(self.kb.id))
+        self.assertEqual(manifest['version'], self.kb.version)
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.status, 'completed')
+            self.assertGreater(job.result['chunk_count'], 0)
+            self.assertEqual(job.document.chunks.count(), job.result['chunk_count'])
+
+    def test_large_files_in_batch_are_streamed(self):
+        small = [self.create_document(name) for name in ('a.txt', 'b.txt')]
+        large = self.create_document('c.txt', repeat=50)
+        for document in (small[0], large, small[1]):
+            enqueue_document(document)
+        rag_system = RAGSystem()
+        kb_settings = {**settings.KNOWLEDGE_BASE, 'PARALLEL_PARSE_MAX_BYTES': os.path.getsize(small[0].file_path)}
+
+        with override_settings(KNOWLEDGE_BASE=kb_settings), \
+                mock.patch.object(rag_system, 'process_document', wraps=rag_system.process_document) as single, \
+                mock.patch.object(rag_system, 'process_documents_parallel',
+                                  wraps=rag_system.process_documents_parallel) as parallel:
+            self.assertEqual(run_jobs(rag_system, claim_jobs('worker-a', 3)), 3)
+
+        self.assertEqual([document_id for _, document_id in parallel.call_args.args[1]], [doc.id for doc in small])
+        self.assertEqual([call.args[2] for call in single.call_args_list], [large.id])
+        for job in IngestionJob.objects.all():
+            self.assertEqual((job.status, job.stage, job.progress), ('completed', 'done', 100))
+            self.assertEqual(job.document.chunks.count(), job.result['chunk_count'])
+
+    def test_requeue_only_jobs_without_recent_heartbeat(self):
+        stale = enqueue_document(self.create_document('a.txt'))
+        alive = enqueue_document(self.create_document('b.txt'))
+        claim_next_job('worker-a')
+        claim_next_job('worker-b')
+        # 两个任务开始于很久以前，只有 alive 仍在刷新心跳
+        long_ago = timezone.now() - timedelta(hours=2)
+        IngestionJob.objects.update(started_at=long_ago)
+        IngestionJob.objects.filter(id=stale.id).update(heartbeat_at=long_ago)
+        Document.objects.update(status='processing')
+
+        self.assertEqual(requeue_stale_jobs(300), 1)
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual((stale.status, stale.worker, stale.heartbeat_at), ('pending', '', None))
+        self.assertEqual(stale.document.status, 'pending')
+        self.assertEqual(alive.status, 'processing')
+        self.assertEqual(Document.objects.get(id=alive.document_id).status, 'processing')
+        self.assertEqual(requeue_stale_jobs(300), 0)
+
+    def test_run_job_refreshes_heartbeat_with_progress(self):
+        job = enqueue_document(self.create_document('a.txt'))
+        claimed = claim_next_job('worker-a')
+        IngestionJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        heartbeats = []
+
+        class RecordingRAG:
+            knowledge_bases, kb_versions = {}, {}
+
+            def process_document(self, kb_id, file_path, document_id, progress_callback=None):
+                progress_callback('embedding', 50)
+                heartbeats.append(IngestionJob.objects.get(id=job.id).heartbeat_at)
+                return {'success': True, 'chunk_count': 3}
+
+            def refit_embedding_if_grown(self, kb_id):
+                return None
+
+            def persist_knowledge_base(self, kb_id):
+                return None
+
+        self.assertTrue(run_job(RecordingRAG(), claimed))
+        self.assertGreater(heartbeats[0], timezone.now() - timedelta(minutes=1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result['chunk_count']), ('completed', 3))
+
+    def test_worker_loop_requeues_and_processes_stale_jobs(self):
+        job = enqueue_document(self.create_document('a.txt'))
+        claim_next_job('crashed-worker')
+        IngestionJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(worker_loop('worker-a', once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), ('completed', 'worker-a'))
+        self.assertEqual(job.document.status, 'completed')
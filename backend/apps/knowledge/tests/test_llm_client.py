@@ -0,0 +1,62 @@
+"""
+大模型API共享连接池的关闭测试
+"""
+import asyncio
+import threading
+
+from django.test import SimpleTestCase
+
+from apps.knowledge import llm_client
+from apps.knowledge.views import _iterate_async
+
+
+class SessionCloseTests(SimpleTestCase):
+    URL = 'http://llm.example.com/v1/chat/completions'
+
+    def test_iterate_async_closes_sessions_of_its_own_loop(self):
+        sessions = []
+
+        async def answer():
+            sessions.append(llm_client.get_session(self.URL))
+            yield 'delta'
+
+        # 新线程中没有事件循环，_iterate_async 自建并在结束时关闭
+        thread = threading.Thread(target=lambda: sessions.append(list(_iterate_async(answer()))))
+        thread.start()
+        thread.join()
+
+        session, chunks = sessions
+        self.assertEqual(chunks, ['delta'])
+        self.assertTrue(session.closed)
+
+    def test_close_all_sessions_closes_idle_loops(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def open_session():
+            return llm_client.get_session(self.URL)
+
+        session = loop.run_until_complete(open_session())
+        llm_client.close_all_sessions()
+        self.assertTrue(session.closed)
+        self.assertNotIn(loop, llm_client._sessions)
+
+    def test_asgi_lifespan_shutdown_closes_sessions(self):
+        from edu.asgi import application
+
+        async def serve():
+            session = llm_client.get_session(self.URL)
+            messages = asyncio.Queue()
+            sent = []
+            for message_type in ('lifespan.startup', 'lifespan.shutdown'):
+                messages.put_nowait({'type': message_type})
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await application({'type': 'lifespan'}, messages.get, send)
+            return session, sent
+
+        session, sent = asyncio.run(serve())
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(session.closed)
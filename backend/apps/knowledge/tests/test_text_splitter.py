@@ -0,0 +1,69 @@
+"""
+文本分块器的测试
+"""
+import random
+
+from django.test import SimpleTestCase
+
+from apps.knowledge.rag_system_simple import TextSplitter
+
+
+def legacy_split(text, chunk_size, chunk_overlap):
+    """按句子边界分块之前的实现（按字符数切片，只在“。”处回退）"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunk = text[start:end]
+        if end < len(text):
+            last_period = chunk.rfind('。')
+            if last_period > chunk_size // 2:
+                chunk = chunk[:last_period + 1]
+                end = start + last_period + 1
+        chunks.append({'content': chunk.strip(), 'chunk_index': len(chunks), 'chunk_size': len(chunk)})
+        start = end - chunk_overlap
+    return chunks
+
+
+def random_text(rng, pieces, count):
+    return ''.join(rng.choice(pieces) for _ in range(count))
+
+
+class TextSplitterTests(SimpleTestCase):
+
+    def test_matches_legacy_splitter_on_full_stops(self):
+        """只有“。”作为句末标点且不重叠时，与原分块器切出的块相同"""
+        rng = random.Random(7)
+        pieces = ['变压器的额定容量。', '继电保护装置应满足选择性要求。', '配电线路', '电力系统频率调整分为一次调频和二次调频']
+        for chunk_size in (50, 120, 500):
+            text = random_text(rng, pieces, 600)
+            chunks = TextSplitter(chunk_size, 0).split_text(text)
+            self.assertEqual(
+                [{'content': chunk['content'], **chunk['metadata']} for chunk in chunks],
+                legacy_split(text, chunk_size, 0)
+            )
+
+    def test_stream_matches_whole_text(self):
+        rng = random.Random(11)
+        pieces = ['变压器容量。', '继电保护“选择性”。', 'Ends here. ', 'v1.2 ', '\n', '\n\n## 运行维护\n', '…', '长句子没有标点' * 10]
+        for chunk_size, chunk_overlap in ((60, 0), (200, 50), (400, 100)):
+            splitter = TextSplitter(chunk_size, chunk_overlap)
+            text = random_text(rng, pieces, 800)
+            segments = []
+            position = 0
+            while position < len(text):
+                size = rng.randint(1, 300)
+                segments.append(text[position:position + size])
+                position += size
+            self.assertEqual(list(splitter.split_stream(segments)), splitter.split_text(text))
+
+    def test_chunks_end_at_sentence_or_before_heading(self):
+        text = ('继电保护装置应满足选择性要求。' * 20 + '\n## 运行维护\n' + '配电线路的巡视周期按季节确定。' * 30)
+        chunks = TextSplitter(200, 0).split_text(text)
+        self.assertTrue(all(chunk['content'].endswith('。') for chunk in chunks))
+        self.assertTrue(any(chunk['content'].startswith('## 运行维护') for chunk in chunks))
+
+        # 重叠部分从句子开头开始
+        chunks = TextSplitter(200, 40).split_text(text)
+        for chunk in chunks[1:]:
+            self.assertTrue(chunk['content'].startswith(('继电保护', '配电线路', '## 运行维护')), chunk['content'][:20])
@@ -0,0 +1,143 @@
+"""
+内存索引与共享向量文件的测试
+"""
+import os
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from apps.knowledge.ann_index import IVFIndex
+from apps.knowledge.models import Document, DocumentChunk, KnowledgeBase
+from apps.knowledge.rag_system_simple import RAGSystem, VectorStore, align_rows
+
+from .base import KnowledgeBaseMixin, SENTENCES
+
+class SharedVectorFileTests(KnowledgeBaseMixin, TestCase):
+
+    def vector_files(self, version: int):
+        directory = RAGSystem._default_vector_store_dir(self.kb.id)
+        return [name for name in os.listdir(directory) if name.startswith(f'vectors-{version}-')]
+
+    def test_workers_share_one_file_after_update(self):
+        ingest, first_web, second_web = RAGSystem(), RAGSystem(), RAGSystem()
+        self.add_document(ingest, 'a.txt')
+        self.assertIsNotNone(ingest.persist_knowledge_base(self.kb.id))
+        first_web.sync_knowledge_base(self.kb.id)
+        second_web.sync_knowledge_base(self.kb.id)
+
+        # 入库工作进程写入新版本的文件后，两个问答进程都做增量同步
+        self.add_document(ingest, 'b.txt')
+        version = KnowledgeBase.objects.get(id=self.kb.id).version
+        self.assertEqual(ingest.persist_knowledge_base(self.kb.id)['version'], version)
+        self.assertIsNone(ingest.persist_knowledge_base(self.kb.id))
+        first_web.sync_knowledge_base(self.kb.id)
+        second_web.sync_knowledge_base(self.kb.id)
+
+        first = first_web.knowledge_bases[self.kb.id].vectors
+        second = second_web.knowledge_bases[self.kb.id].vectors
+        self.assertIsInstance(first, np.memmap)
+        self.assertIsInstance(second, np.memmap)
+        self.assertEqual(os.path.abspath(first.filename), os.path.abspath(second.filename))
+        self.assertEqual(len(self.vector_files(version)), 1)
+
+    def test_sync_does_not_write_or_wait_for_vector_files(self):
+        ingest, web = RAGSystem(), RAGSystem()
+        self.add_document(ingest, 'a.txt')
+        ingest.persist_knowledge_base(self.kb.id)
+        self.add_document(ingest, 'b.txt')
+        version = KnowledgeBase.objects.get(id=self.kb.id).version
+        # 其他进程正在写入该版本
+        directory = RAGSystem._default_vector_store_dir(self.kb.id)
+        open(os.path.join(directory, f'write-{version}.lock'), 'w').close()
+
+        chunk_count = DocumentChunk.objects.filter(document__knowledge_base=self.kb).count()
+        self.assertEqual(web.sync_knowledge_base(self.kb.id), chunk_count)
+        self.assertEqual(self.vector_files(version), [])
+        self.assertEqual(web.kb_versions[self.kb.id], version)
+        self.assertIsNone(ingest.persist_knowledge_base(self.kb.id))
+
+    def test_ann_index_is_trained_only_when_writing_vector_files(self):
+        ingest, web = RAGSystem(), RAGSystem()
+        ann_settings = {**settings.KNOWLEDGE_BASE, 'ANN_INDEX': True, 'ANN_MIN_CHUNKS': 1}
+        with override_settings(KNOWLEDGE_BASE=ann_settings), \
+                mock.patch.object(IVFIndex, 'train', wraps=IVFIndex.train) as train:
+            self.add_document(ingest, 'a.txt')
+            web.sync_knowledge_base(self.kb.id)
+            self.assertEqual(train.call_count, 0)
+            self.assertIsNotNone(ingest.persist_knowledge_base(self.kb.id))
+            self.assertEqual(train.call_count, 1)
+
+            # 新版本的文件写好之前和之后，问答进程的增量同步都不训练
+            self.add_document(ingest, 'b.txt')
+            web.sync_knowledge_base(self.kb.id)
+            self.assertIsNotNone(ingest.persist_knowledge_base(self.kb.id))
+            web.sync_knowledge_base(self.kb.id)
+            self.assertEqual(train.call_count, 1)
+            self.assertEqual(len(web.knowledge_bases[self.kb.id].snapshot),
+                             DocumentChunk.objects.filter(document__knowledge_base=self.kb).count())
+
+    def test_add_documents_only_writes_chunks_of_existing_documents(self):
+        rag_system = RAGSystem()
+        document = self.add_document(rag_system, 'a.txt')
+        vector_store = rag_system.get_or_create_vector_store(self.kb.id)
+        before = len(vector_store.snapshot)
+        chunks = [
+            {'content': '新增的块', 'metadata': {'document_id': document.id, 'chunk_index': 100}},
+            {'content': '已删除文档的块', 'metadata': {'document_id': document.id + 1000, 'chunk_index': 0}},
+        ]
+
+        self.assertEqual(vector_store.add_documents(chunks)['chunk_count'], 1)
+        self.assertEqual(len(vector_store.snapshot), before)
+        self.assertEqual(DocumentChunk.objects.filter(content__in=['新增的块', '已删除文档的块']).count(), 1)
+
+    def test_align_rows(self):
+        keys = np.array([[1, 0], [1, 1], [2, 0]])
+        target = np.array([[2, 0], [1, 0], [1, 1]])
+        order = align_rows(keys, target)
+        np.testing.assert_array_equal(keys[order], target)
+        np.testing.assert_array_equal(align_rows(keys, keys), np.arange(3))
+        self.assertIsNone(align_rows(keys, np.array([[1, 0], [1, 1], [3, 0]])))
+        self.assertIsNone(align_rows(keys, keys[:2]))
+
+
+class EmbeddingFitTests(KnowledgeBaseMixin, TestCase):
+
+    def embedding_state(self):
+        return VectorStore.read_embedding_state(RAGSystem._default_vector_store_dir(self.kb.id))
+
+    def test_first_document_is_fitted_on_whole_file(self):
+        # 文件末尾才出现的字符也进入词汇表，而不是只在第一批块上拟合
+        path = os.path.join(self.media_root, 'long.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(SENTENCES[0] * 40 + '雷电冲击波形' * 10)
+        document = Document.objects.create(
+            knowledge_base=self.kb, title='long.txt', file_path=path, file_type='txt', uploaded_by=self.user
+        )
+        rag_system = RAGSystem()
+        kb_settings = {**settings.KNOWLEDGE_BASE, 'INGEST_BATCH_SIZE': 2}
+        with override_settings(KNOWLEDGE_BASE=kb_settings):
+            result = rag_system.process_document(self.kb.id, path, document.id)
+
+        state = self.embedding_state()
+        self.assertIn('雷', state['vocab'])
+        self.assertEqual(state['fitted_chunks'], result['chunk_count'])
+
+    def test_refit_after_corpus_grows(self):
+        rag_system = RAGSystem()
+        self.add_document(rag_system, 'a.txt')
+        fitted_chunks = self.embedding_state()['fitted_chunks']
+        kb_settings = {**settings.KNOWLEDGE_BASE, 'EMBEDDING_REFIT_GROWTH': 2}
+        with override_settings(KNOWLEDGE_BASE=kb_settings):
+            self.assertIsNone(rag_system.refit_embedding_if_grown(self.kb.id))
+            self.add_document(rag_system, 'b.txt')
+            self.add_document(rag_system, 'c.txt')
+            result = rag_system.refit_embedding_if_grown(self.kb.id)
+
+        chunk_count = DocumentChunk.objects.filter(document__knowledge_base=self.kb).count()
+        self.assertGreaterEqual(chunk_count, 2 * fitted_chunks)
+        self.assertEqual(result['chunk_count'], chunk_count)
+        self.assertEqual(self.embedding_state()['fitted_chunks'], chunk_count)
+        self.assertEqual(set(DocumentChunk.objects.values_list('embedding_version', flat=True)),
+                         {result['embedding_version']})
@@ -8,7 +8,8 @@ from ninja import Router, UploadedFile, File
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from apps.user.models import User
 from django.core.paginator import Paginator
@@ -24,10 +25,10 @@ logger = logging.getLogger(__name__)
 import uuid
 from datetime import datetime
 
-from apps.core import auth, R
+from apps.core import auth, async_auth, R
 from .models import (
     KnowledgeBase, Document, QASession, QARecord, 
-    ModelConfig, EmbeddingConfig
+    ModelConfig, EmbeddingConfig, IngestionJob
 )
 from .schemas import (
     KnowledgeBaseSchema, DocumentSchema, QASessionSchema, 
@@ -36,7 +37,10 @@ from .schemas import (
 )
 
 # 导入RAG系统
-from .rag_system_simple import RAGSystem
+from .rag_system_simple import RAGSystem, get_kb_setting, vector_to_bytes
+from .ingestion import enqueue_document
+from .llm_client import close_sessions
+from . import db_executor, prewarm
 
 # 创建路由器
 router = Router()
@@ -60,6 +64,14 @@ def get_user_from_request(request):
         raise ValueError("用户不存在，请重新登录")
 
 
+async def aget_user_from_request(request):
+    """get_user_from_request 的异步版本，供异步视图使用"""
+    try:
+        return await User.objects.aget(id=request.auth)
+    except User.DoesNotExist:
+        raise ValueError("用户不存在，请重新登录")
+
+
 @router.get("/", summary="知识库系统概览")
 def knowledge_root(request):
     """知识库系统根端点"""
@@ -131,11 +143,17 @@ def create_knowledge_base(request, data: KnowledgeBaseCreateSchema):
         # 获取用户
         user = get_user_from_request(request)
         
+        if data.embedding_config_id and not EmbeddingConfig.objects.filter(id=data.embedding_config_id, is_active=True).exists():
+            return {"success": False, "error": "嵌入模型配置不存在"}
+        
         # 创建数据库记录
         kb = KnowledgeBase.objects.create(
             name=data.name,
             description=data.description,
-            created_by=user
+            created_by=user,
+            embedding_config_id=data.embedding_config_id,
+            chunk_size=data.chunk_size,
+            chunk_overlap=data.chunk_overlap
         )
         
         # 简单返回成功，不需要特殊的RAG系统初始化
@@ -166,6 +184,8 @@ def get_knowledge_base(request, kb_id: int):
                     "name": kb.name,
                     "description": kb.description,
                     "is_active": kb.is_active,
+                    "chunk_size": kb.chunk_size,
+                    "chunk_overlap": kb.chunk_overlap,
                     "created_at": kb.created_at.isoformat() if kb.created_at else None,
                     "updated_at": kb.updated_at.isoformat() if kb.updated_at else None,
                     "created_by": kb.created_by.username if kb.created_by else None,
@@ -196,6 +216,9 @@ def delete_knowledge_base(request, kb_id: int):
         kb.is_active = False
         kb.save()
         
+        # 释放内存索引
+        get_rag_system().delete_knowledge_base(kb_id)
+        
         return {"success": True, "message": "知识库已删除"}
         
     except KnowledgeBase.DoesNotExist:
@@ -288,6 +311,44 @@ def get_document_detail(request, doc_id: int):
         logger.error(f"获取文档详情失败: {e}")
         return {"success": False, "error": str(e)}
 
+@router.get("/documents/{doc_id}/progress", summary="获取文档入库进度")
+def get_document_progress(request, doc_id: int):
+    """获取文档入库进度（最近一次入库任务的状态）"""
+    try:
+        document = Document.objects.get(id=doc_id)
+        job = IngestionJob.objects.filter(document_id=doc_id).order_by('-id').first()
+        
+        job_data = None
+        if job:
+            job_data = {
+                "id": job.id,
+                "status": job.status,
+                "stage": job.stage,
+                "progress": job.progress,
+                "error": job.error,
+                "result": job.result,
+                "created_at": job.created_at.isoformat() if job.created_at else None,
+                "started_at": job.started_at.isoformat() if job.started_at else None,
+                "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+            }
+        
+        return {
+            "success": True,
+            "data": {
+                "document_id": document.id,
+                "status": document.status,
+                "chunk_count": document.chunk_count,
+                "job": job_data
+            }
+        }
+        
+    except Document.DoesNotExist:
+        return {"success": False, "error": "文档不存在"}
+    except Exception as e:
+        logger.error(f"获取文档入库进度失败: {e}")
+        return {"success": False, "error": str(e)}
+
+
 @router.delete("/documents/{doc_id}", summary="删除文档", **auth)
 def delete_document(request, doc_id: int):
     """删除文档"""
@@ -304,8 +365,12 @@ def delete_document(request, doc_id: int):
             os.remove(document.file_path)
         
         # 删除数据库记录
+        kb_id = document.knowledge_base_id
         document.delete()
         
+        # 从内存索引中移除该文档
+        get_rag_system().delete_document(kb_id, doc_id)
+        
         return {"success": True, "message": "文档已删除"}
         
     except Document.DoesNotExist:
@@ -371,7 +436,22 @@ def upload_document(request, kb_id: int, file: UploadedFile = File(...)):
             status='pending'
         )
         
-        # 异步处理文档
+        # 默认加入后台入库队列，由 process_ingestion_jobs 工作进程处理
+        if get_kb_setting('ASYNC_INGESTION', True):
+            job = enqueue_document(document)
+            return {
+                "success": True,
+                "data": {
+                    "document_id": document.id,
+                    "job_id": job.id,
+                    "chunk_count": 0,
+                    "status": "pending",
+                    "file_size": file.size,
+                    "file_name": file.name
+                }
+            }
+        
+        # 同步处理文档
         try:
             rag_system = get_rag_system()
             logger.info(f"开始处理文档: {file.name}, 文件大小: {file.size}")
@@ -379,12 +459,7 @@ def upload_document(request, kb_id: int, file: UploadedFile = File(...)):
             logger.info(f"文档处理结果: {result}")
             
             if result.get('success', False):
-                # 更新文档状态
-                document.status = 'completed'
-                document.chunk_count = result.get('chunk_count', 0)
-                document.processed_at = datetime.now()
-                document.save()
-                
+                # 文档状态已由RAG系统更新为completed
                 return {
                     "success": True,
                     "data": {
@@ -392,7 +467,8 @@ def upload_document(request, kb_id: int, file: UploadedFile = File(...)):
                         "chunk_count": result.get('chunk_count', 0),
                         "status": "completed",
                         "file_size": file.size,
-                        "file_name": file.name
+                        "file_name": file.name,
+                        "ingest_stats": result.get('ingest_stats', {})
                     }
                 }
             else:
@@ -431,6 +507,7 @@ def batch_upload_documents(request, kb_id: int):
             return {"success": False, "error": "没有选择文件"}
         
         results = []
+        pending = []  # 待同步处理的 (结果位置, 文件, 文档)
         allowed_extensions = ['.md', '.pdf', '.txt', '.docx', '.html']
         max_file_size = 500 * 1024 * 1024  # 500MB
         
@@ -495,35 +572,21 @@ def batch_upload_documents(request, kb_id: int):
                     status='pending'
                 )
                 
-                # 处理文档
-                rag_system = get_rag_system()
-                logger.info(f"开始批量处理文档: {file.name}, 文件大小: {file.size}")
-                result = rag_system.process_document(kb_id, file_path, document.id)
-                logger.info(f"批量文档处理结果: {result}")
-                
-                if result.get('success', False):
-                    # 更新文档状态
-                    document.status = 'completed'
-                    document.chunk_count = result.get('chunk_count', 0)
-                    document.processed_at = datetime.now()
-                    document.save()
-                    
+                if get_kb_setting('ASYNC_INGESTION', True):
+                    job = enqueue_document(document)
                     results.append({
                         "file_name": file.name,
                         "success": True,
                         "document_id": document.id,
-                        "chunk_count": result.get('chunk_count', 0),
+                        "job_id": job.id,
+                        "status": "pending",
                         "file_size": file.size
                     })
-                else:
-                    document.status = 'failed'
-                    document.save()
-                    logger.error(f"批量文档处理失败: {result.get('error', '未知错误')}")
-                    results.append({
-                        "file_name": file.name,
-                        "success": False,
-                        "error": f"文档处理失败: {result.get('error', '未知错误')}"
-                    })
+                    continue
+                
+                # 同步处理：文件保存完后依次入库
+                pending.append((len(results), file, document))
+                results.append(None)
                 
             except Exception as e:
                 logger.error(f"批量文档处理异常 {file.name}: {str(e)}", exc_info=True)
@@ -533,6 +596,32 @@ def batch_upload_documents(request, kb_id: int):
                     "error": str(e)
                 })
         
+        # 请求内依次处理，不在Web工作进程中创建进程池（并行解析只在入库工作进程中进行）
+        if pending:
+            rag_system = get_rag_system()
+            logger.info(f"开始批量处理 {len(pending)} 个文档")
+            for position, file, document in pending:
+                result = rag_system.process_document(kb_id, document.file_path, document.id)
+                if result.get('success', False):
+                    # 文档状态已由RAG系统更新为completed
+                    results[position] = {
+                        "file_name": file.name,
+                        "success": True,
+                        "document_id": document.id,
+                        "chunk_count": result.get('chunk_count', 0),
+                        "file_size": file.size,
+                        "ingest_stats": result.get('ingest_stats', {})
+                    }
+                else:
+                    document.status = 'failed'
+                    document.save()
+                    logger.error(f"批量文档处理失败: {result.get('error', '未知错误')}")
+                    results[position] = {
+                        "file_name": file.name,
+                        "success": False,
+                        "error": f"文档处理失败: {result.get('error', '未知错误')}"
+                    }
+        
         # 统计结果
         success_count = sum(1 for r in results if r['success'])
         total_count = len(results)
@@ -561,140 +650,117 @@ def batch_upload_documents(request, kb_id: int):
 
 # ==================== 问答功能 ====================
 
-@router.post("/qa/ask", summary="智能问答", **auth)
-def ask_question(request, data: QARequestSchema):
-    """智能问答接口"""
-    try:
-        # 检查知识库
-        kb = KnowledgeBase.objects.get(id=data.kb_id, is_active=True)
-        user = get_user_from_request(request)
-        
-        # 获取或创建会话
-        if data.session_id:
-            try:
-                session = QASession.objects.get(session_id=data.session_id, user=user)
-            except QASession.DoesNotExist:
-                session = QASession.objects.create(
-                    knowledge_base=kb,
-                    user=user,
-                    session_id=data.session_id,
-                    title=data.question[:50] + "..." if len(data.question) > 50 else data.question
-                )
-        else:
-            # 创建新会话
-            session_id = str(uuid.uuid4())
-            session = QASession.objects.create(
+async def _get_or_create_session(kb, user, session_id: Optional[str], question: str):
+    """获取会话，不存在或未指定时创建新会话"""
+    title = question[:50] + "..." if len(question) > 50 else question
+    if session_id:
+        try:
+            return await QASession.objects.aget(session_id=session_id, user=user)
+        except QASession.DoesNotExist:
+            return await QASession.objects.acreate(
                 knowledge_base=kb,
                 user=user,
                 session_id=session_id,
-                title=data.question[:50] + "..." if len(data.question) > 50 else data.question
+                title=title
             )
+    # 创建新会话
+    return await QASession.objects.acreate(
+        knowledge_base=kb,
+        user=user,
+        session_id=str(uuid.uuid4()),
+        title=title
+    )
+
+
+def _llm_config_dict(model_config) -> Dict:
+    return {
+        'model_type': model_config.model_type,
+        'model_name': model_config.model_name,
+        'api_key': model_config.api_key,
+        'api_base_url': model_config.api_base_url,
+        'max_tokens': model_config.max_tokens,
+        'temperature': model_config.temperature
+    }
+
+
+async def _configure_qa_llm(rag_system, config_id: Optional[int]) -> Optional[int]:
+    """配置LLM - 优先使用指定的配置，否则使用默认的Gemini配置，返回最终使用的配置ID"""
+    config_id_to_use = config_id
+    
+    if config_id_to_use:
+        try:
+            model_config = await ModelConfig.objects.aget(id=config_id_to_use, is_active=True)
+            rag_system.configure_llm(config_id_to_use, _llm_config_dict(model_config))
+        except ModelConfig.DoesNotExist:
+            config_id_to_use = None
+    
+    # 如果没有指定配置ID或指定的配置不存在，使用默认的Gemini配置
+    if not config_id_to_use:
+        try:
+            # 查找激活的Gemini配置
+            gemini_config = await ModelConfig.objects.filter(
+                model_name__icontains='gemini',
+                is_active=True
+            ).afirst()
+            
+            if gemini_config:
+                config_id_to_use = gemini_config.id
+                rag_system.configure_llm(config_id_to_use, _llm_config_dict(gemini_config))
+                logger.info(f"使用默认Gemini配置: {gemini_config.model_name}")
+            else:
+                logger.warning("未找到激活的Gemini配置")
+        except Exception as e:
+            logger.warning(f"无法配置默认Gemini配置: {e}")
+    
+    # 添加调试日志
+    logger.info(f"最终使用的配置ID: {config_id_to_use}")
+    logger.info(f"RAG系统中的LLM配置: {list(rag_system.llm_configs.keys())}")
+    return config_id_to_use
+
+
+async def _save_qa_record(session, question: str, result: Dict, record_fields: Optional[Dict] = None):
+    """保存问答记录；新生成的回答同时保存问题向量（record_fields，由RAG系统填写），供语义缓存匹配"""
+    semantic_fields = {}
+    if record_fields and record_fields.get('question_embedding') is not None and not result.get('cached'):
+        semantic_fields = {**record_fields, 'question_embedding': vector_to_bytes(record_fields['question_embedding'])}
+    return await QARecord.objects.acreate(
+        session=session,
+        question=question,
+        answer=result['answer'],
+        retrieved_chunks=result.get('retrieved_chunks', []),
+        model_used=result['model_used'],
+        response_time=result['response_time'],
+        tokens_used=result.get('tokens_used', 0),
+        **semantic_fields
+    )
+
+
+@router.post("/qa/ask", summary="智能问答", **async_auth)
+async def ask_question(request, data: QARequestSchema):
+    """智能问答接口（异步视图，ASGI下同一工作进程可同时等待多个大模型调用）"""
+    try:
+        # 检查知识库
+        kb = await KnowledgeBase.objects.aget(id=data.kb_id, is_active=True)
+        user = await aget_user_from_request(request)
+        
+        # 获取或创建会话
+        session = await _get_or_create_session(kb, user, data.session_id, data.question)
         
         # 调用RAG系统进行问答
         rag_system = get_rag_system()
-        
-        # 配置LLM - 优先使用指定的配置，否则使用默认的Gemini配置
-        config_id_to_use = data.model_config_id
-        
-        if config_id_to_use:
-            try:
-                model_config = ModelConfig.objects.get(id=config_id_to_use, is_active=True)
-                llm_config = {
-                    'model_type': model_config.model_type,
-                    'model_name': model_config.model_name,
-                    'api_key': model_config.api_key,
-                    'api_base_url': model_config.api_base_url,
-                    'max_tokens': model_config.max_tokens,
-                    'temperature': model_config.temperature
-                }
-                rag_system.configure_llm(config_id_to_use, llm_config)
-            except ModelConfig.DoesNotExist:
-                config_id_to_use = None
-        
-        # 如果没有指定配置ID或指定的配置不存在，使用默认的Gemini配置
-        if not config_id_to_use:
-            try:
-                # 查找激活的Gemini配置
-                gemini_config = ModelConfig.objects.filter(
-                    model_name__icontains='gemini',
-                    is_active=True
-                ).first()
-                
-                if gemini_config:
-                    config_id_to_use = gemini_config.id
-                    llm_config = {
-                        'model_type': gemini_config.model_type,
-                        'model_name': gemini_config.model_name,
-                        'api_key': gemini_config.api_key,
-                        'api_base_url': gemini_config.api_base_url,
-                        'max_tokens': gemini_config.max_tokens,
-                        'temperature': gemini_config.temperature
-                    }
-                    rag_system.configure_llm(config_id_to_use, llm_config)
-                    logger.info(f"使用默认Gemini配置: {gemini_config.model_name}")
-                else:
-                    logger.warning("未找到激活的Gemini配置")
-            except Exception as e:
-                logger.warning(f"无法配置默认Gemini配置: {e}")
-        
-        # 添加调试日志
-        logger.info(f"最终使用的配置ID: {config_id_to_use}")
-        logger.info(f"RAG系统中的LLM配置: {list(rag_system.llm_configs.keys())}")
+        config_id_to_use = await _configure_qa_llm(rag_system, data.model_config_id)
         
         # 执行问答
-        async def run_qa():
-            from asgiref.sync import sync_to_async
-            
-            @sync_to_async
-            def get_doc_count():
-                return Document.objects.filter(
-                    knowledge_base_id=data.kb_id,
-                    status='completed'
-                ).count()
-            
-            try:
-                # 获取知识库的文档数量
-                doc_count = await get_doc_count()
-                
-                # 检查RAG系统中是否已有文档
-                vector_store = rag_system.get_or_create_vector_store(data.kb_id)
-                
-                # 如果向量存储为空但数据库中有文档，则手动加载
-                if len(vector_store.chunks) == 0 and doc_count > 0:
-                    logger.info(f"知识库 {data.kb_id} 的向量存储为空，开始手动加载文档数据")
-                    loaded_count = rag_system.manually_load_documents(data.kb_id)
-                    logger.info(f"成功加载 {loaded_count} 个文档块")
-                else:
-                    logger.info(f"知识库 {data.kb_id} 中已有 {len(vector_store.chunks)} 个文档块")
-                    
-            except Exception as e:
-                logger.error(f"加载文档时出错: {e}")
-                # 继续执行，即使加载失败也允许问答（可能返回通用回答）
-            
-            return await rag_system.ask_question(
-                kb_id=data.kb_id,
-                question=data.question,
-                config_id=config_id_to_use,
-                top_k=data.top_k or 5,
-                threshold=data.threshold or 0.1  # 降低默认阈值，确保能检索到文档
-            )
-        
-        # 在同步环境中运行异步函数
-        try:
-            # 尝试获取当前事件循环
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                # 如果事件循环正在运行，使用asyncio.run_coroutine_threadsafe
-                import concurrent.futures
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(asyncio.run, run_qa())
-                    result = future.result()
-            else:
-                # 如果事件循环没有运行，直接运行
-                result = loop.run_until_complete(run_qa())
-        except RuntimeError:
-            # 如果没有事件循环，创建新的
-            result = asyncio.run(run_qa())
+        # 索引由ask_question按知识库版本号增量同步
+        record_fields = {}
+        result = await rag_system.ask_question(
+            kb_id=data.kb_id,
+            question=data.question,
+            config_id=config_id_to_use,
+            top_k=data.top_k or 5,
+            threshold=data.threshold or 0.1,  # 降低默认阈值，确保能检索到文档
+            record_fields=record_fields
+        )
         
         # 验证返回的结果包含所有必要字段
         required_fields = ['answer', 'sources', 'model_used', 'response_time']
@@ -705,16 +771,7 @@ def ask_question(request, data: QARequestSchema):
             logger.error(f"实际返回的结果: {result}")
             return {"success": False, "error": f"系统内部错误: 缺少必要字段 {missing_fields}"}
         
-        # 保存问答记录
-        qa_record = QARecord.objects.create(
-            session=session,
-            question=data.question,
-            answer=result['answer'],
-            retrieved_chunks=result.get('retrieved_chunks', []),
-            model_used=result['model_used'],
-            response_time=result['response_time'],
-            tokens_used=result.get('tokens_used', 0)
-        )
+        qa_record = await _save_qa_record(session, data.question, result, record_fields)
         
         return {
             "success": True,
@@ -724,6 +781,7 @@ def ask_question(request, data: QARequestSchema):
                 "sources": result['sources'],
                 "model_used": result['model_used'],
                 "response_time": result['response_time'],
+                "cached": result.get('cached', False),
                 "qa_record_id": qa_record.id
             }
         }
@@ -740,6 +798,98 @@ def ask_question(request, data: QARequestSchema):
         return {"success": False, "error": str(e)}
 
 
+def _sse_event(event: str, data: Dict) -> str:
+    """格式化一条服务端事件(SSE)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _iterate_async(async_iterator):
+    """在同步代码中逐个取出异步迭代器的元素
+    
+    WSGI下 StreamingHttpResponse 会把异步迭代器整体读完再返回，流式响应需要转成同步迭代器；
+    复用当前线程的事件循环，使大模型API的连接池在同一工作进程的请求间保持复用。
+    没有可复用的事件循环时新建一个，关闭前先关闭其中创建的连接池。
+    """
+    try:
+        loop = asyncio.get_event_loop()
+        own_loop = loop.is_running() or loop.is_closed()
+    except RuntimeError:
+        own_loop = True
+    if own_loop:
+        loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        if own_loop:
+            loop.run_until_complete(close_sessions())
+            loop.close()
+
+
+@router.post("/qa/ask/stream", summary="智能问答（流式）", **async_auth)
+async def ask_question_stream(request, data: QARequestSchema):
+    """流式智能问答接口，以服务端事件(text/event-stream)返回
+    
+    事件依次为 session（会话ID）、sources（来源）、若干 delta（回答片段）、
+    done（问答记录ID、响应时间、使用的模型和token数）；出错时为 error。
+    回答生成结束后保存问答记录。
+    """
+    try:
+        kb = await KnowledgeBase.objects.aget(id=data.kb_id, is_active=True)
+        user = await aget_user_from_request(request)
+        session = await _get_or_create_session(kb, user, data.session_id, data.question)
+        rag_system = get_rag_system()
+        config_id_to_use = await _configure_qa_llm(rag_system, data.model_config_id)
+    except KnowledgeBase.DoesNotExist:
+        return {"success": False, "error": "知识库不存在"}
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    except Exception as e:
+        logger.error(f"流式问答初始化失败: {e}")
+        return {"success": False, "error": str(e)}
+    
+    async def event_stream():
+        yield _sse_event('session', {'session_id': session.session_id})
+        try:
+            record_fields = {}
+            events = rag_system.ask_question_stream(
+                kb_id=data.kb_id,
+                question=data.question,
+                config_id=config_id_to_use,
+                top_k=data.top_k or 5,
+                threshold=data.threshold or 0.1,
+                record_fields=record_fields
+            )
+            async for event in events:
+                if event['type'] != 'done':
+                    yield _sse_event(event['type'], {key: value for key, value in event.items() if key != 'type'})
+                    continue
+                result = event['result']
+                qa_record = await _save_qa_record(session, data.question, result, record_fields)
+                yield _sse_event('done', {
+                    'qa_record_id': qa_record.id,
+                    'response_time': result['response_time'],
+                    'model_used': result['model_used'],
+                    'tokens_used': result.get('tokens_used', 0),
+                    'cached': result.get('cached', False)
+                })
+        except Exception as e:
+            logger.error(f"流式问答异常: {traceback.format_exc()}")
+            yield _sse_event('error', {'error': str(e)})
+    
+    # ASGI下直接消费异步生成器；WSGI（如开发服务器）下转为同步迭代
+    stream = event_stream() if isinstance(request, ASGIRequest) else _iterate_async(event_stream())
+    response = StreamingHttpResponse(stream, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # 关闭Nginx等反向代理的响应缓冲
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @router.get("/qa/sessions", summary="获取问答会话列表", **auth)
 def get_qa_sessions(request, kb_id: int = None, page: int = 1, size: int = 10):
     """获取用户的问答会话列表"""
@@ -937,40 +1087,22 @@ def delete_model_config(request, config_id: int):
         return {"success": False, "error": str(e)}
 
 
-@router.get("/models/test", summary="测试模型配置", **auth)
-def test_model_config(request, config_id: int):
+@router.get("/models/test", summary="测试模型配置", **async_auth)
+async def test_model_config(request, config_id: int):
     """测试模型配置"""
     try:
-        config = ModelConfig.objects.get(id=config_id, is_active=True)
+        config = await ModelConfig.objects.aget(id=config_id, is_active=True)
         
         # 创建测试用的RAG系统实例
         rag_system = get_rag_system()
         
         # 配置LLM
-        llm_config = {
-            'model_type': config.model_type,
-            'model_name': config.model_name,
-            'api_key': config.api_key,
-            'api_base_url': config.api_base_url,
-            'max_tokens': config.max_tokens,
-            'temperature': config.temperature
-        }
-        
-        rag_system.configure_llm(config_id, llm_config)
+        rag_system.configure_llm(config_id, _llm_config_dict(config))
         
         # 发送测试问题
-        async def test_llm():
-            return await rag_system.llm_configs[config_id].generate_response(
-                "你好，请简单介绍一下你自己。", ""
-            )
-        
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        result = loop.run_until_complete(test_llm())
+        result = await rag_system.llm_configs[config_id].generate_response(
+            "你好，请简单介绍一下你自己。", ""
+        )
         
         return {
             "success": True,
@@ -1003,11 +1135,17 @@ def get_system_stats(request):
         
         # 获取最近的问答记录
         recent_qa = QARecord.objects.order_by('-created_at')[:5]
+        rag_system = get_rag_system()
         
         return {
             "success": True,
             "data": {
                 "stats": stats,
+                # 问答缓存命中率（当前工作进程）
+                "answer_cache": rag_system.answer_cache.stats(),
+                "semantic_cache": rag_system.semantic_cache.stats() if rag_system.semantic_cache else None,
+                # RAG层数据库线程池的排队等待和执行耗时（当前工作进程）
+                "db_executor": db_executor.stats.as_dict(),
                 "recent_qa": [
                     {
                         "question": qa.question[:50] + "..." if len(qa.question) > 50 else qa.question,
@@ -1024,7 +1162,7 @@ def get_system_stats(request):
 
 
 @router.get("/health", summary="系统健康检查")
-def health_check(request):
+async def health_check(request):
     """系统健康检查"""
     try:
         # 检查RAG系统
@@ -1033,30 +1171,25 @@ def health_check(request):
         # 检查数据库连接
         db_status = "ok"
         try:
-            KnowledgeBase.objects.first()
+            await KnowledgeBase.objects.afirst()
         except Exception as e:
             db_status = f"error: {str(e)}"
         
         # 检查模型配置
-        active_models = ModelConfig.objects.filter(is_active=True).count()
+        active_models = await ModelConfig.objects.filter(is_active=True).acount()
+        
+        prewarm_status = prewarm.status()
         
         # 测试问答系统基本功能
         qa_test_status = "ok"
         try:
-            import asyncio
-            async def test_qa():
-                return await rag_system.ask_question(
-                    kb_id=1,
-                    question="健康检查测试",
-                    config_id=None,
-                    top_k=1,
-                    threshold=0.5
-                )
-            
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            test_result = loop.run_until_complete(test_qa())
-            loop.close()
+            test_result = await rag_system.ask_question(
+                kb_id=1,
+                question="健康检查测试",
+                config_id=None,
+                top_k=1,
+                threshold=0.5
+            )
             
             # 检查返回结果是否包含必要字段
             required_fields = ['answer', 'sources', 'model_used', 'response_time']
@@ -1080,6 +1213,9 @@ def health_check(request):
                 "rag_system": "initialized" if rag_system else "not_initialized",
                 "qa_system": qa_test_status,
                 "active_models": active_models,
+                # 索引预热进行中 ready 为 false，此时的问答可能需要等待索引加载；未开启预热时始终为 true
+                "ready": prewarm_status["ready"],
+                "prewarm": prewarm_status,
                 "timestamp": datetime.now().isoformat()
             }
         }
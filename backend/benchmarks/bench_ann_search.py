@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+IVF近似检索基准测试 - 不同 nprobe 下与精确检索对比延迟和 recall@k
+
+最后一行为 calibrate 按 --target-recall 选出的 nprobe（即服务中实际使用的值）在独立查询上的结果。
+
+向量取自带噪声的高斯簇（接近真实文本嵌入的聚类结构），查询为簇中心附近的随机点。
+
+用法（在 backend 目录下运行，无需数据库）：
+    python benchmarks/bench_ann_search.py
+    python benchmarks/bench_ann_search.py --size 1000000 --dim 256 --nprobe 4 8 16 32 64
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.knowledge.ann_index import IVFIndex  # noqa: E402
+from apps.knowledge.rag_system_simple import normalize_rows  # noqa: E402
+
+
+def build_vectors(size, dim, clusters, noise, rng):
+    """生成 size 个围绕 clusters 个中心分布的归一化向量"""
+    centers = normalize_rows(rng.standard_normal((clusters, dim), dtype=np.float32))
+    vectors = centers[rng.integers(0, clusters, size)]
+    vectors += noise * rng.standard_normal((size, dim), dtype=np.float32)
+    return normalize_rows(vectors), centers
+
+
+def exact_search(vectors, query, top_k):
+    similarities = vectors @ query
+    candidates = np.argpartition(-similarities, top_k - 1)[:top_k]
+    return candidates[np.argsort(-similarities[candidates])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IVF近似检索基准测试')
+    parser.add_argument('--size', type=int, default=200000, help='块数量')
+    parser.add_argument('--dim', type=int, default=256, help='向量维度')
+    parser.add_argument('--clusters', type=int, default=2000, help='生成数据的簇数')
+    parser.add_argument('--noise', type=float, default=0.08, help='簇内噪声')
+    parser.add_argument('--nlist', type=int, default=None, help='IVF簇数（默认 4*sqrt(N)）')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64], help='检索的簇数')
+    parser.add_argument('--top-k', type=int, default=10, help='recall@k 的 k')
+    parser.add_argument('--queries', type=int, default=200, help='查询数量')
+    parser.add_argument('--target-recall', type=float, default=0.95, help='校准的目标召回率')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors, centers = build_vectors(args.size, args.dim, args.clusters, args.noise, rng)
+    queries = centers[rng.integers(0, args.clusters, args.queries)]
+    queries = normalize_rows(queries + 1.2 * args.noise * rng.standard_normal(queries.shape, dtype=np.float32))
+
+    start = time.perf_counter()
+    index = IVFIndex.train(vectors, nlist=args.nlist, seed=args.seed)
+    print(f"块数量 {args.size:,}, 维度 {args.dim}, 簇数 {index.nlist}, 训练耗时 {time.perf_counter() - start:.1f} 秒")
+
+    start = time.perf_counter()
+    expected = [exact_search(vectors, query, args.top_k) for query in queries]
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"{'nprobe':>8} {'延迟(ms)':>10} {'加速比':>8} {'recall@' + str(args.top_k):>10}")
+    print(f"{'精确':>8} {exact_ms:>10.2f} {1:>7.1f}x {1.0:>10.4f}")
+
+    def report(label, nprobe):
+        start = time.perf_counter()
+        found = [index.search(vectors, query, top_k=args.top_k, nprobe=nprobe)[0] for query in queries]
+        ann_ms = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(got.tolist()) & set(exp.tolist())) / args.top_k for got, exp in zip(found, expected)])
+        print(f"{label:>8} {ann_ms:>10.2f} {exact_ms / ann_ms:>7.1f}x {recall:>10.4f}")
+
+    for nprobe in args.nprobe:
+        report(nprobe, nprobe)
+
+    start = time.perf_counter()
+    nprobe = index.calibrate(vectors, target_recall=args.target_recall, top_k=args.top_k, min_nprobe=min(args.nprobe))
+    calibrate_s = time.perf_counter() - start
+    if nprobe is None:
+        print(f"校准: recall@{args.top_k} 达不到 {args.target_recall}，不使用索引（耗时 {calibrate_s:.1f} 秒）")
+    else:
+        print(f"校准: nprobe={nprobe}（耗时 {calibrate_s:.1f} 秒）")
+        report(f'校准{nprobe}', nprobe)
+
+
+if __name__ == '__main__':
+    main()
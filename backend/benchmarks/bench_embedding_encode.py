@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SimpleEmbedding 编码基准测试 - 对比逐字符循环编码与向量化批量编码的吞吐（字符/秒）
+
+用法（在 backend 目录下运行，无需数据库）：
+    python benchmarks/bench_embedding_encode.py
+    python benchmarks/bench_embedding_encode.py --chunks 20000 --chunk-size 1000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.knowledge.rag_system_simple import SimpleEmbedding  # noqa: E402
+
+# 电力领域的中文语料片段，随机拼接成接近真实文档的块
+SENTENCES = [
+    "变压器的额定容量是指在规定的使用条件下能够长期连续输出的视在功率。",
+    "继电保护装置应满足选择性、速动性、灵敏性和可靠性的基本要求。",
+    "10kV配电线路的断路器宜采用真空断路器，型号如ZN63A-12。",
+    "根据GB/T 14285-2006《继电保护和安全自动装置技术规程》的规定执行。",
+    "电力系统的频率调整分为一次调频、二次调频和三次调频。",
+    "在中性点不接地系统中发生单相接地故障时，允许继续运行不超过2小时。",
+    "负荷预测是电力系统规划和调度运行的重要基础工作。",
+    "检修人员必须严格执行工作票制度和操作票制度，确保人身安全。",
+    "The rated voltage of the transformer is 110/10.5 kV with ONAN cooling.",
+    "电缆线路的载流量与敷设方式、环境温度和土壤热阻系数有关。",
+]
+
+
+def legacy_encode(model, texts):
+    """原实现：逐文本、逐字符的Python循环"""
+    vectors = []
+    for text in texts:
+        vector = np.zeros(model.vector_size)
+        for char in list(text):
+            if char in model.vocab:
+                vector[model.vocab[char] % model.vector_size] += 1
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        vectors.append(vector)
+    return np.array(vectors, dtype=float)
+
+
+def build_corpus(chunks, chunk_size, seed):
+    """生成指定数量和长度的文本块"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(chunks):
+        parts = []
+        length = 0
+        while length < chunk_size:
+            sentence = rng.choice(SENTENCES)
+            parts.append(sentence)
+            length += len(sentence)
+        corpus.append(''.join(parts)[:chunk_size])
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SimpleEmbedding 编码基准测试')
+    parser.add_argument('--chunks', type=int, default=5000, help='文本块数量')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='每块字符数')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.chunks, args.chunk_size, args.seed)
+    total_chars = sum(len(text) for text in corpus)
+    model = SimpleEmbedding().fit(corpus)
+
+    start = time.perf_counter()
+    expected = legacy_encode(model, corpus)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectors = model.encode(corpus)
+    new_seconds = time.perf_counter() - start
+
+    assert np.allclose(expected, vectors, atol=1e-5), '向量化编码结果与原实现不一致'
+
+    print(f"语料: {args.chunks} 块 x {args.chunk_size} 字符 = {total_chars} 字符")
+    print(f"原实现:     {legacy_seconds:8.3f} 秒  {total_chars / legacy_seconds:14,.0f} 字符/秒")
+    print(f"向量化编码: {new_seconds:8.3f} 秒  {total_chars / new_seconds:14,.0f} 字符/秒")
+    print(f"加速比:     {legacy_seconds / new_seconds:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+向量检索基准测试 - 对比逐条余弦相似度循环与矩阵检索
+
+用法（在 backend 目录下运行，无需数据库）：
+    python benchmarks/bench_similarity_search.py
+    python benchmarks/bench_similarity_search.py --sizes 10000 100000 1000000 --legacy-max 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.knowledge.chunk_store import MISSING_DOCUMENT, ChunkTable  # noqa: E402
+from apps.knowledge.rag_system_simple import IndexSnapshot, VectorStore, normalize_rows  # noqa: E402
+
+
+def legacy_search(vectors, query_vector, top_k):
+    """原实现：Python循环逐条计算余弦相似度后全量排序"""
+    def cosine_sim(a, b):
+        dot_product = np.dot(a, b)
+        norm_a = np.linalg.norm(a)
+        norm_b = np.linalg.norm(b)
+        if norm_a == 0 or norm_b == 0:
+            return 0
+        return dot_product / (norm_a * norm_b)
+
+    similarities = np.array([cosine_sim(query_vector, vector) for vector in vectors])
+    return np.argsort(similarities)[::-1][:top_k]
+
+
+def build_store(size, dim, rng):
+    """构造指定规模的向量存储（各行不属于任何文档，检索结果不读取数据库）"""
+    store = VectorStore()
+    store._publish(IndexSnapshot(
+        table=ChunkTable(np.full(size, MISSING_DOCUMENT), np.arange(size)),
+        vectors=normalize_rows(rng.random((size, dim), dtype=np.float32))
+    ))
+    return store
+
+
+def time_call(func, repeat):
+    """返回多次调用的最短耗时（毫秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='向量检索基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='块数量')
+    parser.add_argument('--dim', type=int, default=300, help='向量维度')
+    parser.add_argument('--top-k', type=int, default=5, help='返回结果数量')
+    parser.add_argument('--repeat', type=int, default=5, help='每项重复次数（取最快一次）')
+    parser.add_argument('--legacy-max', type=int, default=100000, help='超过该规模时跳过原实现（太慢）')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    print(f"{'块数量':>10} {'原实现(ms)':>14} {'矩阵检索(ms)':>14} {'加速比':>10}")
+
+    for size in args.sizes:
+        store = build_store(size, args.dim, rng)
+        query = rng.random(args.dim, dtype=np.float32)
+
+        new_ms = time_call(lambda: store.search_by_vector(query, top_k=args.top_k, threshold=-1.0), args.repeat)
+
+        if size <= args.legacy_max:
+            legacy_ms = time_call(lambda: legacy_search(store.vectors, query, args.top_k), 1)
+            expected = set(int(i) for i in legacy_search(store.vectors, query, args.top_k))
+            got = set(r['index'] for r in store.search_by_vector(query, top_k=args.top_k, threshold=-1.0))
+            assert expected == got, '矩阵检索结果与原实现不一致'
+            print(f"{size:>10} {legacy_ms:>14.1f} {new_ms:>14.2f} {legacy_ms / new_ms:>9.0f}x")
+        else:
+            print(f"{size:>10} {'跳过':>14} {new_ms:>14.2f} {'-':>10}")
+
+
+if __name__ == '__main__':
+    main()
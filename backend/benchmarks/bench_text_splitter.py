@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+文本分块基准测试 - 对比原分块器（按字符数切片、只在“。”处回退）与按句子边界分块的分块器
+
+除耗时外还统计块数、平均块长，以及在句子边界（或标题前）结束的块所占比例。
+
+用法（在 backend 目录下运行，无需数据库）：
+    python benchmarks/bench_text_splitter.py
+    python benchmarks/bench_text_splitter.py --size-mb 20 --chunk-size 500 --chunk-overlap 100
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.knowledge.rag_system_simple import TextSplitter  # noqa: E402
+
+# 电力领域的中英文语料片段，夹杂Markdown标题，随机拼接成多MB的文本
+SENTENCES = [
+    "变压器的额定容量是指在规定的使用条件下能够长期连续输出的视在功率。",
+    "继电保护装置应满足选择性、速动性、灵敏性和可靠性的基本要求！",
+    "10kV配电线路的断路器宜采用真空断路器，型号如ZN63A-12；",
+    "根据GB/T 14285-2006《继电保护和安全自动装置技术规程》的规定执行。",
+    "电力系统的频率调整分为一次调频、二次调频和三次调频？",
+    "The rated voltage of the transformer is 110/10.5 kV with ONAN cooling. ",
+    "Protection relays must clear faults selectively and quickly. ",
+    "\n",
+    "\n\n## 运行维护要求\n",
+]
+SENTENCE_ENDS = ('。', '！', '？', '；', '.', '!', '?', ';', '\n')
+
+
+def legacy_split(text, chunk_size, chunk_overlap):
+    """原实现"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunk = text[start:end]
+        if end < len(text):
+            last_period = chunk.rfind('。')
+            if last_period > chunk_size // 2:
+                chunk = chunk[:last_period + 1]
+                end = start + last_period + 1
+        chunks.append({
+            'content': chunk.strip(),
+            'metadata': {
+                'chunk_index': len(chunks),
+                'chunk_size': len(chunk),
+                'chunk_word_count': len(chunk.split()),
+            }
+        })
+        start = end - chunk_overlap
+    return chunks
+
+
+def build_text(size_mb, seed):
+    """生成约 size_mb 百万字符的文本"""
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    target = int(size_mb * 1_000_000)
+    while length < target:
+        sentence = rng.choice(SENTENCES)
+        parts.append(sentence)
+        length += len(sentence)
+    return ''.join(parts)
+
+
+def ends_at_boundary(content):
+    """块在句末结束，或以标题行结束（下一个块从紧接着的标题开始）"""
+    return content.endswith(SENTENCE_ENDS) or content.rsplit('\n', 1)[-1].startswith('#')
+
+
+def summarize(name, chunks, seconds, text_length):
+    sizes = [chunk['metadata']['chunk_size'] for chunk in chunks]
+    at_boundary = sum(1 for chunk in chunks if ends_at_boundary(chunk['content']))
+    print(
+        f"{name:<10} {seconds:8.3f} 秒 {text_length / seconds / 1e6:8.2f} M字符/秒 "
+        f"{len(chunks):>8} 块  平均 {sum(sizes) / max(len(sizes), 1):7.1f} 字符  "
+        f"句子边界结束 {at_boundary / max(len(chunks), 1):6.1%}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文本分块基准测试')
+    parser.add_argument('--size-mb', type=float, default=10, help='文本大小（百万字符）')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='分块大小')
+    parser.add_argument('--chunk-overlap', type=int, default=200, help='分块重叠')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    args = parser.parse_args()
+
+    text = build_text(args.size_mb, args.seed)
+    print(f"文本: {len(text):,} 字符, 块大小 {args.chunk_size}, 重叠 {args.chunk_overlap}")
+
+    start = time.perf_counter()
+    chunks = legacy_split(text, args.chunk_size, args.chunk_overlap)
+    summarize('原实现', chunks, time.perf_counter() - start, len(text))
+
+    splitter = TextSplitter(args.chunk_size, args.chunk_overlap)
+    start = time.perf_counter()
+    chunks = splitter.split_text(text)
+    summarize('句子边界', chunks, time.perf_counter() - start, len(text))
+
+    # 按1M字符一段流式输入，与整体分块结果一致
+    segments = [text[i:i + 1_000_000] for i in range(0, len(text), 1_000_000)]
+    start = time.perf_counter()
+    streamed = list(splitter.split_stream(segments))
+    summarize('流式', streamed, time.perf_counter() - start, len(text))
+    assert streamed == chunks, '流式分块结果与整体分块不一致'
+
+
+if __name__ == '__main__':
+    main()
@@ -171,3 +171,85 @@ FILE_UPLOAD_TEMP_DIR = None  # 使用系统默认临时目录
 
 # 上传文件权限
 FILE_UPLOAD_PERMISSIONS = 0o644
+
+# 大模型知识库配置
+KNOWLEDGE_BASE = {
+    # 向量矩阵持久化为 KnowledgeBase.vector_store_path 下的 float32 memmap 文件，
+    # 多个 gunicorn worker 共享同一份页缓存，新 worker 无需重新编码即可回答问题
+    'VECTOR_MMAP': True,
+    # 向量文件由入库工作进程在任务完成后写入（文档删除等其他版本变化在其轮询时补写，
+    # 同步入库的部署可定时执行 `python manage.py persist_vector_indexes`）；问答请求只映射已写好的文件，
+    # 当前版本的文件尚未写好时使用内存中的副本。每个版本只由一个进程写入（write-{版本}.lock），
+    # 超过 VECTOR_WRITE_LOCK_TIMEOUT 秒的锁文件视为写入进程已退出
+    'VECTOR_WRITE_LOCK_TIMEOUT': 600,
+    # 按内容哈希缓存块向量（EmbeddingCache），重新上传或重新加载相同文本时不再重新编码
+    'EMBEDDING_CACHE': True,
+    # 混合检索：向量检索与BM25关键词检索（型号、标准编号等）的结果按倒数排名融合，
+    # RRF_K 为融合常数，每路各取 top_k*HYBRID_CANDIDATES 个候选
+    'HYBRID_SEARCH': True,
+    'RRF_K': 60,
+    'HYBRID_CANDIDATES': 4,
+    # 近似最近邻(IVF)检索（默认关闭）：块数达到 ANN_MIN_CHUNKS 的知识库由入库工作进程（或 persist_vector_indexes
+    # 命令）在写入向量文件时训练k-means簇中心，与向量文件一起保存，问答进程只加载已保存的索引、不做训练；
+    # 训练后从 ANN_NPROBE 个簇起逐次翻倍，抽样对比精确检索，选出 recall@10 达到 ANN_MIN_RECALL 的最小检索簇数，
+    # 扫描超过1/4的簇仍达不到时不使用索引（嵌入聚类不明显时常见）。
+    # ANN_NLIST 为簇数（默认 4*sqrt(块数)）。依赖 VECTOR_MMAP。
+    'ANN_INDEX': False,
+    'ANN_MIN_CHUNKS': 100000,
+    'ANN_NPROBE': 16,
+    'ANN_MIN_RECALL': 0.95,
+    # 'ANN_NLIST': 1024,
+    # 问答结果缓存（每个工作进程各一份）：条数上限和过期秒数，ANSWER_CACHE_SIZE 为0时关闭
+    'ANSWER_CACHE_SIZE': 1000,
+    'ANSWER_CACHE_TTL': 3600,
+    # 语义缓存：问题向量与同一知识库版本下已有问答记录的余弦相似度不低于阈值时复用其回答
+    'SEMANTIC_CACHE': True,
+    'SEMANTIC_CACHE_THRESHOLD': 0.95,
+    # 大模型API的共享连接池（每个工作进程按主机复用keep-alive连接）：总连接数/每主机连接数、
+    # 总超时/连接超时（秒），429/5xx/连接错误时最多重试 LLM_HTTP_RETRIES 次，退避 0.5s、1s、2s...
+    'LLM_HTTP_LIMIT': 100,
+    'LLM_HTTP_LIMIT_PER_HOST': 20,
+    'LLM_HTTP_TIMEOUT': 30,
+    'LLM_HTTP_CONNECT_TIMEOUT': 10,
+    'LLM_HTTP_RETRIES': 2,
+    'LLM_HTTP_BACKOFF': 0.5,
+    # 问答提示词中知识库内容的token预算：不超过 CONTEXT_TOKEN_BUDGET，
+    # 且不超过模型上下文窗口 LLM_CONTEXT_WINDOW 扣除回答的 max_tokens（ModelConfig.max_tokens）和提示模板
+    'CONTEXT_TOKEN_BUDGET': 3000,
+    'LLM_CONTEXT_WINDOW': 8192,
+    # 问答路径上数据库查询共用的线程池大小（每个工作进程），线程常驻并复用数据库连接
+    'DB_EXECUTOR_WORKERS': 4,
+    # 工作进程启动时（gunicorn post_fork）在后台预加载最近 PREWARM_DAYS 天问答最多的 PREWARM_TOP_N 个知识库的索引，
+    # 进度见 /knowledge/health 的 prewarm 字段
+    'PREWARM_ON_STARTUP': True,
+    'PREWARM_TOP_N': 5,
+    'PREWARM_DAYS': 7,
+    # 上传的文档加入 IngestionJob 队列，由 `python manage.py process_ingestion_jobs` 后台处理；
+    # 关闭后在上传请求内同步处理（大文件可能超过 gunicorn 的超时时间）
+    'ASYNC_INGESTION': True,
+    'INGEST_WORKERS': 2,
+    # 入库时每编码并写库一批的块数，决定处理大文件时的峰值内存
+    'INGEST_BATCH_SIZE': 256,
+    # 入库工作进程一次领取同一知识库的任务数，其中的小文件在进程池中并行解析/分块（默认 CPU 核数，最多4个）；
+    # Web请求内的同步上传始终依次处理
+    # 'PARSE_WORKERS': 4,
+    # 并行解析的子进程整份读取文件并把全部块传回工作进程，超过 PARALLEL_PARSE_MAX_BYTES 的文件改为逐个流式入库
+    'PARALLEL_PARSE_MAX_BYTES': 8 * 1024 * 1024,
+    # 处理中的任务每 INGEST_HEARTBEAT_INTERVAL 秒刷新一次心跳，超过 INGEST_JOB_TIMEOUT 秒没有心跳视为工作进程已退出，
+    # 工作进程每 INGEST_REQUEUE_INTERVAL 秒检查一次并把这些任务重新排队
+    'INGEST_HEARTBEAT_INTERVAL': 30,
+    'INGEST_JOB_TIMEOUT': 300,
+    'INGEST_REQUEUE_INTERVAL': 60,
+    # 嵌入模型API（EmbeddingConfig.embedding_type='api'）：每次请求的文本数、进程内共享的并发请求数、超时秒数、
+    # 进程内缓存条数；429/5xx/连接错误时最多重试 EMBEDDING_API_RETRIES 次，退避时间同 LLM_HTTP_BACKOFF
+    'EMBEDDING_API_BATCH_SIZE': 64,
+    'EMBEDDING_API_CONCURRENCY': 4,
+    'EMBEDDING_API_TIMEOUT': 30,
+    'EMBEDDING_API_CACHE_SIZE': 10000,
+    'EMBEDDING_API_RETRIES': 2,
+    # 需要拟合的嵌入模型（SimpleEmbedding 词汇表、本地TF-IDF的idf）：知识库的第一个文档在最多
+    # EMBEDDING_FIT_SAMPLE_SIZE 个均匀抽样的块上拟合；之后块数每增长到拟合时的 EMBEDDING_REFIT_GROWTH 倍，
+    # 入库工作进程在全部语料上重新拟合并重新编码（设为 None 关闭，改为手动执行 python manage.py refit_embeddings）
+    'EMBEDDING_FIT_SAMPLE_SIZE': 5000,
+    'EMBEDDING_REFIT_GROWTH': 4,
+}
@@ -2,16 +2,25 @@
 # 保存为 gunicorn.conf.py
 
 import multiprocessing
+import os
 
 # 服务器套接字
 bind = "127.0.0.1:8000"
 backlog = 2048
 
 # 工作进程
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+# 使用ASGI应用(edu.asgi)：问答视图为异步视图，一个工作进程可同时等待多个大模型API调用。
+# 其余视图（登录、课程、文档管理等）仍是同步视图，Django 在ASGI下通过 sync_to_async(thread_sensitive=True)
+# 执行：每个请求有自己的线程上下文，同一请求内的同步代码在同一个线程中依次运行，不同请求之间不共享线程，
+# 也没有按线程数限制的并发上限（ASGI_THREADS 对此不起作用）。为与WSGI部署时的并发能力和内存占用相当，
+# 工作进程数不低于WSGI部署时的数量，可用 GUNICORN_WORKERS 调整。
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
 worker_connections = 1000
-timeout = 30
+# UvicornWorker 的心跳由事件循环发出，同步视图在线程池中执行不影响心跳；
+# 超时只在事件循环被阻塞时触发，留出预热和大模型流式回答的余量
+timeout = 120
+graceful_timeout = 60
 keepalive = 2
 
 # 重启
@@ -36,3 +45,15 @@ proc_name = "poweredu_ai"
 limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+
+def post_fork(server, worker):
+    """工作进程启动后在后台预热最活跃知识库的索引（KNOWLEDGE_BASE['PREWARM_ON_STARTUP']）"""
+    from apps.knowledge.prewarm import start_prewarm
+    start_prewarm()
+
+
+def worker_exit(server, worker):
+    """工作进程退出前关闭其余线程事件循环中的大模型API连接池（请求事件循环中的由 edu.asgi 的 lifespan 关闭）"""
+    from apps.knowledge.llm_client import close_all_sessions
+    close_all_sessions()
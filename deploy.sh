@@ -134,12 +134,15 @@ nginx -t
 echo "🔧 配置系统服务..."
 cp poweredu-ai-gunicorn.service /etc/systemd/system/
 sed -i "s|/var/www/poweredu-ai|$PROJECT_PATH|g" /etc/systemd/system/poweredu-ai-gunicorn.service
+cp poweredu-ai-ingest.service /etc/systemd/system/
+sed -i "s|/var/www/poweredu-ai|$PROJECT_PATH|g" /etc/systemd/system/poweredu-ai-ingest.service
 
 # 重新加载systemd
 systemctl daemon-reload
 
 # 启用并启动服务
 systemctl enable poweredu-ai-gunicorn
+systemctl enable poweredu-ai-ingest
 systemctl enable nginx
 systemctl enable redis-server
 
@@ -147,6 +150,7 @@ systemctl enable redis-server
 echo "🚀 启动服务..."
 systemctl start redis-server
 systemctl start poweredu-ai-gunicorn
+systemctl start poweredu-ai-ingest
 systemctl restart nginx
 
 # 13. 设置防火墙
@@ -35,6 +35,11 @@ echo "🚀 启动Django后端服务..."
 python3 manage.py runserver &
 BACKEND_PID=$!
 
+# 启动知识库文档入库工作进程（后台运行）
+echo "🚀 启动文档入库工作进程..."
+python3 manage.py process_ingestion_jobs &
+INGEST_PID=$!
+
 cd ..
 
 # 进入前端目录并安装依赖
@@ -69,5 +74,5 @@ echo ""
 echo "按 Ctrl+C 停止所有服务"
 
 # 等待用户中断
-trap "echo '停止服务...'; kill $BACKEND_PID $FRONTEND_PID; exit" INT
+trap "echo '停止服务...'; kill $BACKEND_PID $INGEST_PID $FRONTEND_PID; exit" INT
 wait